@@ -0,0 +1,166 @@
+# This module implements an opt-in on-disk cache for the identity
+# values (username, hostname, environment name, and their hashes)
+# resolved by anaconda_ident. Looking these up can be slow on hosts
+# backed by network directory services, and conda's own caching only
+# lasts as long as a single process. It also manages the suffix file
+# written into the prefix by `anaconda-ident --enable`, which holds
+# the same values precomputed for the installing user.
+
+import json
+import os
+import platform
+import sys
+import time
+from hashlib import blake2b
+from os import environ
+from os.path import dirname, expanduser, join
+
+from anaconda_anon_usage.utils import _debug
+
+CACHE_DIR = join(expanduser("~/.conda"), "anaconda_ident")
+SUFFIX_PATH = join(sys.prefix, "etc", "anaconda_ident_suffix.json")
+
+# The cache is disabled unless a positive lifetime, in seconds,
+# is supplied through this environment variable.
+try:
+    CACHE_TTL = float(environ.get("ANACONDA_IDENT_CACHE_TTL") or 0)
+except ValueError:
+    CACHE_TTL = 0
+
+
+# A lock file older than this is assumed to have been left behind
+# by a process that exited before removing it
+STALE_LOCK = 60
+
+
+def acquire_lock(lpath):
+    """
+    Attempts to create the given lock file, without waiting. Returns
+    True if successful; the caller must remove it with release_lock.
+    """
+    for _ in range(2):
+        try:
+            os.close(os.open(lpath, os.O_CREAT | os.O_EXCL | os.O_WRONLY, 0o600))
+            return True
+        except FileExistsError:
+            try:
+                if time.time() - os.stat(lpath).st_mtime < STALE_LOCK:
+                    return False
+                _debug("Removing stale lock: %s", lpath)
+                os.unlink(lpath)
+            except FileNotFoundError:
+                pass
+    return False
+
+
+def release_lock(lpath):
+    try:
+        os.unlink(lpath)
+    except OSError:
+        pass
+
+
+def cache_key(*parts):
+    """
+    Returns a short digest of the given strings, suitable for use
+    as a cache key or as a component of a filename.
+    """
+    data = "\0".join(str(p) for p in parts).encode("utf-8")
+    return blake2b(data, digest_size=16).hexdigest()
+
+
+def _identity_path(prefix):
+    # One file per host, so that hosts sharing a home directory do not
+    # overwrite each other's values
+    return join(CACHE_DIR, "ident_" + cache_key(prefix, platform.node()) + ".json")
+
+
+def load_identity(prefix, key, expired=False):
+    """
+    Returns the cached identity values for the given prefix, provided
+    they were saved under the same key and have not yet expired; or
+    if expired=True, regardless of their age. Returns an empty
+    dictionary otherwise.
+    """
+    if CACHE_TTL <= 0:
+        return {}
+    fpath = _identity_path(prefix)
+    try:
+        with open(fpath) as fp:
+            data = json.load(fp)
+        if data.get("key") != key:
+            _debug("Identity cache key mismatch: %s", fpath)
+        elif not expired and time.time() - data.get("time", 0) > CACHE_TTL:
+            _debug("Identity cache expired: %s", fpath)
+        else:
+            _debug("Identity cache hit: %s", fpath)
+            return data.get("values") or {}
+    except FileNotFoundError:
+        _debug("Identity cache not present: %s", fpath)
+    except Exception as exc:
+        _debug("Unexpected error reading identity cache: %s", exc)
+    return {}
+
+
+def _save(fpath, data):
+    tpath = f"{fpath}.{os.getpid()}"
+    try:
+        os.makedirs(dirname(fpath), exist_ok=True)
+        with open(tpath, "w") as fp:
+            json.dump(data, fp)
+        os.replace(tpath, fpath)
+        return True
+    except Exception as exc:
+        _debug("Unexpected error saving %s: %s", fpath, exc)
+        try:
+            os.unlink(tpath)
+        except OSError:
+            pass
+    return False
+
+
+def save_identity(prefix, key, values):
+    """
+    Saves the identity values for the given prefix and key. Failures
+    are silently ignored; the cache is purely an optimization.
+    """
+    if CACHE_TTL <= 0:
+        return
+    fpath = _identity_path(prefix)
+    data = {"key": key, "time": time.time(), "values": values}
+    if _save(fpath, data):
+        _debug("Identity cache saved: %s", fpath)
+
+
+def load_suffix(key):
+    """
+    Returns the precomputed token values from the suffix file, if it
+    was written under the given key; otherwise an empty dictionary.
+    """
+    try:
+        with open(SUFFIX_PATH) as fp:
+            data = json.load(fp)
+        if data.get("key") == key:
+            _debug("Precomputed suffix found: %s", SUFFIX_PATH)
+            return data.get("values") or {}
+        _debug("Precomputed suffix is stale: %s", SUFFIX_PATH)
+    except FileNotFoundError:
+        pass
+    except Exception as exc:
+        _debug("Unexpected error reading precomputed suffix: %s", exc)
+    return {}
+
+
+def save_suffix(key, values):
+    """
+    Writes the precomputed token values to the suffix file.
+    Returns True if successful.
+    """
+    return _save(SUFFIX_PATH, {"key": key, "values": values})
+
+
+def clear_suffix():
+    try:
+        os.unlink(SUFFIX_PATH)
+    except FileNotFoundError:
+        pass
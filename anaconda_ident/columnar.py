@@ -0,0 +1,322 @@
+# This module implements TokenBatch, a columnar representation of the
+# TokenRecords parsed from access logs, for analysis in memory. Each
+# token is a column: a dictionary of its distinct values, in order of
+# first appearance, and an array holding the code of each record's
+# value in that dictionary. Codes are one byte wide until a column has
+# more than 255 distinct values, two until it has more than 65535, and
+# four beyond that, so a record takes a few dozen bytes, rather than
+# the several hundred of a dict. Counts grouped by any combination of
+# tokens, and the distinct values of a token, are computed over the
+# codes, a column at a time. The repeatable tokens, o and m, are
+# interned as tuples. NumPy is optional: if it is installed, the codes
+# can be exported to it without copying, and it is used to group them.
+
+from array import array
+from collections import Counter
+from itertools import compress, islice
+from operator import itemgetter
+
+from . import logparse
+from .logparse import FIELDS, TokenRecord
+
+# The array type codes, and the number of distinct values each holds
+_WIDTHS = (("B", 1 << 8), ("H", 1 << 16), ("I", 1 << 32))
+_LIMITS = dict(_WIDTHS)
+# Records are added to the columns this many at a time
+CHUNK_SIZE = 65536
+
+
+def _numpy():
+    try:
+        import numpy
+    except ImportError:
+        return None
+    return numpy
+
+
+def _require_numpy():
+    numpy = _numpy()
+    if numpy is None:
+        raise ImportError("Exporting to NumPy requires numpy")
+    return numpy
+
+
+class Column:
+    """
+    The values of one token in a TokenBatch. values lists the distinct
+    values, with None, for records without the token, always first;
+    codes holds the index into values of each record's value.
+    """
+
+    __slots__ = ("name", "values", "index", "codes")
+
+    def __init__(self, name, values=None, index=None, codes=None):
+        self.name = name
+        self.values = [None] if values is None else values
+        self.index = {None: 0} if index is None else index
+        self.codes = array("B") if codes is None else codes
+
+    def __len__(self):
+        return len(self.codes)
+
+    def __getitem__(self, ndx):
+        return self.values[self.codes[ndx]]
+
+    def code(self, value):
+        """
+        Returns the code of a value, adding it to the dictionary if it
+        is new, and widening the codes if necessary.
+        """
+        code = self.index.get(value)
+        if code is None:
+            code = self.index[value] = len(self.values)
+            self.values.append(value)
+            if code >= _LIMITS[self.codes.typecode]:
+                self._widen(code)
+        return code
+
+    def _widen(self, code):
+        for typecode, limit in _WIDTHS:
+            if code < limit:
+                self.codes = array(typecode, self.codes)
+                return
+        raise OverflowError(f"Too many distinct values of {self.name}")
+
+    def to_numpy(self):
+        """
+        Returns the codes as a NumPy array of unsigned integers, which
+        shares their memory. The batch cannot be extended while such
+        an array exists.
+        """
+        numpy = _require_numpy()
+        return numpy.frombuffer(self.codes, dtype=f"u{self.codes.itemsize}")
+
+
+class TokenBatch:
+    """
+    A columnar batch of TokenRecords, limited to the given fields; all
+    of them by default. Records are added with extend, and retrieved by
+    index or iteration; their absent fields are None.
+    """
+
+    def __init__(self, fields=FIELDS):
+        bad = [f for f in fields if f not in logparse._INDEX]
+        if bad or not fields:
+            raise ValueError(
+                f"Unknown fields: {','.join(bad)}; expected {','.join(FIELDS)}"
+            )
+        self.fields = tuple(fields)
+        self.columns = {f: Column(f) for f in self.fields}
+        self._length = 0
+
+    @classmethod
+    def from_records(cls, records, fields=FIELDS):
+        """
+        Returns a batch of the given TokenRecords.
+        """
+        result = cls(fields)
+        result.extend(records)
+        return result
+
+    def __len__(self):
+        return self._length
+
+    @property
+    def nbytes(self):
+        """
+        The size of the codes, in bytes, not counting the dictionaries.
+        """
+        return sum(len(c.codes) * c.codes.itemsize for c in self.columns.values())
+
+    def extend(self, records):
+        """
+        Adds an iterable of TokenRecords to the batch. Consecutive
+        records repeat heavily, so the codes of each distinct record
+        are looked up only once in each chunk of them.
+        """
+        records = iter(records)
+        columns = [self.columns[f] for f in self.fields]
+        full = self.fields == FIELDS
+        # Repeating the first index returns a tuple even for one field
+        indices = [logparse._INDEX[f] for f in self.fields]
+        select = itemgetter(*indices, *indices[:1])
+        end = len(indices)
+        while True:
+            chunk = list(islice(records, CHUNK_SIZE))
+            if not chunk:
+                break
+            memo = {}
+            rows = []
+            for record in chunk:
+                row = memo.get(record)
+                if row is None:
+                    values = record if full else select(record)[:end]
+                    row = memo[record] = tuple(map(Column.code, columns, values))
+                rows.append(row)
+            for column, codes in zip(columns, zip(*rows)):
+                column.codes.extend(codes)
+            self._length += len(rows)
+
+    def __getitem__(self, ndx):
+        values = dict.fromkeys(FIELDS)
+        for field, column in self.columns.items():
+            values[field] = column[ndx]
+        return TokenRecord(**values)
+
+    def __iter__(self):
+        columns = [self.columns[f] for f in self.fields]
+        indices = [logparse._INDEX[f] for f in self.fields]
+        empty = [None] * len(FIELDS)
+        for codes in zip(*(c.codes for c in columns)):
+            values = list(empty)
+            for ndx, column, code in zip(indices, columns, codes):
+                values[ndx] = column.values[code]
+            yield TokenRecord._make(values)
+
+    def _shared(self, codes):
+        # A batch with the given codes for each column, sharing this
+        # one's dictionaries
+        result = TokenBatch.__new__(TokenBatch)
+        result.fields = self.fields
+        result.columns = {
+            f: Column(f, c.values, c.index, codes[f]) for f, c in self.columns.items()
+        }
+        result._length = len(codes[self.fields[0]])
+        return result
+
+    def where(self, **conditions):
+        """
+        Returns a batch of the records whose fields have the given
+        values, such as where(o=("acme",), n="ml-gpu"), sharing this
+        batch's dictionaries. A value of None selects the records
+        without that token.
+        """
+        codes = {}
+        for field, value in conditions.items():
+            code = self.columns[field].index.get(value)
+            if code is None:
+                return self._shared(
+                    {f: array(c.codes.typecode) for f, c in self.columns.items()}
+                )
+            codes[field] = code
+        numpy = _numpy()
+        if numpy is not None and len(self):
+            mask = numpy.ones(len(self), dtype=bool)
+            for field, code in codes.items():
+                mask &= self.columns[field].to_numpy() == code
+            result = {}
+            for field, column in self.columns.items():
+                selected = array(column.codes.typecode)
+                selected.frombytes(column.to_numpy()[mask].tobytes())
+                result[field] = selected
+            return self._shared(result)
+        selected = range(len(self))
+        for field, code in codes.items():
+            column = self.columns[field].codes
+            selected = list(
+                compress(selected, map(code.__eq__, map(column.__getitem__, selected)))
+            )
+        return self._shared(
+            {
+                f: array(c.codes.typecode, map(c.codes.__getitem__, selected))
+                for f, c in self.columns.items()
+            }
+        )
+
+    def distinct(self, field):
+        """
+        Returns the distinct values of a field found in the batch, in
+        order of first appearance, not counting None.
+        """
+        column = self.columns[field]
+        numpy = _numpy()
+        # The dictionary may be shared with a larger batch, so the
+        # order of its codes is not necessarily that of this one
+        if numpy is not None:
+            codes, first = numpy.unique(column.to_numpy(), return_index=True)
+            present = codes[numpy.argsort(first)].tolist()
+        else:
+            present = dict.fromkeys(column.codes)
+        return [column.values[c] for c in present if c]
+
+    def group_by(self, keys, distinct=None):
+        """
+        Returns a dict mapping each combination of values of the given
+        fields found in the batch to the number of records with it;
+        or, with distinct, to the number of distinct values of that
+        field among them, not counting None. keys is a field, whose
+        values are the keys of the result, or a sequence of them,
+        whose tuples of values are.
+        """
+        single = isinstance(keys, str)
+        keys = (keys,) if single else tuple(keys)
+        columns = [self.columns[k] for k in keys]
+        grouped = None
+        if _numpy() is not None and len(self):
+            grouped = self._group_numpy(columns, distinct)
+        if grouped is None:
+            codes = [c.codes for c in columns]
+            if distinct is None:
+                grouped = Counter(zip(*codes))
+            else:
+                pairs = set(zip(*codes, self.columns[distinct].codes))
+                grouped = Counter(p[:-1] for p in pairs if p[-1])
+        if single:
+            values = columns[0].values
+            return {values[k[0]]: n for k, n in grouped.items()}
+        return {
+            tuple(c.values[k] for c, k in zip(columns, key)): n
+            for key, n in grouped.items()
+        }
+
+    def _group_numpy(self, columns, distinct):
+        # Combines the codes of the key columns, and of the distinct
+        # column if any, into one integer for each record, which is
+        # then counted; or returns None if it might overflow
+        numpy = _numpy()
+        sizes = [len(c.values) for c in columns]
+        if distinct is not None:
+            sizes.append(len(self.columns[distinct].values))
+        total = 1
+        for size in sizes:
+            total *= size
+        if total >= 1 << 63:
+            return None
+        combined = numpy.zeros(len(self), dtype=numpy.int64)
+        arrays = [c.to_numpy() for c in columns]
+        if distinct is not None:
+            arrays.append(self.columns[distinct].to_numpy())
+        for size, codes in zip(sizes, arrays):
+            combined *= size
+            combined += codes
+        if distinct is not None:
+            # Each distinct pair once, without the records lacking the value
+            combined = numpy.unique(combined[arrays[-1] != 0]) // sizes[-1]
+            sizes.pop()
+        unique, counts = numpy.unique(combined, return_counts=True)
+        grouped = {}
+        for value, count in zip(unique.tolist(), counts.tolist()):
+            key = []
+            for size in reversed(sizes):
+                value, code = divmod(value, size)
+                key.append(code)
+            grouped[tuple(reversed(key))] = count
+        return grouped
+
+    def to_numpy(self):
+        """
+        Returns a dict of the codes of each field as NumPy arrays that
+        share their memory, as Column.to_numpy does. The value of each
+        code is found in the dictionary of its column, as in
+        columns[field].values[code].
+        """
+        _require_numpy()
+        return {f: c.to_numpy() for f, c in self.columns.items()}
+
+
+def read_batch(paths, jobs=1, fields=FIELDS):
+    """
+    Parses the given log files, as logparse.parse_files does, into a
+    TokenBatch limited to the given fields.
+    """
+    return TokenBatch.from_records(logparse.parse_files(paths, jobs), fields)
@@ -0,0 +1,268 @@
+# This module implements an optional per-user daemon that resolves
+# the prefix-independent identity tokens once and serves them to
+# conda processes over a UNIX socket. On shared login nodes, where
+# many short-lived conda commands run concurrently, this replaces the
+# token file reads and directory service lookups each would otherwise
+# perform. The daemon is started on demand by the first conda process
+# that needs it, and exits after a period of inactivity. Any failure
+# to reach it leaves the caller to resolve the tokens itself. The
+# server side imports anaconda_ident.patch, and with it conda, only
+# when it starts.
+
+import json
+import os
+import socket
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+from os import environ
+from os.path import join
+
+from anaconda_anon_usage.utils import _debug
+
+from . import __version__
+from .cache import cache_key
+
+# Set ANACONDA_IDENT_DAEMON=1 to enable the daemon. It exits after
+# ANACONDA_IDENT_DAEMON_IDLE seconds without a request.
+ENABLED = bool(environ.get("ANACONDA_IDENT_DAEMON")) and hasattr(socket, "AF_UNIX")
+try:
+    IDLE_TIMEOUT = float(environ.get("ANACONDA_IDENT_DAEMON_IDLE") or 900)
+except ValueError:
+    IDLE_TIMEOUT = 900
+
+# How long a client waits for a reply before resolving the tokens
+# itself, and how long the daemon retains a result before resolving
+# it again, so that changes to login tokens and the like are noticed.
+CLIENT_TIMEOUT = 0.5
+REFRESH_INTERVAL = 60
+
+# The session token is unique to each process, so it is never served
+LOCAL_CODES = "s"
+
+# The anaconda_anon_usage tokens depend upon these variables as well
+# as the user's files. The daemon only answers clients whose values
+# match its own; others fall back to resolving the tokens locally.
+ENVIRONMENT_VARIABLES = (
+    "HOME",
+    "CONDARC",
+    "XDG_CONFIG_HOME",
+    "ANACONDA_AUTH_API_KEY",
+    "ANACONDA_ANON_USAGE_ORG_TOKEN",
+    "ANACONDA_ANON_USAGE_MACHINE_TOKEN",
+)
+
+
+def environment_key():
+    return cache_key(*(environ.get(k, "") for k in ENVIRONMENT_VARIABLES))
+
+
+def _private_dir(path, create=False):
+    if create:
+        try:
+            os.mkdir(path, 0o700)
+        except FileExistsError:
+            pass
+    # Refuse a directory that another user could have created or
+    # could write to, since clients send the full config string.
+    st = os.lstat(path)
+    if not stat.S_ISDIR(st.st_mode) or st.st_uid != os.getuid():
+        raise PermissionError(f"Not owned by the current user: {path}")
+    if st.st_mode & 0o077:
+        raise PermissionError(f"Accessible by other users: {path}")
+    return path
+
+
+def socket_dir(create=False):
+    """
+    Returns the directory containing the daemon socket: the login
+    session's runtime directory if one is provided, otherwise a
+    private subdirectory of the temporary directory. Raises an
+    exception if the directory is not private to the current user.
+    """
+    runtime = environ.get("XDG_RUNTIME_DIR")
+    if runtime:
+        return _private_dir(runtime)
+    path = join(tempfile.gettempdir(), f"anaconda_ident-{os.getuid()}")
+    return _private_dir(path, create)
+
+
+def socket_path(sdir=None):
+    # One daemon per user and installation, since the tokens it
+    # serves depend upon the conda installation as well.
+    key = cache_key(sys.prefix, __version__)[:16]
+    return join(sdir or socket_dir(), f"anaconda_ident-{key}.sock")
+
+
+_spawned = None
+
+
+def start():
+    """
+    Launches the daemon in the background, detached from the caller.
+    Concurrent launches are harmless; all but one exit immediately.
+    """
+    global _spawned
+    if _spawned is not None:
+        return
+    _debug("Starting the token daemon")
+    try:
+        _spawned = subprocess.Popen(
+            [sys.executable, "-m", "anaconda_ident.daemon"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            start_new_session=True,
+        )
+    except Exception as exc:
+        _debug("Unexpected error starting the token daemon: %s", exc)
+        _spawned = False
+
+
+def request_tokens(config, spawn=True):
+    """
+    Returns the prefix-independent token values for the given
+    anaconda_ident config string, as a dictionary keyed by token
+    code, or None if the daemon cannot supply them. If the daemon
+    is not running and spawn=True, it is started for later callers.
+    """
+    request = {"config": config, "env": environment_key()}
+    try:
+        path = socket_path()
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+            sock.settimeout(CLIENT_TIMEOUT)
+            sock.connect(path)
+            sock.sendall(json.dumps(request).encode("utf-8") + b"\n")
+            with sock.makefile("rb") as fp:
+                response = json.loads(fp.readline())
+        values = response.get("values")
+        _debug("Token daemon %s: %s", "hit" if values else "miss", path)
+        return values
+    except (FileNotFoundError, ConnectionRefusedError):
+        _debug("Token daemon not running")
+        if spawn:
+            start()
+    except Exception as exc:
+        _debug("Unexpected error contacting the token daemon: %s", exc)
+    return None
+
+
+class _TokenServer:
+    def __init__(self):
+        from . import patch
+
+        self.patch = patch
+        self.env_key = environment_key()
+        self.entries = {}
+
+    def resolve(self, config):
+        now = time.monotonic()
+        entry = self.entries.get(config)
+        if entry is not None and now - entry[0] < REFRESH_INTERVAL:
+            return entry[1]
+        if entry is not None:
+            # Have anaconda_anon_usage read its token files again
+            from anaconda_anon_usage.utils import _cache_clear
+
+            _cache_clear()
+            self.entries.clear()
+        plan = self.patch.token_plan(config)
+        codes = "".join(c for c in plan.static if c not in LOCAL_CODES)
+        values, late = self.patch._resolve_tokens(plan, codes, sys.prefix, {})
+        # The encoded reply is retained, so repeat requests cost
+        # little more than the socket operations themselves
+        response = json.dumps({"values": values}).encode("utf-8") + b"\n"
+        if not late:
+            self.entries[config] = (now, response)
+        return response
+
+    def handle(self, conn):
+        conn.settimeout(CLIENT_TIMEOUT)
+        data = b""
+        while not data.endswith(b"\n") and len(data) < 65536:
+            chunk = conn.recv(65536)
+            if not chunk:
+                break
+            data += chunk
+        try:
+            request = json.loads(data)
+            if request.get("env") != self.env_key:
+                response = b"{}\n"
+            else:
+                response = self.resolve(request["config"])
+        except Exception as exc:
+            _debug("Unexpected error serving tokens: %s", exc)
+            response = b"{}\n"
+        conn.sendall(response)
+
+
+def serve(idle=None, sdir=None):
+    """
+    Runs the daemon until no request has been received for the given
+    number of seconds. Returns False without serving if another daemon
+    already holds the socket.
+    """
+    import fcntl
+
+    sdir = sdir or socket_dir(create=True)
+    path = socket_path(sdir)
+    server = _TokenServer()
+    with open(path + ".lock", "a") as lock:
+        try:
+            fcntl.flock(lock, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            _debug("Token daemon already running: %s", path)
+            return False
+        # The daemon runs outside of any conda command, so it loads
+        # the configuration itself, as conda would
+        from conda.base.context import context
+
+        server.patch.add_parameters()
+        context.__init__()
+        try:
+            os.unlink(path)
+        except FileNotFoundError:
+            pass
+        idle = IDLE_TIMEOUT if idle is None else idle
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as listener:
+            listener.bind(path)
+            try:
+                os.chmod(path, 0o600)
+                listener.listen(128)
+                listener.settimeout(idle)
+                _debug("Token daemon listening: %s", path)
+                while True:
+                    try:
+                        conn, _ = listener.accept()
+                    except socket.timeout:
+                        break
+                    with conn:
+                        try:
+                            server.handle(conn)
+                        except OSError as exc:
+                            _debug("Token daemon client error: %s", exc)
+            finally:
+                os.unlink(path)
+        _debug("Token daemon exiting after %ds idle", idle)
+    return True
+
+
+def main():
+    import argparse
+
+    p = argparse.ArgumentParser(description="anaconda-ident token daemon")
+    p.add_argument(
+        "--idle",
+        type=float,
+        default=IDLE_TIMEOUT,
+        help="Exit after this many seconds without a request.",
+    )
+    args = p.parse_args()
+    serve(args.idle)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,383 @@
+# This module implements a persistent index from the hashed U/, H/,
+# and N/ tokens back to the values they were computed from, so that
+# the rosters need not be hashed again for every analysis. It is built
+# by "anaconda-ident-hash index" and read by anaconda-ident-dehash.
+#
+# The file holds the digests, sorted, and the values in a single heap,
+# so it is read with mmap and searched in place: opening it takes no
+# time, and processes that read the same index share one copy of it in
+# the page cache. The layout, with integers little-endian, is:
+#
+#   header   MAGIC, the number of peppers, and the number of
+#            usernames, hostnames, and environment names
+#   peppers  for each pepper, its fingerprint, and the first and last
+#            days on which it was used, or zero if unbounded
+#   digests  the 16-byte blake2b digest of each value, in a section
+#            for each kind, in that order; each section sorted
+#   ids      a 2-byte pepper number for each digest, padded to a
+#            multiple of 8 bytes
+#   offsets  an 8-byte offset into the heap for each value, and one
+#            for the end of the heap
+#   heap     the UTF-8 encoded values, in the order of the digests
+#
+# Each value is hashed with every pepper, and the digests of all of
+# them are sorted together, so that a hash is found in a single search
+# whichever pepper it was computed with. New values and peppers are
+# added by merging them into a new copy of the file, which then
+# replaces the old one; a process that has the old one open continues
+# to read it undisturbed.
+
+import argparse
+import heapq
+import os
+import struct
+import sys
+from array import array
+from base64 import urlsafe_b64decode
+from binascii import Error as Base64Error
+from datetime import date
+from hashlib import blake2b
+from itertools import groupby
+from mmap import ACCESS_READ, mmap
+from operator import itemgetter
+
+from . import roster
+
+MAGIC = b"AIDXv002"
+_HEADER = struct.Struct("<8s4Q")
+_PEPPER = struct.Struct("<16sqq")
+_DIGEST_SIZE = 16
+# The pepper numbers are stored in two bytes
+MAX_PEPPERS = 65535
+
+
+def _fingerprint(pepper):
+    # Identifies the pepper without revealing it; like hash_string, it
+    # uses only as much of the pepper as fits in the salt
+    if isinstance(pepper, str):
+        pepper = pepper.encode("utf-8")
+    pepper = (pepper or b"")[: blake2b.SALT_SIZE]
+    return blake2b(pepper, digest_size=16, person=b"aident-pepper").digest()
+
+
+def _peppers(peppers):
+    # A single pepper, or a list of them, as a list of roster.Peppers
+    if not isinstance(peppers, list):
+        peppers = [peppers]
+    return [
+        p if isinstance(p, roster.Pepper) else roster.Pepper(p, None, None)
+        for p in peppers
+    ]
+
+
+def _decode(token):
+    # The digest from which a hashed token was encoded, or None
+    if len(token) != 22:
+        return None
+    try:
+        return urlsafe_b64decode(token + "==")
+    except (Base64Error, ValueError):
+        return None
+
+
+def _array(mm, start, end, code):
+    # A view of part of the map as an array of integers, without a
+    # copy where the byte order allows
+    view = memoryview(mm)[start:end]
+    if sys.byteorder == "little":
+        return view.cast(code)
+    result = array(code, view)
+    result.byteswap()
+    view.release()
+    return result
+
+
+class _Section:
+    """
+    The values of one kind in an index; like a dictionary from hashed
+    token to value, for lookups only.
+    """
+
+    __slots__ = ("index", "start", "stop")
+
+    def __init__(self, index, start, stop):
+        self.index, self.start, self.stop = index, start, stop
+
+    def __len__(self):
+        return self.stop - self.start
+
+    def get(self, token, default=None):
+        digest = _decode(token)
+        if digest is None:
+            return default
+        index = self.index
+        pos = index._find(digest, self.start, self.stop)
+        if pos < 0 or index._valid is not None and index._ids[pos] not in index._valid:
+            return default
+        return index._value(pos).decode("utf-8")
+
+
+class HashIndex:
+    """
+    An index file opened for lookups. If peppers are given, a single
+    one or a list, the index must include each of them. If a date is
+    given, hashes computed with peppers not in use on that date are not
+    found. Indexing it with a hashed token name, U, H, or N, gives an
+    object whose get method looks up a hash of that kind, as with the
+    tables of roster.build_table.
+    """
+
+    def __init__(self, path, peppers=None, when=None):
+        self.path = path
+        with open(path, "rb") as fp:
+            self._mm = mmap(fp.fileno(), 0, access=ACCESS_READ)
+        self._views = []
+        try:
+            self._open(peppers, when)
+        except Exception:
+            self.close()
+            raise
+
+    def _open(self, peppers, when):
+        mm, path = self._mm, self.path
+        if len(mm) < _HEADER.size or mm[:8] != MAGIC:
+            raise ValueError(f"Not a hash index, or an older one: {path}")
+        _, npeppers, *counts = _HEADER.unpack_from(mm)
+        # The fingerprint, and the first and last dates of use, of each
+        # pepper, in the order of their numbers
+        self.peppers = []
+        for num in range(npeppers):
+            at = _HEADER.size + _PEPPER.size * num
+            fprint, start, end = _PEPPER.unpack_from(mm, at)
+            start = date.fromordinal(start) if start else None
+            end = date.fromordinal(end) if end else None
+            self.peppers.append(roster.Pepper(fprint, start, end))
+        if peppers is not None:
+            fprints = {p.value for p in self.peppers}
+            for pepper in _peppers(peppers):
+                if _fingerprint(pepper.value) not in fprints:
+                    raise ValueError(f"Index built without a given pepper: {path}")
+        self._valid = None
+        if when is not None:
+            self._valid = {
+                n for n, p in enumerate(self.peppers) if roster.in_use(p, when)
+            }
+        total = sum(counts)
+        self._digests_at = _HEADER.size + _PEPPER.size * npeppers
+        ids_at = self._digests_at + _DIGEST_SIZE * total
+        offsets_at = ids_at + (2 * total + 7) // 8 * 8
+        self._heap_at = offsets_at + 8 * (total + 1)
+        if len(mm) < self._heap_at:
+            raise ValueError(f"Truncated hash index: {path}")
+        self._ids = _array(mm, ids_at, ids_at + 2 * total, "H")
+        self._offsets = _array(mm, offsets_at, self._heap_at, "Q")
+        self._views = [self._ids, self._offsets]
+        self.sections = {}
+        start = 0
+        for (hashed, _), count in zip(roster.KINDS.values(), counts):
+            self.sections[hashed] = _Section(self, start, start + count)
+            start += count
+
+    def __getitem__(self, hashed):
+        return self.sections[hashed]
+
+    def __len__(self):
+        return len(self._offsets) - 1
+
+    def counts(self):
+        """
+        Returns the number of digests of each kind, by kind. There is a
+        digest for each value and each pepper it was hashed with, so
+        with several peppers this exceeds the number of values.
+        """
+        return {k: len(s) for k, s in zip(roster.KINDS, self.sections.values())}
+
+    def _find(self, digest, lo, hi):
+        # Digests are uniformly distributed, so an interpolation search
+        # finds one in a few probes, where a binary search takes about
+        # log2(n); each probe compares 16 bytes of the map in place
+        mm, base = self._mm, self._digests_at
+        target = int.from_bytes(digest, "big")
+        lo_key, hi_key = -1, 1 << 128
+        while lo < hi:
+            mid = lo + (target - lo_key) * (hi - lo) // (hi_key - lo_key)
+            at = base + _DIGEST_SIZE * mid
+            end = at + _DIGEST_SIZE
+            probe = int.from_bytes(mm[at:end], "big")
+            if probe < target:
+                lo, lo_key = mid + 1, probe
+            elif probe > target:
+                hi, hi_key = mid, probe
+            else:
+                return mid
+        return -1
+
+    def _value(self, pos):
+        start = self._heap_at + self._offsets[pos]
+        end = self._heap_at + self._offsets[pos + 1]
+        return self._mm[start:end]
+
+    def items(self, kind):
+        """
+        Yields the (digest, pepper number, value) triples of the given
+        kind, in order, with the values as UTF-8 encoded bytes.
+        """
+        section = self.sections[roster.KINDS[kind][0]]
+        mm, ids = self._mm, self._ids
+        for pos in range(section.start, section.stop):
+            at = self._digests_at + _DIGEST_SIZE * pos
+            end = at + _DIGEST_SIZE
+            yield mm[at:end], ids[pos], self._value(pos)
+
+    def close(self):
+        if self._mm is not None:
+            for view in self._views:
+                if isinstance(view, memoryview):
+                    view.release()
+            self._mm.close()
+            self._mm = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def _write(path, peppers, sections):
+    # Writes the sorted (digest, pepper number, value) triples of each
+    # kind, replacing the file atomically once it is complete
+    digests, ids, heap = bytearray(), array("H"), bytearray()
+    offsets, counts = array("Q", [0]), []
+    for triples in sections:
+        count = 0
+        for digest, num, value in triples:
+            digests += digest
+            ids.append(num)
+            heap += value
+            offsets.append(len(heap))
+            count += 1
+        counts.append(count)
+    ids.extend([0] * (-len(ids) % 4))
+    if sys.byteorder != "little":
+        ids.byteswap()
+        offsets.byteswap()
+    tpath = path + ".tmp"
+    with open(tpath, "wb") as fp:
+        fp.write(_HEADER.pack(MAGIC, len(peppers), *counts))
+        for fprint, start, end in peppers:
+            start = start.toordinal() if start else 0
+            end = end.toordinal() if end else 0
+            fp.write(_PEPPER.pack(fprint, start, end))
+        fp.write(digests)
+        fp.write(ids.tobytes())
+        fp.write(offsets.tobytes())
+        fp.write(heap)
+        fp.flush()
+        os.fsync(fp.fileno())
+    os.replace(tpath, path)
+
+
+def update_index(path, entries, peppers=None, jobs=1):
+    """
+    Adds the (kind, value) pairs given to the index at path, creating
+    it if necessary, and returns the number of digests added; that is,
+    of new values, or values new to a pepper, times peppers. The values
+    are hashed with each of the peppers, already decoded: a single one,
+    or a list, possibly of roster.Peppers with the dates on which they
+    were in use. A pepper that is new to the index is added to it; the
+    dates of one already in it are replaced if given. jobs is as for
+    roster.hash_roster. The values already in the index are not hashed
+    again; the new ones are sorted, and merged with them in a single
+    pass.
+    """
+    peppers = _peppers(peppers)
+    old = HashIndex(path) if os.path.exists(path) else None
+    try:
+        table = list(old.peppers) if old is not None else []
+        numbers = {p.value: n for n, p in enumerate(table)}
+        for pepper in peppers:
+            fprint = _fingerprint(pepper.value)
+            num = numbers.setdefault(fprint, len(table))
+            if num == len(table):
+                table.append(roster.Pepper(fprint, pepper.start, pepper.end))
+            elif pepper.start or pepper.end:
+                table[num] = roster.Pepper(fprint, pepper.start, pepper.end)
+        if len(table) > MAX_PEPPERS:
+            raise ValueError(f"Too many peppers for one index: {len(table)}")
+        ids = [numbers[_fingerprint(p.value)] for p in peppers]
+        added = {kind: [] for kind in roster.KINDS}
+        values = [p.value for p in peppers]
+        hashed = roster.hash_roster(entries, values, jobs, raw=True)
+        for kind, num, batch, digests in hashed:
+            batch = [v.encode("utf-8") for v in batch]
+            added[kind].extend(zip(digests, [ids[num]] * len(batch), batch))
+        before = len(old) if old else 0
+        sections = []
+        for kind, triples in added.items():
+            triples.sort()
+            if old is not None:
+                triples = heapq.merge(old.items(kind), triples, key=itemgetter(0))
+            # A value already in the index is kept once
+            sections.append(next(g) for _, g in groupby(triples, itemgetter(0)))
+        _write(path, table, sections)
+    finally:
+        if old is not None:
+            old.close()
+    with HashIndex(path) as index:
+        return len(index) - before
+
+
+def parse_argv(args=None):
+    p = argparse.ArgumentParser(
+        prog="anaconda-ident-hash index",
+        description="Create or update an index from the hashed username, "
+        "hostname, and environment tokens back to the values they were "
+        "computed from, for use with anaconda-ident-dehash --index.",
+    )
+    p.add_argument("index", help="The index file to create or update.")
+    p.add_argument(
+        "--roster",
+        "-r",
+        action="append",
+        type=roster._roster_arg,
+        required=True,
+        help="A roster of values to add, as for anaconda-ident-dehash. "
+        "Repeatable; - is standard input.",
+    )
+    p.add_argument(
+        "--pepper",
+        action="append",
+        type=roster._pepper_arg,
+        default=[],
+        help="The pepper from the anaconda_ident config, as it appears there, "
+        "optionally followed by :START and :END, the first and last dates on "
+        "which it was in use, such as ugQzhEX5Fs45/iOonikPXA:2026-01-01. "
+        "Repeatable; each value is hashed with every pepper.",
+    )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used to hash the rosters; "
+        "0 means one for each CPU. Defaults to 1.",
+    )
+    args = p.parse_args(args)
+    args.pepper = args.pepper or [roster.parse_pepper("")]
+    return args
+
+
+def main(args=None):
+    args = parse_argv(args)
+    entries = (e for kind, path in args.roster for e in roster.read_roster(path, kind))
+    try:
+        added = update_index(args.index, entries, args.pepper, args.jobs)
+    except ValueError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+    with HashIndex(args.index) as index:
+        counts = ", ".join(f"{n:,d} {k}" for k, n in index.counts().items())
+        npeppers = len(index.peppers)
+    print(f"{args.index}: {npeppers} peppers; digests: {counts}; {added:,d} added")
+    return 0
@@ -0,0 +1,269 @@
+# This module coalesces the activation heartbeats sent by
+# anaconda_anon_usage. When anaconda_heartbeat_interval is set, at
+# most one heartbeat is sent for each environment within that many
+# seconds, no matter how many times it is activated. The time of the
+# last heartbeat is recorded as the modification time of a small
+# file in the user's cache directory, and an exclusive lock file
+# ensures that concurrent activations send at most one between them.
+#
+# When anaconda_heartbeat_background is set, the activation does not
+# send the heartbeat itself. Instead, it adds it to a bounded queue in
+# the same directory and launches a detached sender process, so the
+# activation never waits on the network.
+
+import json
+import os
+import subprocess
+import sys
+import time
+from os.path import join
+
+from anaconda_anon_usage.utils import _debug
+
+from .cache import CACHE_DIR, acquire_lock, cache_key, release_lock
+
+
+def _timestamp_path(prefix):
+    return join(CACHE_DIR, "heartbeat_" + cache_key(prefix))
+
+
+def heartbeat_due(prefix, interval):
+    """
+    Returns True if a heartbeat should be sent for the given prefix;
+    that is, if none has been sent within the last interval seconds.
+    In that case, the current time is recorded as well, so that the
+    caller is the only one to send it. Any error in the bookkeeping
+    itself allows the heartbeat to proceed.
+    """
+    tpath = _timestamp_path(prefix)
+    lpath = tpath + ".lock"
+    try:
+        os.makedirs(CACHE_DIR, exist_ok=True)
+        if not acquire_lock(lpath):
+            _debug("Heartbeat in progress for %s", prefix)
+            return False
+    except Exception as exc:
+        _debug("Unexpected error locking heartbeat timestamp: %s", exc)
+        return True
+    try:
+        now = time.time()
+        try:
+            age = now - os.stat(tpath).st_mtime
+        except FileNotFoundError:
+            age = None
+        if age is not None and 0 <= age < interval:
+            _debug("Heartbeat for %s sent %.0fs ago; skipping", prefix, age)
+            return False
+        with open(tpath, "w"):
+            pass
+        os.utime(tpath, (now, now))
+        return True
+    except Exception as exc:
+        _debug("Unexpected error updating heartbeat timestamp: %s", exc)
+        return True
+    finally:
+        release_lock(lpath)
+
+
+QUEUE_DIR = join(CACHE_DIR, "heartbeats")
+# Beats beyond this many pending are dropped, as are any that have
+# waited longer than QUEUE_MAX_AGE seconds to be sent.
+QUEUE_LIMIT = 16
+QUEUE_MAX_AGE = 3600
+# The sender waits this long before loading conda, so that it does
+# not compete with the activation itself on a busy machine.
+SENDER_DELAY = 1
+# Set in the detached sender, which may replay the offline spool
+# itself; an activation leaves that to a new sender instead.
+SENDER = False
+
+
+def _sender_lock():
+    return join(QUEUE_DIR, "sender.lock")
+
+
+def _queued():
+    try:
+        return sorted(f for f in os.listdir(QUEUE_DIR) if f.endswith(".json"))
+    except FileNotFoundError:
+        return []
+
+
+def _start_sender():
+    # Takes the sender lock on behalf of the new process, which releases
+    # it when done, so that a burst of activations starts only one
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    lpath = _sender_lock()
+    if not acquire_lock(lpath):
+        return False
+    kwargs = {}
+    if sys.platform == "win32":
+        kwargs["creationflags"] = subprocess.DETACHED_PROCESS
+    else:
+        kwargs["start_new_session"] = True
+    try:
+        subprocess.Popen(
+            [sys.executable, "-m", "anaconda_ident.heartbeat", "--locked"],
+            stdin=subprocess.DEVNULL,
+            stdout=subprocess.DEVNULL,
+            stderr=subprocess.DEVNULL,
+            close_fds=True,
+            **kwargs,
+        )
+    except Exception:
+        release_lock(lpath)
+        raise
+    return True
+
+
+def queue_heartbeat(prefix, channel=None, path=None, spawn=True):
+    """
+    Adds a heartbeat for the given prefix to the queue, and starts the
+    sender process unless one is already running. Returns False if
+    the queue is full and the heartbeat was dropped.
+    """
+    os.makedirs(QUEUE_DIR, exist_ok=True)
+    if len(_queued()) >= QUEUE_LIMIT:
+        _debug("Heartbeat queue full; dropping heartbeat for %s", prefix)
+        return False
+    now = time.time()
+    beat = {"prefix": prefix, "channel": channel, "path": path, "time": now}
+    fpath = join(QUEUE_DIR, "%.6f-%d.json" % (now, os.getpid()))
+    with open(fpath + ".tmp", "w") as fp:
+        json.dump(beat, fp)
+    os.replace(fpath + ".tmp", fpath)
+    _debug("Heartbeat queued: %s", fpath)
+    if spawn:
+        _start_sender()
+    return True
+
+
+def send_queued(locked=False):
+    """
+    Sends the queued heartbeats, oldest first, until the queue is
+    empty. Returns the number sent. Only one process does this at a
+    time; any other returns immediately. With locked=True, the caller
+    already holds the sender lock, which is released when done.
+    """
+    from anaconda_anon_usage import heartbeat as aau_heartbeat
+    from conda.base.context import context
+
+    from . import patch
+
+    patch.main()
+    if context.anaconda_heartbeat_spool:
+        patch_ping()
+    # Wait for each request, rather than leaving it to a thread
+    aau_heartbeat.STANDALONE = True
+    sent = 0
+    lpath = _sender_lock()
+    while locked or (_queued() and acquire_lock(lpath)):
+        locked = False
+        try:
+            for fname in _queued():
+                fpath = join(QUEUE_DIR, fname)
+                try:
+                    with open(fpath) as fp:
+                        beat = json.load(fp)
+                except Exception as exc:
+                    _debug("Unexpected error reading %s: %s", fpath, exc)
+                    beat = None
+                try:
+                    os.unlink(fpath)
+                except OSError:
+                    pass
+                if beat is None:
+                    continue
+                if time.time() - beat["time"] > QUEUE_MAX_AGE:
+                    _debug("Dropping expired heartbeat: %s", fname)
+                    continue
+                aau_heartbeat.attempt_heartbeat(
+                    beat["prefix"], channel=beat["channel"], path=beat["path"]
+                )
+                sent += 1
+        finally:
+            release_lock(lpath)
+        # Repeating the check after the lock is released picks up
+        # any beat queued by a process that saw the lock held.
+    return sent
+
+
+def _aid_ping(session, url, timeout):
+    from . import spool
+
+    try:
+        session.head(url, proxies=session.proxies, timeout=timeout)
+        _debug("Heartbeat sent: %s", url)
+    except Exception as exc:
+        _debug("Heartbeat not sent: %s", exc)
+        spool.spool_event(url, session.headers.get("User-Agent"))
+        return
+    # The repository is reachable, so this is a good time to send
+    # any heartbeats that were spooled while it was not
+    if spool.pending():
+        if SENDER:
+            spool.flush(lambda url: session, timeout)
+        else:
+            _start_sender()
+
+
+def patch_ping():
+    """
+    Replaces the anaconda_anon_usage heartbeat request with one that
+    spools the heartbeat when the repository cannot be reached.
+    """
+    from anaconda_anon_usage import heartbeat as aau_heartbeat
+
+    if not hasattr(aau_heartbeat, "_old_ping"):
+        _debug("Applying anaconda_ident heartbeat spool patch")
+        aau_heartbeat._old_ping = aau_heartbeat._ping
+        aau_heartbeat._ping = _aid_ping
+
+
+def flush_spool():
+    """
+    Sends the oldest batch of spooled heartbeats, if the spool is
+    enabled. Returns the number sent.
+    """
+    from anaconda_anon_usage import heartbeat as aau_heartbeat
+    from conda.base.context import context
+    from conda.gateways.connection.session import get_session
+
+    from . import spool
+
+    if not (context.anaconda_heartbeat_spool and spool.pending()):
+        return 0
+    timeout = aau_heartbeat.TIMEOUT / aau_heartbeat.ATTEMPTS
+    return spool.flush(get_session, timeout)
+
+
+def main(args=None):
+    global SENDER
+    SENDER = True
+    # Started by _start_sender, which took the lock on our behalf
+    locked = "--locked" in (sys.argv[1:] if args is None else args)
+    # Yield the CPU to the activating shell and whatever follows it
+    if hasattr(os, "nice"):
+        os.nice(10)
+    time.sleep(SENDER_DELAY)
+    from conda.base.context import context
+
+    from . import patch
+
+    # Loads the configuration, including the heartbeat settings
+    # and repository tokens, as conda itself would
+    patch.main()
+    context.__init__()
+    if locked:
+        # Keeps the lock from being taken for stale after a slow start;
+        # if it already has been, the lock is no longer ours
+        try:
+            os.utime(_sender_lock())
+        except OSError:
+            locked = False
+    send_queued(locked)
+    flush_spool()
+
+
+if __name__ == "__main__":
+    main()
@@ -6,9 +6,6 @@ import sysconfig
 from os.path import dirname, exists, join, relpath
 from traceback import format_exc
 
-from anaconda_anon_usage import __version__ as aau_version
-from conda import __version__ as c_version
-
 from . import __version__
 
 success = True
@@ -106,6 +103,14 @@ def parse_argv():
         "This takes the form of a single HEAD request attempt to the tokenized repository "
         "with silent failure and a short timeout for negligible disruption.",
     )
+    p.add_argument(
+        "--heartbeat-interval",
+        default=None,
+        type=int,
+        help="Send at most one activation heartbeat per environment within this "
+        "many seconds, coalescing repeated activations. Supply 0 to send a "
+        "heartbeat on every activation.",
+    )
     p.add_argument(
         "--write-token",
         default=None,
@@ -124,6 +129,14 @@ def parse_argv():
         "installed environment behaves as expected when replacing an older install. "
         "This is most useful in an installer post-install script.",
     )
+    p.add_argument(
+        "--precompute",
+        default=None,
+        action="store_true",
+        help="Precompute the fixed portion of the user agent for the current user "
+        "and save it in the prefix. This is done automatically whenever the "
+        "configuration is modified, and may be combined with --verify.",
+    )
     p.add_argument(
         "--quiet",
         dest="verbose",
@@ -137,9 +150,13 @@ def parse_argv():
 
     sys.argv[0] = "anaconda-ident"
     args = p.parse_args()
+    # --verify may be combined with --precompute
+    others = dict(vars(args))
+    if args.verify:
+        del others["precompute"]
     if (
         args.clean or args.verify or args.expect or args.status or args.version
-    ) and sum(v is not None for v in vars(args).values()) != 8:
+    ) and sum(v is not None for v in others.values()) != 8:
         what = "clean" if args.clean else ("status" if args.status else "verify")
         print("WARNING: --%s overrides other operations" % what)
     return args, p
@@ -200,10 +217,19 @@ def _eolmatch(text, ptext):
     return ptext
 
 
-def _read(pfile, patch_text):
+# Patches are always appended to the end of the target file, so its
+# status can be determined from the tail alone. This window is large
+# enough to hold any patch that has ever been written by this tool.
+TAIL_SIZE = 4096
+
+
+def _read(pfile, patch_text, full=False):
     if not exists(pfile):
         return None, "NOT PRESENT"
     with open(pfile, "rb") as fp:
+        if not full:
+            fp.seek(0, os.SEEK_END)
+            fp.seek(max(0, fp.tell() - TAIL_SIZE))
         text = fp.read()
     if patch_text and text.endswith(_eolmatch(text, patch_text)):
         status = "ENABLED"
@@ -246,11 +272,12 @@ def _patch(args, pfile, pname):
         patch_text = None
     text, status = _read(pfile, patch_text)
     if status == "DISABLED" and not patch_text:
-        return
+        return status
     if verbose:
         print(f"  {tpath}: {status}")
     enable = (not args or args.enable or args.verify or args.expect) and patch_text
     disable = args and (args.disable or args.clean or not patch_text)
+    current = status
     if status == "NEEDS UPDATE":
         need_change = True
         status = "reverting" if disable else "updating"
@@ -263,13 +290,14 @@ def _patch(args, pfile, pname):
     else:
         need_change = False
     if not need_change:
-        return
+        return current
     if args and args.expect and need_change:
         error("not properly enabled", fatal=True)
     if verbose:
         print(f"    {status} patch...", end="")
     renamed = False
     try:
+        text, _ = _read(pfile, patch_text, full=True)
         text = _strip_patch(text)
         # We do not append to the original file because this is
         # likely a hard link into the package cache, so doing so
@@ -297,6 +325,7 @@ def _patch(args, pfile, pname):
     text, status = _read(pfile, patch_text)
     if verbose:
         print(f"    new status: {status}")
+    return status
 
 
 # The only patch we need now is conda.gateways.anaconda_client
@@ -315,7 +344,7 @@ def _patch_anon_usage(args):
 
 def _patch_anaconda_client(args):
     acfile = join(_sp_dir(), "conda", "gateways", "anaconda_client.py")
-    _patch(args, acfile, "patch_ac")
+    return _patch(args, acfile, "patch_ac")
 
 
 def _patch_binstar_client(args):
@@ -335,8 +364,85 @@ def manage_patch(args):
         _patch_conda_context(args)
         _patch_anon_usage(args)
         _patch_binstar_client(args)
-    _patch_anaconda_client(args)
+    status = _patch_anaconda_client(args)
     _patch_heartbeat(args)
+    return status == "ENABLED"
+
+
+# The activation scripts compare this stamp against the files on
+# disk with a pure shell check, so that the Python interpreter is
+# launched only when something has actually changed. Each line
+# holds the size and full path of a file. On Unix, a file that is
+# missing or newer than the stamp itself invalidates it; on Windows,
+# one that is missing or has a different size. Package files may keep
+# the modification times they had when built, but an upgrade or
+# reinstall always replaces the package's conda-meta record.
+STAMP_PATH = join(sys.prefix, "etc", "anaconda_ident.stamp")
+STAMP_PACKAGES = ("conda", "anaconda-anon-usage", "anaconda-ident")
+
+
+def _stamp_files():
+    files = [
+        join(_sp_dir(), "conda", "gateways", "anaconda_client.py"),
+        join(_sp_dir(), "conda", "activate.py"),
+        join(dirname(__file__), "_version.py"),
+    ]
+    # The conda-meta records carry the package versions in their
+    # names, and are rewritten on every upgrade or reinstall.
+    versions = {}
+    mdir = join(sys.prefix, "conda-meta")
+    try:
+        for fname in sorted(os.listdir(mdir)):
+            parts = fname[:-5].rsplit("-", 2)
+            if fname.endswith(".json") and parts[0] in STAMP_PACKAGES:
+                versions[parts[0]] = parts[1]
+                files.append(join(mdir, fname))
+    except OSError:
+        pass
+    versions.setdefault("anaconda-ident", __version__)
+    return files, versions
+
+
+def write_stamp(args):
+    files, versions = _stamp_files()
+    lines = ["# " + " ".join(f"{k}={v}" for k, v in versions.items())]
+    for fpath in files:
+        try:
+            lines.append(f"{os.stat(fpath).st_size} {fpath}")
+        except OSError:
+            pass
+    tpath = f"{STAMP_PATH}.{os.getpid()}"
+    try:
+        os.makedirs(dirname(STAMP_PATH), exist_ok=True)
+        with open(tpath, "w") as fp:
+            fp.write("\n".join(lines) + "\n")
+        os.replace(tpath, STAMP_PATH)
+    except Exception as exc:
+        tryop(os.unlink, tpath)
+        if args.verbose:
+            print(f"failed to write verification stamp: {exc}")
+
+
+def clear_stamp():
+    if exists(STAMP_PATH):
+        tryop(os.unlink, STAMP_PATH)
+
+
+def manage_suffix(args, enabled):
+    from .cache import clear_suffix
+
+    if args.disable or args.clean or not enabled:
+        tryop(clear_suffix)
+        return
+    if args.verbose:
+        print("precomputing user agent suffix...")
+    try:
+        from .patch import write_suffix
+
+        if not write_suffix():
+            error("user agent suffix not saved", warn=True)
+    except Exception:
+        error("user agent suffix failed", warn=True)
 
 
 __yaml = None
@@ -388,6 +494,9 @@ def _print_condarc(args, config, changes=False):
     if not changes or args.heartbeat is not None:
         value = bool(config.get("anaconda_heartbeat"))
         print(f"  heartbeat: {value or '<none>'}")
+    if not changes or args.heartbeat_interval is not None:
+        value = config.get("anaconda_heartbeat_interval")
+        print(f"  heartbeat interval: {value or '<none>'}")
 
 
 def _set_or_delete(d, k, v):
@@ -477,6 +586,10 @@ def manage_condarc(args, condarc):
         heartbeat = args.heartbeat or None
         _set_or_delete(condarc, "anaconda_heartbeat", heartbeat)
         changes = True
+    if args.heartbeat_interval is not None:
+        interval = max(0, args.heartbeat_interval)
+        _set_or_delete(condarc, "anaconda_heartbeat_interval", interval)
+        changes = True
     _set_or_delete(condarc, "add_anaconda_token", bool(condarc.get("repo_tokens")))
     if changes and verbose:
         print("changes:")
@@ -586,8 +699,11 @@ def modify_binstar(args, condarc, save=True):
                     | stat.S_IREAD
                     | stat.S_IEXEC,
                 )
+            # Replace rather than rewrite, so the directory modification
+            # time changes and cached token reads are invalidated
             if exists(fpath):
                 os.chmod(fpath, os.stat(fpath).st_mode | stat.S_IWRITE)
+                os.unlink(fpath)
             with open(fpath, "w") as fp:
                 fp.write(token)
             t_success = True
@@ -614,6 +730,10 @@ def main():
         print(line)
         print("anaconda-ident installer")
         print(line)
+        # Deferred so that the --verify path does not load conda
+        from anaconda_anon_usage import __version__ as aau_version
+        from conda import __version__ as c_version
+
         print("versions:")
         print(f"  anaconda-ident: {__version__}")
         print(f"  anaconda-anon-usage: {aau_version}")
@@ -622,7 +742,12 @@ def main():
         print("  prefix:", sys.prefix)
         print(f"  site-packages: {relpath(_sp_dir(), sys.prefix)}")
 
-    manage_patch(args)
+    enabled = manage_patch(args)
+    if args.verify:
+        if enabled and success:
+            write_stamp(args)
+    elif not (args.expect or args.status):
+        clear_stamp()
     if not (args.verify or args.expect):
         fname = join(sys.prefix, "condarc.d", "anaconda_ident.yml")
         condarc = read_condarc(args, fname)
@@ -634,6 +759,8 @@ def main():
                 print("no changes to save")
         if args.write_token or args.clear_old_token:
             modify_binstar(args, newcondarc, save=args.write_token)
+    if not (args.expect or args.status) and (args.precompute or not args.verify):
+        manage_suffix(args, enabled and success)
     if verbose:
         print(line)
     return 0 if success else -1
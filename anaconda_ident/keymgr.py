@@ -121,6 +121,14 @@ def parse_argv():
         "This takes the form of a single HEAD request attempt to the tokenized repository "
         "with silent failure and a short timeout for negligible disruption.",
     )
+    p.add_argument(
+        "--heartbeat-interval",
+        default=None,
+        type=int,
+        help="If supplied, at most one activation heartbeat is sent per environment "
+        "within this many seconds; repeated activations within that window are "
+        "coalesced. By default, a heartbeat is sent on every activation.",
+    )
     p.add_argument(
         "--compatibility",
         default=False,
@@ -353,6 +361,10 @@ def build_config_dict(args):
     result["anaconda_heartbeat"] = hb
     if verbose:
         print("anaconda_heartbeat:", hb)
+    if hb and args.heartbeat_interval:
+        result["anaconda_heartbeat_interval"] = args.heartbeat_interval
+        if verbose:
+            print("anaconda_heartbeat_interval:", args.heartbeat_interval)
     if args.repo_token is not None:
         token = args.repo_token.strip()
         defchan = list(result.get("default_channels", []))
@@ -0,0 +1,601 @@
+# This module extracts the anaconda_anon_usage and anaconda_ident
+# tokens from the user agents recorded in repository access logs. It
+# works directly on the raw bytes of each line: the user agent is
+# located by its aau/ token, and only that span is decoded and split,
+# so the remaining fields of the line are never turned into strings.
+# Quoted user agents, as in the combined log format or JSON logs, end
+# at the closing quote; otherwise, at the end of the line. Lines that
+# carry no aau/ token are skipped. Compressed logs are decompressed
+# as they are read. Large files can be divided into line-aligned
+# chunks of a memory-mapped file, and many files spread over a pool of
+# processes. Only zstandard-compressed logs need a package outside of
+# the standard library, so logs can be processed on a machine without
+# conda.
+
+import argparse
+import bz2
+import csv
+import gzip
+import io
+import json
+import lzma
+import mmap
+import multiprocessing
+import os
+import queue
+import sys
+import threading
+from array import array
+from collections import deque, namedtuple
+from functools import lru_cache
+from itertools import islice
+from multiprocessing import connection
+
+FIELDS = ("aau", "aid", "c", "s", "e", "u", "h", "n", "o", "m", "U", "H", "N")
+# These tokens may appear more than once in a single user agent
+LIST_FIELDS = ("o", "m")
+
+TokenRecord = namedtuple("TokenRecord", FIELDS)
+TokenRecord.__doc__ = """
+The token values from a single user agent. Absent tokens are None,
+and the repeatable tokens are tuples.
+"""
+
+_INDEX = {k: n for n, k in enumerate(FIELDS)}
+_LISTS = frozenset(_INDEX[k] for k in LIST_FIELDS)
+_MARKER = b"aau/"
+_BOUNDARY = b" \t\"'"
+
+
+def _user_agent_span(line):
+    # Returns the portion of the user agent starting at the aau/
+    # token, as bytes, or None if the line carries none
+    pos = line.find(_MARKER)
+    while pos > 0 and line[pos - 1] not in _BOUNDARY:
+        pos = line.find(_MARKER, pos + 1)
+    if pos < 0:
+        return None
+    end = line.find(b'"', pos)
+    if end < 0:
+        end = len(line)
+    quote = line.find(b"'", pos, end)
+    if quote >= 0:
+        end = quote
+    return line[pos:end].rstrip()
+
+
+def parse_tokens(span):
+    """
+    Builds a TokenRecord from a user agent, or the portion of one,
+    as a string. Unrecognized tokens are ignored.
+    """
+    values = [None] * len(FIELDS)
+    for token in span.split():
+        key, _, value = token.partition("/")
+        ndx = _INDEX.get(key)
+        if ndx is None or not value:
+            continue
+        if ndx in _LISTS:
+            values[ndx] = (values[ndx] or ()) + (value,)
+        elif values[ndx] is None:
+            values[ndx] = value
+    return TokenRecord._make(values)
+
+
+def parse_line(line):
+    """
+    Returns the TokenRecord for a single log line, as bytes, or None
+    if the line does not carry anaconda_anon_usage tokens.
+    """
+    span = _user_agent_span(line)
+    if span is None:
+        return None
+    return parse_tokens(span.decode("utf-8", "replace"))
+
+
+# Every request made by a single conda command carries the same user
+# agent, so consecutive lines repeat them heavily. parse_lines keeps
+# the records for up to this many distinct user agents, keyed by
+# their raw bytes, so that each is tokenized only once.
+MEMO_SIZE = 65536
+
+
+def parse_lines(lines):
+    """
+    Yields the TokenRecord for each line of an iterable of log lines,
+    as bytes, skipping lines without anaconda_anon_usage tokens. This
+    is a generator, so a log of any size is processed in constant
+    memory when streamed from a file. Records are immutable, and
+    lines with the same user agent yield the same record object.
+    """
+    memo = {}
+    span_of = _user_agent_span
+    for line in lines:
+        span = span_of(line)
+        if span is None:
+            continue
+        record = memo.get(span)
+        if record is None:
+            if len(memo) >= MEMO_SIZE:
+                memo.clear()
+            record = parse_tokens(span.decode("utf-8", "replace"))
+            memo[span] = record
+        yield record
+
+
+# Larger than the default buffer, since access logs are read sequentially
+BUFFER_SIZE = 1 << 20
+# Files larger than this are split into chunks of about this size,
+# aligned to line boundaries, when parsed with more than one process
+CHUNK_SIZE = 16 << 20
+
+
+def _open_zstd(path, mode="rb"):
+    try:
+        from compression import zstd
+    except ImportError:
+        zstd = None
+    if zstd is not None:
+        return zstd.ZstdFile(path, mode)
+    try:
+        import zstandard
+    except ImportError:
+        raise ImportError("Reading zstd-compressed logs requires zstandard")
+    # Standard input is left open, as the other decompressors do
+    closefd = isinstance(path, str)
+    if closefd:
+        path = open(path, "rb")
+    return zstandard.ZstdDecompressor().stream_reader(
+        path, read_across_frames=True, closefd=closefd
+    )
+
+
+# Compressed logs are recognized by their contents, so that rotated
+# files need not follow any naming convention
+_MAGIC = (
+    (b"\x1f\x8b", gzip.open),
+    (b"BZh", bz2.open),
+    (b"\xfd7zXZ\x00", lzma.open),
+    (b"\x28\xb5\x2f\xfd", _open_zstd),
+)
+
+
+def _decompressor(head):
+    for magic, opener in _MAGIC:
+        if head.startswith(magic):
+            return opener
+    return None
+
+
+def is_compressed(path):
+    """
+    Returns True if the given log file is compressed.
+    """
+    with open(path, "rb") as fp:
+        return _decompressor(fp.read(8)) is not None
+
+
+def open_log(path):
+    """
+    Opens a log file for reading as bytes; "-" is standard input. Files
+    compressed with gzip, bzip2, xz, or zstd are decompressed as they
+    are read; zstd requires Python 3.14 or the zstandard package.
+    """
+    if path == "-":
+        fp = sys.stdin.buffer
+        opener = _decompressor(fp.peek(8)[:8])
+        if opener is None:
+            return fp
+    else:
+        fp = open(path, "rb", buffering=BUFFER_SIZE)
+        opener = _decompressor(fp.peek(8)[:8])
+        if opener is None:
+            return fp
+        fp.close()
+        fp = path
+    # The decompressors read lines much faster with a larger buffer
+    return io.BufferedReader(opener(fp, "rb"), BUFFER_SIZE)
+
+
+def chunk_ranges(path, chunk_size=None):
+    """
+    Returns a list of (start, end) byte offsets that divide the given
+    file into chunks of at least chunk_size bytes, CHUNK_SIZE if not
+    given, each ending just after a newline or at the end of the file.
+    """
+    chunk_size = chunk_size or CHUNK_SIZE
+    size = os.path.getsize(path)
+    if not size:
+        return []
+    ranges, start = [], 0
+    with open(path, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            while start < size:
+                end = mm.find(b"\n", min(start + chunk_size, size) - 1) + 1
+                end = end or size
+                ranges.append((start, end))
+                start = end
+    return ranges
+
+
+def _serial(path, format=None, fields=FIELDS):
+    fp = open_log(path)
+    try:
+        items = parse_lines(fp)
+        if format is not None:
+            items = map(formatter(format, fields), items)
+        yield from items
+    finally:
+        if fp is not sys.stdin.buffer:
+            fp.close()
+
+
+# The number of records a worker sends to the parent at a time, when
+# streaming a file too large or compressed to be divided into chunks
+BATCH_SIZE = 32768
+
+
+def _encode(items):
+    # Repeated records and lines are the same objects, so sending each
+    # distinct one once, with an array of indices into them, is much
+    # cheaper than pickling the full list
+    index, distinct, codes = {}, [], array("I")
+    for item in items:
+        code = index.get(id(item))
+        if code is None:
+            code = index[id(item)] = len(distinct)
+            distinct.append(item)
+        codes.append(code)
+    if distinct and isinstance(distinct[0], TokenRecord):
+        # Named tuples pickle much more slowly than plain ones
+        distinct = list(map(tuple, distinct))
+    return distinct, codes
+
+
+def _task_lines(path, start, end):
+    # The lines of a task. A chunk is copied out of the mapped file in
+    # one piece; any other file is streamed, and decompressed if
+    # necessary, so the memory used by a worker is bounded either way.
+    if start is None:
+        with open_log(path) as fp:
+            yield from fp
+        return
+    with open(path, "rb") as fp:
+        with mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            lines = mm[start:end].split(b"\n")
+    yield from lines
+
+
+def _parse_task(task):
+    # Runs in a worker process, yielding the encoded results in
+    # batches. The results are formatted here when possible, to
+    # minimize the work left to the parent.
+    path, start, end, format, fields = task
+    items = parse_lines(_task_lines(path, start, end))
+    if format is not None:
+        items = map(formatter(format, fields), items)
+    while True:
+        batch = _encode(islice(items, BATCH_SIZE))
+        if not batch[1]:
+            break
+        yield batch
+
+
+def _receive(conn, tasks):
+    for task in iter(conn.recv, None):
+        tasks.put(task)
+    tasks.put(None)
+
+
+def _worker(func, conn):
+    # Runs each task received over the connection, sending back the
+    # results it yields followed by None; or the exception it raised.
+    # The tasks are received in a separate thread, so that the parent
+    # is never blocked sending one while this is sending results.
+    tasks = queue.SimpleQueue()
+    threading.Thread(target=_receive, args=(conn, tasks), daemon=True).start()
+    for task in iter(tasks.get, None):
+        try:
+            for result in func(task):
+                conn.send(result)
+        except Exception as exc:
+            conn.send(exc)
+        conn.send(None)
+
+
+def _pool_stream(func, tasks, jobs, ordered=True):
+    # Runs the generator function func over the tasks in a pool of
+    # worker processes, yielding the results as they are streamed back.
+    # Each worker has at most two tasks assigned at a time, and blocks
+    # when its pipe to the parent is full, so memory stays bounded
+    # however large the task or slow the consumer. With ordered=True,
+    # task n goes to worker n % jobs, and the results of each task are
+    # read in turn; otherwise, from whichever worker is ready first,
+    # and each is assigned a new task as it finishes one.
+    tasks = iter(tasks)
+    workers = []
+    try:
+        for _ in range(jobs):
+            conn, child = multiprocessing.Pipe()
+            proc = multiprocessing.Process(
+                target=_worker, args=(func, child), daemon=True
+            )
+            proc.start()
+            child.close()
+            workers.append((proc, conn))
+        conns = [conn for _, conn in workers]
+        # The connections of the assigned tasks, oldest first
+        assigned = deque()
+        for conn in conns * 2:
+            task = next(tasks, None)
+            if task is None:
+                break
+            conn.send(task)
+            assigned.append(conn)
+        while assigned:
+            if ordered:
+                conn = assigned[0]
+            else:
+                conn = connection.wait(set(assigned))[0]
+            result = conn.recv()
+            if isinstance(result, Exception):
+                raise result
+            if result is not None:
+                yield result
+                continue
+            assigned.remove(conn)
+            task = next(tasks, None)
+            if task is not None:
+                conn.send(task)
+                assigned.append(conn)
+    finally:
+        for proc, conn in workers:
+            try:
+                conn.send(None)
+            except OSError:
+                pass
+            conn.close()
+        for proc, _ in workers:
+            proc.join(1)
+            if proc.is_alive():
+                proc.terminate()
+
+
+def _tasks(paths, format, fields, chunk_size):
+    # Large uncompressed files are divided into chunks; any other file
+    # is a single task, so that compressed logs are decompressed in
+    # parallel with one another
+    chunk_size = chunk_size or CHUNK_SIZE
+    for path in paths:
+        if is_compressed(path) or os.path.getsize(path) <= chunk_size:
+            yield path, None, None, format, fields
+            continue
+        for start, end in chunk_ranges(path, chunk_size):
+            yield path, start, end, format, fields
+
+
+def _parallel(paths, jobs, ordered, format, fields, chunk_size):
+    tasks = _tasks(paths, format, fields, chunk_size)
+    for distinct, codes in _pool_stream(_parse_task, tasks, jobs, ordered):
+        if format is None:
+            distinct = list(map(TokenRecord._make, distinct))
+        yield from map(distinct.__getitem__, codes)
+
+
+def _scan(paths, jobs=1, ordered=True, format=None, fields=FIELDS, chunk_size=None):
+    # Yields records, or formatted lines, from the given files. Regular
+    # files are divided among the worker processes; standard input is
+    # always read in this one, in its place among the others.
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    group = []
+    for path in list(paths) + [None]:
+        if jobs > 1 and path not in ("-", None):
+            group.append(path)
+            continue
+        if group:
+            yield from _parallel(group, jobs, ordered, format, fields, chunk_size)
+            group = []
+        if path is not None:
+            yield from _serial(path, format, fields)
+
+
+def parse_file(path, jobs=1, ordered=True):
+    """
+    Yields the TokenRecord for each line of the given log file, which
+    may be compressed. With jobs greater than one, an uncompressed file
+    is divided into line-aligned chunks that are parsed in that many
+    processes; zero means one for each CPU. With ordered=False, the
+    records from each chunk are yielded as soon as it is done, which
+    keeps all processes busy when the consumer is slow, at the cost of
+    the original order.
+    """
+    return _scan([path], jobs, ordered)
+
+
+def parse_files(paths, jobs=1, ordered=True):
+    """
+    Like parse_file, but for a sequence of log files. With jobs greater
+    than one, compressed files are each decompressed and parsed in one
+    of the processes, in parallel with the others.
+    """
+    return _scan(paths, jobs, ordered)
+
+
+def record_dict(record, fields=FIELDS):
+    """
+    Returns the present values of a TokenRecord as a dictionary,
+    with the repeatable tokens as lists; suitable for JSON.
+    """
+    result = {}
+    for key in fields:
+        value = getattr(record, key)
+        if value is not None:
+            result[key] = list(value) if key in LIST_FIELDS else value
+    return result
+
+
+def _memoized(func):
+    # Consecutive records repeat as often as the user agents they came
+    # from, so each distinct record is formatted only once
+    memo = {}
+
+    def wrapper(record):
+        result = memo.get(record)
+        if result is None:
+            if len(memo) >= MEMO_SIZE:
+                memo.clear()
+            result = memo[record] = func(record)
+        return result
+
+    return wrapper
+
+
+def _format_ndjson(fields):
+    def format(record):
+        return json.dumps(record_dict(record, fields), separators=(",", ":")) + "\n"
+
+    return format
+
+
+def _format_csv(fields):
+    # The repeatable tokens are joined with spaces, as in the header
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+
+    def format(record):
+        values = (getattr(record, key) for key in fields)
+        writer.writerow(
+            [
+                " ".join(value or ()) if key in LIST_FIELDS else value or ""
+                for key, value in zip(fields, values)
+            ]
+        )
+        result = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return result
+
+    return format
+
+
+FORMATS = {"ndjson": _format_ndjson, "csv": _format_csv}
+
+
+@lru_cache(maxsize=None)
+def formatter(format, fields=FIELDS):
+    """
+    Returns a function that formats a TokenRecord as a line of output
+    in the given format, limited to the given fields.
+    """
+    return _memoized(FORMATS[format](fields))
+
+
+def header(format, fields=FIELDS):
+    """
+    Returns the header line for the given format, if any.
+    """
+    return ",".join(fields) + "\n" if format == "csv" else ""
+
+
+def parse_argv(args=None):
+    p = argparse.ArgumentParser(
+        description="Extract anaconda-ident tokens from repository access logs."
+    )
+    p.add_argument(
+        "files",
+        nargs="*",
+        default=["-"],
+        help="Log files to read. Defaults to standard input.",
+    )
+    p.add_argument(
+        "--format",
+        choices=tuple(FORMATS),
+        default="ndjson",
+        help="Output format. Defaults to ndjson.",
+    )
+    p.add_argument(
+        "--fields",
+        default=",".join(FIELDS),
+        help="A comma-separated list of the tokens to output. Defaults to all.",
+    )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used to parse large files; "
+        "0 means one for each CPU. Defaults to 1.",
+    )
+    p.add_argument(
+        "--unordered",
+        action="store_true",
+        help="With --jobs, output each chunk of a file as soon as it is parsed, "
+        "rather than in the original order.",
+    )
+    p.add_argument(
+        "--checkpoint",
+        help="Read only the lines added since the last run with the same "
+        "checkpoint file, which records the position reached in each log. "
+        "The output file is appended to, rather than replaced.",
+    )
+    p.add_argument(
+        "--follow",
+        "-F",
+        action="store_true",
+        help="Keep reading lines as they are added to the logs, following "
+        "them through rotation, until interrupted.",
+    )
+    p.add_argument(
+        "--output",
+        "-o",
+        default="-",
+        help="The file to write. Defaults to standard output.",
+    )
+    args = p.parse_args(args)
+    args.fields = tuple(f for f in args.fields.split(",") if f)
+    bad = [f for f in args.fields if f not in _INDEX]
+    if bad or not args.fields:
+        p.error(f"Unknown fields: {','.join(bad)}; expected {','.join(FIELDS)}")
+    if args.checkpoint or args.follow:
+        if args.jobs != 1:
+            p.error("--checkpoint and --follow do not support --jobs")
+        if "-" in args.files:
+            p.error("--checkpoint and --follow require log files")
+    return args
+
+
+def _write(args, fp):
+    if args.checkpoint or args.follow:
+        from .logtail import Checkpoint, ingest
+
+        with Checkpoint(args.checkpoint) as checkpoint:
+            ingest(args.files, checkpoint, fp, args.format, args.fields, args.follow)
+        return
+    fp.write(header(args.format, args.fields))
+    fp.writelines(
+        _scan(args.files, args.jobs, not args.unordered, args.format, args.fields)
+    )
+
+
+def main(args=None):
+    args = parse_argv(args)
+    if args.output == "-":
+        fp = sys.stdout
+    else:
+        mode = "a" if args.checkpoint else "w"
+        fp = open(args.output, mode, newline="", buffering=BUFFER_SIZE)
+    try:
+        _write(args, fp)
+        fp.flush()
+    except BrokenPipeError:
+        # The reader, such as head, has seen enough; keep the
+        # interpreter from complaining as it flushes on exit
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+if __name__ == "__main__":
+    main()
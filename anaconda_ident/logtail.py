@@ -0,0 +1,333 @@
+# This module reads access logs incrementally, for continuous
+# ingestion by anaconda-ident-logs. A checkpoint file records, for
+# each log, its device and inode, the offset just past the last line
+# that was read, and the length and hash of that line. The next run
+# resumes at that offset, so only the bytes added since are read.
+#
+# When the inode of a log changes, it has been rotated. When its line
+# is no longer found just before the offset, it was truncated in place,
+# as by copytruncate. Either way, the rest of the previous file is read
+# first, and then the new one from the start. The previous file is
+# found among the log's siblings, such as access.log.1: by its inode if
+# it was renamed; otherwise, by the recorded line, which also finds a
+# copy or a compressed version of it. A trailing line without a newline
+# is left for the next run, unless its file has been rotated away.
+# Compressed logs are assumed to be complete, and are positioned by
+# their decompressed offset.
+#
+# The caller advances the checkpoint by saving it once the lines read
+# so far have been processed. anaconda-ident-logs also records the
+# size of its output file, and truncates any output beyond it when it
+# resumes, so each record is written exactly once across restarts.
+
+import json
+import os
+import stat
+import sys
+import time
+from hashlib import blake2b
+from os.path import abspath, basename, dirname, join
+
+from anaconda_anon_usage.utils import _debug
+
+from .cache import acquire_lock, release_lock
+from .logparse import (
+    BUFFER_SIZE,
+    FIELDS,
+    formatter,
+    header,
+    is_compressed,
+    open_log,
+    parse_lines,
+)
+
+CHECKPOINT_VERSION = 1
+# How long follow mode waits between checks for new lines
+POLL_INTERVAL = 1.0
+# ingest saves the checkpoint after writing this many records, as well
+# as after each pass over the logs
+COMMIT_RECORDS = 65536
+
+
+def _digest(line):
+    return blake2b(line, digest_size=16).hexdigest()
+
+
+class Position:
+    """
+    The position reached in a single log file.
+    """
+
+    __slots__ = ("dev", "ino", "size", "offset", "length", "hash", "last")
+
+    def __init__(self, dev, ino, size=0, offset=0, length=0, hash=""):
+        self.dev, self.ino, self.size = dev, ino, size
+        self.offset, self.length, self.hash = offset, length, hash
+        # The last line read, whose digest is computed only when saved
+        self.last = None
+
+    def to_dict(self):
+        if self.last is not None:
+            self.length, self.hash = len(self.last), _digest(self.last)
+            self.last = None
+        return {k: getattr(self, k) for k in self.__slots__[:-1]}
+
+
+class Checkpoint:
+    """
+    The positions reached in a set of log files, and optionally the size
+    of the output they were written to, saved to the given path. While
+    open, the checkpoint is locked against use by another process.
+    """
+
+    def __init__(self, path=None):
+        # Without a path, the checkpoint is kept only in memory
+        self.path = path and abspath(path)
+        self.files = {}
+        self.output_size = None
+        self.locked = False
+        if self.path is None:
+            return
+        try:
+            with open(self.path) as fp:
+                data = json.load(fp)
+        except FileNotFoundError:
+            return
+        if data.get("version") != CHECKPOINT_VERSION:
+            raise ValueError(f"Unsupported checkpoint version: {self.path}")
+        self.output_size = data.get("output_size")
+        for key, value in data["files"].items():
+            self.files[key] = Position(**value)
+
+    def _lock_path(self):
+        return self.path + ".lock"
+
+    def __enter__(self):
+        if self.path is None:
+            return self
+        os.makedirs(dirname(self.path), exist_ok=True)
+        if not acquire_lock(self._lock_path()):
+            raise RuntimeError(f"Checkpoint in use by another process: {self.path}")
+        self.locked = True
+        return self
+
+    def __exit__(self, *args):
+        if self.locked:
+            release_lock(self._lock_path())
+            self.locked = False
+
+    def touch(self):
+        """
+        Refreshes the lock, which is otherwise considered stale after
+        cache.STALE_LOCK seconds.
+        """
+        if self.locked:
+            os.utime(self._lock_path())
+
+    def save(self):
+        """
+        Saves the checkpoint durably: the data is synced to disk before
+        it atomically replaces the previous checkpoint.
+        """
+        if self.path is None:
+            return
+        data = {
+            "version": CHECKPOINT_VERSION,
+            "output_size": self.output_size,
+            "files": {k: v.to_dict() for k, v in self.files.items()},
+        }
+        tpath = self.path + ".tmp"
+        with open(tpath, "w") as fp:
+            json.dump(data, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tpath, self.path)
+        if sys.platform != "win32":
+            # Makes the rename itself durable
+            fd = os.open(dirname(self.path), os.O_RDONLY)
+            try:
+                os.fsync(fd)
+            finally:
+                os.close(fd)
+        self.touch()
+
+
+def _siblings(path):
+    # The other files whose names begin with that of the log, such as
+    # access.log.1 or access.log-20261017.gz, most recently modified first
+    ldir = dirname(path) or "."
+    prefix = basename(path)
+    result = []
+    for fname in os.listdir(ldir):
+        if fname.startswith(prefix) and fname != prefix:
+            fpath = join(ldir, fname)
+            try:
+                result.append((os.stat(fpath), fpath))
+            except OSError:
+                pass
+    result.sort(key=lambda x: -x[0].st_mtime)
+    return result
+
+
+def _seek(fp, offset, compressed):
+    # Positions the file at the given offset, returning False if it
+    # ends first. A decompressing reader cannot seek, so it reads past
+    # the bytes instead.
+    if not compressed:
+        if os.fstat(fp.fileno()).st_size < offset:
+            return False
+        fp.seek(offset)
+        return True
+    while offset > 0:
+        block = fp.read(min(offset, BUFFER_SIZE))
+        if not block:
+            return False
+        offset -= len(block)
+    return True
+
+
+def _continues(path, pos):
+    # Returns True if the line recorded in the position is still found
+    # just before its offset in the given file
+    last = pos.last
+    length = len(last) if last is not None else pos.length
+    if pos.offset < length:
+        return False
+    with open_log(path) as fp:
+        if not _seek(fp, pos.offset - length, is_compressed(path)):
+            return False
+        line = fp.read(length)
+    if last is not None:
+        return line == last
+    return _digest(line) == pos.hash
+
+
+def _find_previous(path, pos):
+    # Returns the file that now holds the lines that followed the
+    # position, if it can be found
+    siblings = _siblings(path)
+    for st, fpath in siblings:
+        if (st.st_dev, st.st_ino) == (pos.dev, pos.ino):
+            return fpath
+    for st, fpath in siblings:
+        if pos.offset and _continues(fpath, pos):
+            return fpath
+    return None
+
+
+def _read(path, pos, final):
+    compressed = is_compressed(path)
+    final = final or compressed
+    with open_log(path) as fp:
+        if not _seek(fp, pos.offset, compressed):
+            return
+        for line in fp:
+            if not final and line[-1:] != b"\n":
+                # Incomplete; it is read again once it is finished
+                break
+            pos.offset += len(line)
+            pos.last = line
+            yield line
+
+
+def new_lines(path, checkpoint):
+    """
+    Yields each complete line added to the given log file since the
+    position recorded in the checkpoint, advancing that position as
+    each line is yielded. If the log has been rotated or truncated
+    since, the rest of the previous file is yielded first, if it can
+    be found. A missing file yields nothing, as it may be in the
+    middle of a rotation.
+    """
+    key = abspath(path)
+    pos = checkpoint.files.get(key)
+    try:
+        st = os.stat(path)
+    except FileNotFoundError:
+        return
+    if pos is not None:
+        if (pos.dev, pos.ino) != (st.st_dev, st.st_ino):
+            _debug("Log rotated: %s", path)
+        elif pos.size == st.st_size and is_compressed(path):
+            # A compressed log does not change once it is written
+            return
+        elif not pos.offset or _continues(path, pos):
+            yield from _read(path, pos, False)
+            pos.size = st.st_size
+            return
+        else:
+            _debug("Log truncated: %s", path)
+        previous = _find_previous(path, pos)
+        if previous is not None:
+            _debug("Reading the rest of %s", previous)
+            yield from _read(previous, pos, True)
+    pos = checkpoint.files[key] = Position(st.st_dev, st.st_ino)
+    yield from _read(path, pos, False)
+    pos.size = st.st_size
+
+
+def _commit(fp, checkpoint):
+    # The output is synced before the checkpoint that covers it is saved
+    fp.flush()
+    if checkpoint.output_size is not None:
+        os.fsync(fp.fileno())
+        checkpoint.output_size = os.fstat(fp.fileno()).st_size
+    checkpoint.save()
+
+
+def _output_size(fp):
+    # Returns the size of the output if it is a regular file, which
+    # can be truncated; not a pipe or a terminal
+    try:
+        st = os.fstat(fp.fileno())
+    except (AttributeError, OSError, ValueError):
+        return None
+    return st.st_size if stat.S_ISREG(st.st_mode) else None
+
+
+def _state(checkpoint):
+    return [(k, p.ino, p.offset) for k, p in checkpoint.files.items()]
+
+
+def ingest(paths, checkpoint, fp, format="ndjson", fields=FIELDS, follow=False):
+    """
+    Writes the tokens from the lines added to the given log files since
+    the checkpoint to fp, in the given format, saving the checkpoint as
+    it goes. If fp is a regular file, opened for appending, any output
+    beyond that recorded in the checkpoint is removed first, so that
+    each record is written exactly once however a previous run ended.
+    With follow=True, continues to check for new lines every
+    POLL_INTERVAL seconds, like tail -F, until interrupted.
+    """
+    format_record = formatter(format, fields)
+    size = _output_size(fp)
+    if size is not None:
+        if checkpoint.output_size is not None and size > checkpoint.output_size:
+            _debug(
+                "Discarding uncommitted output: %d bytes", size - checkpoint.output_size
+            )
+            fp.truncate(checkpoint.output_size)
+            size = checkpoint.output_size
+        checkpoint.output_size = size
+    if size == 0 or (size is None and not checkpoint.files):
+        fp.write(header(format, fields))
+    try:
+        while True:
+            before = _state(checkpoint)
+            for path in paths:
+                records = parse_lines(new_lines(path, checkpoint))
+                for count, record in enumerate(records, 1):
+                    fp.write(format_record(record))
+                    if count % COMMIT_RECORDS == 0:
+                        _commit(fp, checkpoint)
+            if _state(checkpoint) != before:
+                _commit(fp, checkpoint)
+            else:
+                checkpoint.touch()
+            if not follow:
+                break
+            time.sleep(POLL_INTERVAL)
+    except KeyboardInterrupt:
+        # The checkpoint is not saved, as the position may be past the
+        # last record written; the next run resumes from the last one
+        pass
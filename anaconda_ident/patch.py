@@ -1,14 +1,17 @@
-import base64
 import getpass
+import os
 import platform
 import sys
+from collections import OrderedDict, namedtuple
+from concurrent.futures import Future, wait
 from os import environ
 from os.path import basename
+from queue import SimpleQueue
+from threading import Lock, RLock, Thread
 
 from anaconda_anon_usage import tokens
 from anaconda_anon_usage import utils as aau_utils
 from anaconda_anon_usage.utils import _debug, cached
-from conda.auxlib.decorators import memoizedproperty
 from conda.base.context import (
     Context,
     MapParameter,
@@ -17,11 +20,10 @@ from conda.base.context import (
     context,
     env_name,
 )
-from conda.gateways import anaconda_client as ac
-from conda.gateways.connection import session as cs
 
-from . import __version__
-from .tokens import hash_string, include_baked_tokens
+from . import __version__, daemon
+from .cache import cache_key, load_identity, load_suffix, save_identity, save_suffix
+from .tokens import decode_pepper, hash_string, read_binstar_tokens
 
 # Provide ANACONDA_IDENT_DEBUG and ANACONDA_IDENT_DEBUG_PREFIX
 # as synonyms to their a-a-u equivalents. *_DEBUG enables debug
@@ -85,72 +87,304 @@ def get_hostname(hash=False, pepper=None):
     return value
 
 
-def client_token_type():
-    token_type = context.anaconda_ident
+# A compiled form of the anaconda_ident config string, built once for
+# each distinct string. The token codes are split into those that are
+# fixed for the life of the process and those that depend upon the
+# environment prefix, so that the header for an additional prefix
+# requires only the latter to be computed.
+TokenPlan = namedtuple(
+    "TokenPlan",
+    ("config", "fmt", "org", "pepper", "static", "per_prefix", "cache_key"),
+)
+PREFIX_CODES = "enN"
+IDENTITY_CODES = "uhnUHN"
+
+
+@cached
+def token_plan(config):
     if DEBUG:
-        token_disp = token_type
+        token_disp = config
         if token_disp.count(":") > 1:
             token_disp = token_disp.rsplit(":", 1)[0] + ":<pepper>"
         _debug("Token config from context: %s", token_disp)
+    token_type = config
     org = pepper = None
     if ":" in token_type:
         token_type, org = token_type.split(":", 1)
         if ":" in org:
             org, pepper = org.split(":", 1)
-            try:
-                npad = len(pepper) % 3
-                npad = 3 - npad if npad else 0
-                pepper = base64.b64decode(pepper + "=" * npad)
-            except Exception:
-                pass
+            pepper = decode_pepper(pepper)
     fmt = _client_token_formats.get(token_type, token_type)
     _debug("Preliminary usage tokens: %s", fmt)
-    fmt = "csea" + "".join(dict.fromkeys(c for c in fmt if c in "uhnUHN")) + "om"
+    fmt = "csea" + "".join(dict.fromkeys(c for c in fmt if c in IDENTITY_CODES)) + "om"
     _debug("Final token config: %s %s", fmt, org)
-    return fmt, org, pepper
+    return TokenPlan(
+        config,
+        fmt,
+        org,
+        pepper,
+        "".join(c for c in fmt if c not in PREFIX_CODES),
+        "".join(c for c in fmt if c in PREFIX_CODES),
+        cache_key(config, __version__),
+    )
 
 
-@cached
-def client_token_string():
-    _debug("Entering client_token_string")
-    parts = ["aau/" + tokens.version_token(), "aid/" + __version__]
-    fmt, org, pepper = client_token_type()
-    pfx = get_environment_prefix()
-    _debug("Environmment: %s", pfx)
-    for code in fmt:
-        value = None
-        if code == "c":
-            value = tokens.client_token()
-        elif code == "s":
-            value = tokens.session_token()
-        elif code == "e":
-            value = tokens.environment_token(pfx)
-        elif code == "a":
-            value = tokens.anaconda_auth_token()
-        elif code in "uU":
-            value = get_username(hash=code == "U", pepper=pepper)
-        elif code in "hH":
-            value = get_hostname(hash=code == "H", pepper=pepper)
-        elif code in "nN":
-            value = get_environment_name(pfx, hash=code == "N", pepper=pepper)
-        elif code == "o":
-            value = tokens.organization_tokens()
-            if org and org not in value:
-                value.append(org)
-        elif code == "m":
-            value = tokens.machine_tokens()
-        else:
-            _debug("Unexpected client token code: %s", code)
-            value = None
+def client_token_type():
+    plan = token_plan(context.anaconda_ident)
+    return plan.fmt, plan.org, plan.pepper
+
+
+def _organization_tokens(plan):
+    value = list(tokens.organization_tokens())
+    if plan.org and plan.org not in value:
+        value.append(plan.org)
+    return value
+
+
+_token_resolvers = {
+    "c": lambda plan, pfx: tokens.client_token(),
+    "s": lambda plan, pfx: tokens.session_token(),
+    "e": lambda plan, pfx: tokens.environment_token(pfx),
+    "a": lambda plan, pfx: tokens.anaconda_auth_token(),
+    "u": lambda plan, pfx: get_username(pepper=plan.pepper),
+    "U": lambda plan, pfx: get_username(hash=True, pepper=plan.pepper),
+    "h": lambda plan, pfx: get_hostname(pepper=plan.pepper),
+    "H": lambda plan, pfx: get_hostname(hash=True, pepper=plan.pepper),
+    "n": lambda plan, pfx: get_environment_name(pfx, pepper=plan.pepper),
+    "N": lambda plan, pfx: get_environment_name(pfx, hash=True, pepper=plan.pepper),
+    "o": lambda plan, pfx: _organization_tokens(plan),
+    "m": lambda plan, pfx: tokens.machine_tokens(),
+}
+
+
+# Resolving these may block on directory services or slow file systems,
+# so they are looked up in parallel, and any that miss the deadline are
+# filled from the last known good values in the identity cache, or
+# dropped. ANACONDA_IDENT_TOKEN_TIMEOUT_MS sets the deadline; a value
+# of 0 waits for every lookup instead.
+CONCURRENT_CODES = "uhUHom"
+TOKEN_TIMEOUT = 0.2
+try:
+    TOKEN_TIMEOUT = float(environ["ANACONDA_IDENT_TOKEN_TIMEOUT_MS"]) / 1000
+except (KeyError, ValueError):
+    pass
+
+# The lookups run on a few daemon threads shared by every call, so a
+# stuck lookup cannot delay process exit. None of these tokens depend
+# upon the prefix, so there is at most one lookup of each token for
+# each plan; one that misses the deadline keeps running, and its
+# result is used by the next call that needs it.
+LOOKUP_THREADS = len(CONCURRENT_CODES)
+_lookups = {}
+_lookup_queue = SimpleQueue()
+_lookup_threads = []
+_lookup_lock = Lock()
+
+
+def _lookup_worker():
+    while True:
+        future, code, plan, pfx = _lookup_queue.get()
+        if future.set_running_or_notify_cancel():
+            try:
+                future.set_result(_token_resolvers[code](plan, pfx))
+            except Exception as exc:
+                future.set_exception(exc)
+
+
+def _lookup(plan, code, pfx):
+    # Returns the future of the lookup of a token, starting one if
+    # there is none for this plan already
+    with _lookup_lock:
+        future = _lookups.get((plan, code))
+        if future is None:
+            future = _lookups[(plan, code)] = Future()
+            _lookup_queue.put((future, code, plan, pfx))
+            if len(_lookup_threads) < LOOKUP_THREADS:
+                thread = Thread(target=_lookup_worker, daemon=True)
+                thread.start()
+                _lookup_threads.append(thread)
+        return future
+
+
+def _lookup_cache_clear():
+    # Forgets the completed lookups; those in flight are kept, so that
+    # a stuck lookup is never started twice
+    with _lookup_lock:
+        for key, future in list(_lookups.items()):
+            if future.done():
+                del _lookups[key]
+
+
+def _resolve_concurrently(plan, codes, pfx):
+    futures = {c: _lookup(plan, c, pfx) for c in codes}
+    wait(futures.values(), timeout=TOKEN_TIMEOUT)
+    results = {}
+    for code, future in futures.items():
+        if not future.done():
+            continue
+        try:
+            results[code] = future.result()
+        except Exception as exc:
+            _debug("Unexpected error resolving %s token: %s", code, exc)
+            results[code] = None
+            # Retry the lookup the next time it is needed
+            with _lookup_lock:
+                if _lookups.get((plan, code)) is future:
+                    del _lookups[(plan, code)]
+    return results, [c for c in codes if c not in results]
+
+
+def _resolve_tokens(plan, codes, pfx, saved):
+    values = {c: saved[c] for c in codes if c in saved}
+    late = []
+    if TOKEN_TIMEOUT > 0:
+        slow = [c for c in codes if c in CONCURRENT_CODES and c not in values]
+        if slow:
+            found, late = _resolve_concurrently(plan, slow, pfx)
+            values.update(found)
+    if late:
+        _debug(
+            "Tokens missed the %dms deadline: %s", TOKEN_TIMEOUT * 1000, "".join(late)
+        )
+        stale = load_identity(pfx, identity_key(plan), expired=True)
+        values.update((c, stale[c]) for c in late if c in stale)
+    for code in codes:
+        if code not in values and code not in late:
+            values[code] = _token_resolvers[code](plan, pfx)
+    return values, late
+
+
+def _format_tokens(codes, values):
+    parts = []
+    for code in codes:
+        value = values.get(code)
         if value:
             if not isinstance(value, list):
                 value = (value,)
             parts.extend(code + "/" + v for v in value)
-    result = " ".join(parts)
-    _debug("Full client token: %s", result)
+    return " ".join(parts)
+
+
+def identity_key(plan):
+    # The identity cache lives in the home directory, which may be
+    # shared by many hosts, so its key covers the user and the host
+    # as well as the configuration
+    user = os.getuid() if hasattr(os, "getuid") else environ.get("USERNAME")
+    return cache_key(plan.cache_key, user, platform.node())
+
+
+# These values are fixed for a given user, host, and configuration,
+# so `anaconda-ident --enable` precomputes them into a file in the
+# prefix. The key covers everything they depend upon, so that a file
+# written for a different user or an older configuration is ignored.
+# The organization and machine tokens are read from files that may be
+# deployed or rotated at any time, so they are always read afresh.
+SUFFIX_CODES = "uhUH"
+
+
+def suffix_key(plan):
+    return cache_key(
+        identity_key(plan), tokens.version_token(), daemon.environment_key()
+    )
+
+
+def write_suffix():
+    """
+    Precomputes the fixed token values for the current user and the
+    anaconda_ident configuration, and writes them into the suffix
+    file. Returns True if successful.
+    """
+    add_parameters()
+    context.__init__()
+    plan = token_plan(context.anaconda_ident)
+    codes = "".join(c for c in plan.static if c in SUFFIX_CODES)
+    values, late = _resolve_tokens(plan, codes, sys.prefix, {})
+    if late:
+        return False
+    return save_suffix(suffix_key(plan), values)
+
+
+# The prefix-independent portion of the token string for each plan,
+# with its identity values; cleared with the memoized strings
+_static_tokens = {}
+
+
+def plan_token_string(plan, pfx):
+    """
+    Builds the client token string for the given plan and prefix.
+    The prefix-independent portion is computed once per plan. Also
+    returns False if any token missed the lookup deadline, in which
+    case the result should not be retained.
+    """
+    _debug("Environmment: %s", pfx)
+    cached_static = _static_tokens.get(plan)
+    # The identity values are the only ones we cache on disk; the
+    # anaconda_anon_usage tokens are always obtained from that package.
+    saved = {}
+    ident_key = identity_key(plan)
+    if cached_static is None or plan.per_prefix:
+        saved = load_identity(pfx, ident_key)
+    if cached_static is None:
+        header = "aau/" + tokens.version_token() + " aid/" + __version__
+        # Values precomputed at install time, and then those supplied
+        # by the daemon, take precedence over the identity cache; only
+        # the remainder are resolved here.
+        known = dict(saved, **load_suffix(suffix_key(plan)))
+        if daemon.ENABLED:
+            remote = daemon.request_tokens(plan.config)
+            if remote:
+                known = dict(known, **remote)
+        values, late = _resolve_tokens(plan, plan.static, pfx, known)
+        static = _format_tokens(plan.static, values)
+        static = header + (" " + static if static else "")
+        static_values = {k: v for k, v in values.items() if k in IDENTITY_CODES}
+        if not late:
+            _static_tokens[plan] = (static, static_values)
+    else:
+        static, static_values = cached_static
+        late = []
+    values, p_late = _resolve_tokens(plan, plan.per_prefix, pfx, saved)
+    late.extend(p_late)
+    varying = _format_tokens(plan.per_prefix, values)
+    resolved = {k: v for k, v in values.items() if v and k in IDENTITY_CODES}
+    resolved.update((k, v) for k, v in static_values.items() if v)
+    if resolved != saved and not late:
+        save_identity(pfx, ident_key, resolved)
+    return static + (" " + varying if varying else ""), not late
+
+
+# Processes that embed conda can serve many environments over their
+# lifetime, so the token string is memoized per prefix and config
+# string, up to this many entries.
+TOKEN_CACHE_SIZE = 64
+_token_strings = OrderedDict()
+_token_lock = RLock()
+
+
+def client_token_string(prefix=None):
+    _debug("Entering client_token_string")
+    key = (prefix or get_environment_prefix(), context.anaconda_ident)
+    with _token_lock:
+        result = _token_strings.get(key)
+        if result is not None:
+            _token_strings.move_to_end(key)
+            return result
+        result, complete = plan_token_string(token_plan(key[1]), key[0])
+        _debug("Full client token: %s", result)
+        if complete:
+            _token_strings[key] = result
+            while len(_token_strings) > TOKEN_CACHE_SIZE:
+                _token_strings.popitem(last=False)
     return result
 
 
+def client_token_cache_clear():
+    with _token_lock:
+        _token_strings.clear()
+        _static_tokens.clear()
+    _lookup_cache_clear()
+
+
 def _aid_user_agent(ctx):
     result = ctx._old_user_agent
     tokens = client_token_string()
@@ -159,25 +393,21 @@ def _aid_user_agent(ctx):
     return result
 
 
-def _aid_read_binstar_tokens():
-    tokens = ac._old_read_binstar_tokens()
-    include_baked_tokens(tokens)
-    return tokens
+def _aid_reset_cache(ctx):
+    # Called whenever the context is (re)initialized
+    client_token_cache_clear()
+    return Context._old_reset_cache(ctx)
 
 
-def main(command=None):
-    if getattr(context, "_aid_initialized", None) is not None:
-        _debug("anaconda_ident already active")
-        return False
-    _debug("Applying anaconda_ident context patch")
+def _aid_read_binstar_tokens():
+    from conda.gateways import anaconda_client as ac
 
-    # This helps us determine if the patching is comlpete
-    context._aid_initialized = False
+    return read_binstar_tokens(ac)
 
-    if getattr(context, "_aau_initialized", None) is None:
-        from anaconda_anon_usage import patch
 
-        patch.main(plugin=True)
+def add_parameters():
+    if hasattr(Context, "anaconda_ident"):
+        return
 
     # conda.base.context.Context
     # Adds anaconda_ident as a managed string config parameter
@@ -193,11 +423,172 @@ def main(command=None):
     Context.repo_tokens = _param
     Context.parameter_names += (_param._set_name("repo_tokens"),)
 
+    # conda.base.context.Context
+    # Adds anaconda_heartbeat_interval as a managed numeric parameter
+    _debug("Adding the anaconda_heartbeat_interval config parameter")
+    _param = ParameterLoader(PrimitiveParameter(0, element_type=(int, float)))
+    Context.anaconda_heartbeat_interval = _param
+    Context.parameter_names += (_param._set_name("anaconda_heartbeat_interval"),)
+
+    # conda.base.context.Context
+    # Adds anaconda_heartbeat_background as a managed boolean parameter
+    _debug("Adding the anaconda_heartbeat_background config parameter")
+    _param = ParameterLoader(PrimitiveParameter(False))
+    Context.anaconda_heartbeat_background = _param
+    Context.parameter_names += (_param._set_name("anaconda_heartbeat_background"),)
+
+    # conda.base.context.Context
+    # Adds anaconda_heartbeat_spool as a managed boolean parameter
+    _debug("Adding the anaconda_heartbeat_spool config parameter")
+    _param = ParameterLoader(PrimitiveParameter(False))
+    Context.anaconda_heartbeat_spool = _param
+    Context.parameter_names += (_param._set_name("anaconda_heartbeat_spool"),)
+
+
+def _aid_activate(self):
+    # Skips the anaconda_anon_usage heartbeat entirely if one has
+    # been sent for this environment within the configured interval,
+    # hands it to a background process, or arranges for it to be
+    # spooled if it cannot be sent, as configured.
+    try:
+        hb = context.anaconda_heartbeat
+        interval = context.anaconda_heartbeat_interval
+        background = context.anaconda_heartbeat_background
+        spool = context.anaconda_heartbeat_spool
+        if hb and (interval > 0 or background or spool):
+            from conda.base.context import locate_prefix_by_name
+
+            from .heartbeat import heartbeat_due, patch_ping, queue_heartbeat
+
+            env = self.env_name_or_prefix
+            if env and os.sep not in env:
+                env = locate_prefix_by_name(env)
+            if interval > 0 and not heartbeat_due(env or sys.prefix, interval):
+                return self._old_activate()
+            if background:
+                channel, path = (hb, "") if isinstance(hb, str) else (None, None)
+                queue_heartbeat(env or sys.prefix, channel, path)
+                return self._old_activate()
+            if spool:
+                patch_ping()
+    except Exception as exc:
+        _debug("Failed to schedule heartbeat: %s", exc, error=True)
+    return self._aau_activate()
+
+
+def patch_activate():
+    from conda import activate
+
+    _Activator = getattr(activate, "_Activator", None)
+    if _Activator is not None and not hasattr(_Activator, "_old_activate"):
+        # anaconda_anon_usage applies its activate patch only when it
+        # is first initialized, which may have been for another command
+        from anaconda_anon_usage import patch
+
+        patch._patch_activate()
+    if not hasattr(_Activator, "_old_activate"):
+        _debug("anaconda_anon_usage activate patch not present")
+    elif hasattr(_Activator, "_aau_activate"):
+        _debug("Verified activate patch")
+    else:
+        _debug("Applying anaconda_ident activate patch")
+        _Activator._aau_activate = _Activator.activate
+        _Activator.activate = _aid_activate
+
+
+_pre_defer_user_agent = None
+
+
+def _aid_deferred_user_agent(ctx):
+    undefer()
+    return ctx.user_agent
+
+
+def undefer():
+    """
+    Applies the patch now, if it was deferred by defer() and has not
+    yet been applied. Returns True if so.
+    """
+    if not getattr(context, "_aid_deferred", False):
+        return False
+    # Restoring the previous property first ensures that a failure
+    # in main() cannot lead back here
+    context._aid_deferred = False
+    Context.user_agent = _pre_defer_user_agent
+    main()
+    return True
+
+
+def defer(command=None):
+    """
+    Prepares for the patch without applying it. The configuration
+    parameters are registered immediately, so that commands such as
+    conda config recognize them. The remainder of the patch, and the
+    resolution of the tokens, is postponed until the user agent or
+    the repository tokens are first requested; e.g., when conda builds
+    a CondaSession.
+    """
+    if getattr(context, "_aid_initialized", None) is not None:
+        _debug("anaconda_ident already active")
+        if command == "activate":
+            patch_activate()
+        return False
+    _debug("Deferring anaconda_ident context patch")
+
+    # anaconda_anon_usage installs its own plugin, so this is no
+    # extra work; but it must precede the hook below so that its
+    # user agent patch does not replace ours.
+    if getattr(context, "_aau_initialized", None) is None:
+        from anaconda_anon_usage import patch
+
+        patch.main(plugin=True, command=command)
+
+    global _pre_defer_user_agent
+    add_parameters()
+    if command == "activate":
+        patch_activate()
+    _pre_defer_user_agent = Context.user_agent
+    Context.user_agent = property(_aid_deferred_user_agent)
+    context._aid_deferred = True
+    return True
+
+
+def main(command=None):
+    if getattr(context, "_aid_initialized", None) is not None:
+        _debug("anaconda_ident already active")
+        if command == "activate":
+            patch_activate()
+        return False
+    _debug("Applying anaconda_ident context patch")
+
+    # This helps us determine if the patching is comlpete
+    context._aid_initialized = False
+
+    if getattr(context, "_aau_initialized", None) is None:
+        from anaconda_anon_usage import patch
+
+        patch.main(plugin=True, command=command)
+
+    add_parameters()
+    if command == "activate":
+        patch_activate()
+
     # conda.base.context.Context.user_agent
-    # Adds the ident token to the user agent string
+    # Adds the ident token to the user agent string. This is not
+    # memoized on the context itself because the target prefix can
+    # change without the context being reinitialized.
     _debug("Replacing anaconda_anon_usage user agent in module")
     assert hasattr(Context, "_old_user_agent")
-    Context.user_agent = memoizedproperty(_aid_user_agent)
+    Context.user_agent = property(_aid_user_agent)
+
+    # conda.base.context.Context._reset_cache
+    # Clears the token cache when the context is reinitialized
+    if not hasattr(Context, "_old_reset_cache"):
+        Context._old_reset_cache = Context._reset_cache
+        Context._reset_cache = _aid_reset_cache
+
+    from conda.gateways import anaconda_client as ac
+    from conda.gateways.connection import session as cs
 
     if hasattr(ac, "_old_read_binstar_tokens"):
         _debug("Verified binstar patch")
@@ -5,7 +5,7 @@ def pre_command_patcher(command):
     try:
         from . import patch  # noqa
 
-        patch.main(command)
+        patch.defer(command)
     except Exception as exc:  # pragma: nocover
         print("Error loading anaconda-ident:", exc)
 
@@ -0,0 +1,355 @@
+# This module implements anaconda-ident-report, which summarizes the
+# tokens found in access logs for each organization token (o/): the
+# number of requests, estimates of the number of distinct users,
+# hosts, environments, sessions, and clients, and the most active
+# users and hosts. It also ranks the organizations themselves. The
+# summaries are built from the mergeable sketches in
+# anaconda_ident.sketches, so their memory use does not grow with the
+# size of the logs. They can be saved and merged later without the
+# logs: daily summaries roll up into weekly or monthly ones, and the
+# summaries built by separate worker processes combine into one.
+
+import argparse
+import json
+import os
+import sys
+import zlib
+from collections import Counter, defaultdict
+from itertools import islice
+
+from . import logparse
+from .sketches import PRECISION, TOPK_SIZE, HyperLogLog, TopK
+
+# The tokens that identify each dimension, in order of preference; a
+# user, for instance, is identified by u/ if present, and otherwise U/
+DIMENSIONS = {
+    "users": ("u", "U"),
+    "hosts": ("h", "H"),
+    "environments": ("e", "n", "N"),
+    "sessions": ("s",),
+    "clients": ("c",),
+}
+# The dimensions for which the most active values are tracked
+TOP_DIMENSIONS = ("users", "hosts")
+# The key of the summary of all requests, whatever their organization,
+# and of those without an organization token
+ALL = "*"
+NONE = ""
+
+MAGIC = b"anaconda-ident-report 1\n"
+
+
+class Summary:
+    """
+    The request count and sketches for a single organization.
+    """
+
+    def __init__(self, precision=PRECISION, topk=TOPK_SIZE):
+        self.requests = 0
+        self.distinct = {d: HyperLogLog(precision) for d in DIMENSIONS}
+        self.top = {d: TopK(topk) for d in TOP_DIMENSIONS}
+
+    def merge(self, other):
+        self.requests += other.requests
+        for d, sketch in other.distinct.items():
+            self.distinct[d].merge(sketch)
+        for d, sketch in other.top.items():
+            self.top[d].merge(sketch)
+        return self
+
+    def to_dict(self):
+        return {
+            "requests": self.requests,
+            "distinct": {d: s.to_dict() for d, s in self.distinct.items()},
+            "top": {d: s.to_dict() for d, s in self.top.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls.__new__(cls)
+        result.requests = data["requests"]
+        result.distinct = {
+            d: HyperLogLog.from_dict(s) for d, s in data["distinct"].items()
+        }
+        result.top = {d: TopK.from_dict(s) for d, s in data["top"].items()}
+        return result
+
+
+def _dimension_values(record):
+    # The value of each dimension, with its token, such as u/alice
+    result = []
+    for dim, keys in DIMENSIONS.items():
+        for key in keys:
+            value = getattr(record, key)
+            if value is not None:
+                result.append((dim, key + "/" + value))
+                break
+    return result
+
+
+class Report:
+    """
+    The summaries of a set of access logs for each organization.
+    """
+
+    def __init__(self, precision=PRECISION, topk=TOPK_SIZE):
+        self.precision = precision
+        self.topk = topk
+        self.summaries = {}
+        self.orgs = TopK(topk)
+        self.sources = []
+
+    def _summary(self, org):
+        summary = self.summaries.get(org)
+        if summary is None:
+            summary = self.summaries[org] = Summary(self.precision, self.topk)
+        return summary
+
+    def add_records(self, records):
+        """
+        Adds an iterable of TokenRecords to the report. The records
+        are aggregated before they are added to the sketches, so a
+        large batch of them is much faster than many small ones.
+        """
+        distinct = defaultdict(set)
+        for record, count in Counter(records).items():
+            values = _dimension_values(record)
+            for org in (ALL,) + (record.o or (NONE,)):
+                summary = self._summary(org)
+                summary.requests += count
+                if org not in (ALL, NONE):
+                    self.orgs.add(org, count)
+                for dim, value in values:
+                    distinct[org, dim].add(value)
+                    if dim in summary.top:
+                        summary.top[dim].add(value, count)
+        for (org, dim), values in distinct.items():
+            self.summaries[org].distinct[dim].update(values)
+
+    def merge(self, other):
+        """
+        Adds the summaries in another report to this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge reports of different precisions")
+        for org, summary in other.summaries.items():
+            if org in self.summaries:
+                self.summaries[org].merge(summary)
+            else:
+                self.summaries[org] = summary
+        self.orgs.merge(other.orgs)
+        self.sources.extend(s for s in other.sources if s not in self.sources)
+        return self
+
+    def to_dict(self):
+        return {
+            "precision": self.precision,
+            "topk": self.topk,
+            "sources": self.sources,
+            "orgs": self.orgs.to_dict(),
+            "summaries": {k: v.to_dict() for k, v in self.summaries.items()},
+        }
+
+    @classmethod
+    def from_dict(cls, data):
+        result = cls(data["precision"], data["topk"])
+        result.sources = data["sources"]
+        result.orgs = TopK.from_dict(data["orgs"])
+        result.summaries = {
+            k: Summary.from_dict(v) for k, v in data["summaries"].items()
+        }
+        return result
+
+    def save(self, path):
+        data = json.dumps(self.to_dict(), separators=(",", ":")).encode("utf-8")
+        with open(path, "wb") as fp:
+            fp.write(MAGIC)
+            fp.write(zlib.compress(data))
+
+    @classmethod
+    def load(cls, path):
+        with open(path, "rb") as fp:
+            if fp.read(len(MAGIC)) != MAGIC:
+                raise ValueError(f"Not a saved report: {path}")
+            data = json.loads(zlib.decompress(fp.read()))
+        return cls.from_dict(data)
+
+    def results(self, top=10):
+        """
+        Returns the estimates for each organization, most active first,
+        along with the most active organizations, as a dictionary.
+        """
+        orgs = {}
+        order = sorted(self.summaries.items(), key=lambda x: -x[1].requests)
+        for org, summary in order:
+            entry = {"requests": summary.requests}
+            for dim, sketch in summary.distinct.items():
+                entry[dim] = sketch.count()
+            for dim, sketch in summary.top.items():
+                entry["top_" + dim] = sketch.top(top)
+            orgs[org] = entry
+        return {
+            "sources": self.sources,
+            "organizations": orgs,
+            "top_organizations": self.orgs.top(top),
+        }
+
+
+def is_report(path):
+    """
+    Returns True if the given file is a saved report, not a log.
+    """
+    with open(path, "rb") as fp:
+        return fp.read(len(MAGIC)) == MAGIC
+
+
+def _report_task(task):
+    # Runs in a worker process, summarizing a chunk or file of a log
+    report = Report(*task[-1])
+    for distinct, codes in logparse._parse_task(task[:-1]):
+        distinct = list(map(logparse.TokenRecord._make, distinct))
+        report.add_records(map(distinct.__getitem__, codes))
+    report.sources.append(task[0])
+    yield report
+
+
+def build(paths, jobs=1, precision=PRECISION, topk=TOPK_SIZE):
+    """
+    Builds a report from the given log files. With jobs greater than
+    one, the logs are divided among that many processes as they are by
+    anaconda-ident-logs, and their reports merged; zero means one for
+    each CPU.
+    """
+    report = Report(precision, topk)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    # Standard input is always read in this process
+    serial = [p for p in paths if jobs == 1 or p == "-"]
+    for path in serial:
+        records = logparse.parse_file(path)
+        while True:
+            batch = list(islice(records, logparse.BATCH_SIZE))
+            if not batch:
+                break
+            report.add_records(batch)
+        report.sources.append(path)
+    paths = [p for p in paths if p not in serial]
+    if paths:
+        tasks = (
+            t + ((precision, topk),)
+            for t in logparse._tasks(paths, None, logparse.FIELDS, None)
+        )
+        for part in logparse._pool_stream(_report_task, tasks, jobs, False):
+            report.merge(part)
+    return report
+
+
+def _label(org):
+    return {ALL: "(all)", NONE: "(none)"}.get(org, org)
+
+
+def format_text(results):
+    """
+    Formats the results of a report as a table, followed by the most
+    active organizations, and the most active users and hosts of each.
+    """
+    lines = []
+    orgs = results["organizations"]
+    width = max([len(_label(o)) for o in orgs] + [12])
+    heads = ("requests",) + tuple(DIMENSIONS)
+    lines.append(f"{'organization':{width}}" + "".join(f" {h:>12}" for h in heads))
+    for org, entry in orgs.items():
+        values = "".join(f" {entry[h]:12,d}" for h in heads)
+        lines.append(f"{_label(org):{width}}{values}")
+    if results["top_organizations"]:
+        lines.extend(["", "top organizations"])
+        lines.extend(f"{c:12,d}  {o}" for o, c in results["top_organizations"])
+    for org, entry in orgs.items():
+        for dim in TOP_DIMENSIONS:
+            if entry["top_" + dim]:
+                lines.extend(["", f"top {dim}: {_label(org)}"])
+                lines.extend(f"{c:12,d}  {v}" for v, c in entry["top_" + dim])
+    return "\n".join(lines) + "\n"
+
+
+def parse_argv(args=None):
+    p = argparse.ArgumentParser(
+        description="Summarize the anaconda-ident tokens in access logs, "
+        "or in reports saved from them, for each organization."
+    )
+    p.add_argument(
+        "inputs",
+        nargs="*",
+        default=["-"],
+        help="Log files, or reports saved with --save, to summarize. "
+        "Defaults to a log on standard input.",
+    )
+    p.add_argument(
+        "--save",
+        help="Save the combined report to this file, for later merging.",
+    )
+    p.add_argument(
+        "--top",
+        type=int,
+        default=10,
+        help="The number of users, hosts, and organizations to list. "
+        "Defaults to 10.",
+    )
+    p.add_argument("--json", action="store_true", help="Output the results as JSON.")
+    p.add_argument(
+        "--quiet", action="store_true", help="Output nothing; use with --save."
+    )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used to read the logs; "
+        "0 means one for each CPU. Defaults to 1.",
+    )
+    p.add_argument(
+        "--precision",
+        type=int,
+        default=PRECISION,
+        help="The precision of the distinct counts, from 4 to 18; the "
+        f"standard error is 1.04 / sqrt(2**precision). Defaults to {PRECISION}. "
+        "Reports must have the same precision to be merged.",
+    )
+    return p.parse_args(args)
+
+
+def main(args=None):
+    args = parse_argv(args)
+    saved = [p for p in args.inputs if p != "-" and is_report(p)]
+    logs = [p for p in args.inputs if p not in saved]
+    if logs:
+        report = build(logs, args.jobs, args.precision)
+        first = "the logs"
+    else:
+        first = saved.pop(0)
+        report = Report.load(first)
+    for path in saved:
+        other = Report.load(path)
+        try:
+            report.merge(other)
+        except ValueError:
+            print(
+                f"Error: cannot merge {path}, with precision {other.precision}, "
+                f"and {first}, with precision {report.precision}",
+                file=sys.stderr,
+            )
+            return 1
+    if args.save:
+        report.save(args.save)
+    if args.quiet:
+        return
+    results = report.results(args.top)
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+    else:
+        sys.stdout.write(format_text(results))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,403 @@
+# This module implements anaconda-ident-dehash, which recovers the
+# identities behind the hashed U/, H/, and N/ tokens in access logs.
+# Those tokens are computed by tokens.hash_string from the username,
+# hostname, or environment name and the pepper in the anaconda_ident
+# config, so they cannot be reversed; but given a roster of the
+# candidate values, such as a user directory or a host inventory, each
+# can be hashed with the same pepper to build a table from hash to
+# value. The rosters are hashed in bulk, across a pool of processes if
+# desired, and the table is then joined against the parsed log records
+# as they stream past, filling in the u/, h/, and n/ tokens.
+#
+# When the pepper is changed, clients switch to the new one as their
+# configuration is updated, so the logs contain hashes computed with
+# both for a time. Several peppers may therefore be given, each with
+# the dates on which it was in use, and every value is hashed with
+# each of them; since the hashes never coincide, a single lookup finds
+# the value whichever pepper was used.
+
+import argparse
+import csv
+import io
+import json
+import os
+import sys
+from base64 import urlsafe_b64encode
+from collections import namedtuple
+from datetime import date
+from hashlib import blake2b
+from itertools import chain, islice
+
+from . import logparse
+from .tokens import decode_pepper
+
+# The kinds of values that are hashed, as passed to hash_string, and
+# the tokens that hold their hashed and original values
+KINDS = {
+    "username": ("U", "u"),
+    "hostname": ("H", "h"),
+    "environment": ("N", "n"),
+}
+# The column names, in CSV and NDJSON rosters, for each kind of value
+COLUMNS = {
+    "username": "username",
+    "user": "username",
+    "hostname": "hostname",
+    "host": "hostname",
+    "environment": "environment",
+    "env": "environment",
+}
+# The number of values sent to a worker process at a time
+HASH_BATCH = 16384
+
+# A decoded pepper, and the first and last dates on which it was used;
+# None if unbounded
+Pepper = namedtuple("Pepper", ("value", "start", "end"))
+
+
+def parse_pepper(spec):
+    """
+    Parses a pepper given as PEPPER[:START[:END]]: the pepper as it
+    appears in the anaconda_ident config, optionally followed by the
+    first and last dates on which it was in use, in ISO format. Returns
+    a Pepper with the value decoded.
+    """
+    value, _, window = spec.partition(":")
+    start, _, end = window.partition(":")
+    start = date.fromisoformat(start) if start else None
+    end = date.fromisoformat(end) if end else None
+    if start and end and end < start:
+        raise ValueError(f"Pepper used until before it was used from: {spec}")
+    return Pepper(decode_pepper(value), start, end)
+
+
+def in_use(pepper, when):
+    """
+    Returns True if the Pepper was in use on the given date.
+    """
+    return (pepper.start is None or pepper.start <= when) and (
+        pepper.end is None or when <= pepper.end
+    )
+
+
+def _values(peppers):
+    # A single pepper, or a list of them, as a list of pepper values
+    if not isinstance(peppers, list):
+        peppers = [peppers]
+    return [p.value if isinstance(p, Pepper) else p for p in peppers]
+
+
+def normalize(kind, value):
+    """
+    Returns the value as anaconda-ident hashes it on the client, which
+    drops the .local suffix that macOS adds to hostnames.
+    """
+    value = value.strip()
+    if kind == "hostname" and value.endswith(".local"):
+        value = value.rsplit(".", 1)[0]
+    return value
+
+
+def digest_values(kind, values, pepper=None):
+    """
+    Returns a list of the 16-byte blake2b digests of the given strings,
+    from which tokens.hash_string(kind, value, pepper) computes its
+    hashes, reusing the hash state prepared for the kind and pepper.
+    """
+    if isinstance(pepper, str):
+        pepper = pepper.encode("utf-8")
+    salt = (pepper or b"")[: blake2b.SALT_SIZE]
+    base = blake2b(digest_size=16, person=kind.encode("utf-8"), salt=salt)
+    result = []
+    for value in values:
+        hfunc = base.copy()
+        hfunc.update(value.encode("utf-8"))
+        result.append(hfunc.digest())
+    return result
+
+
+def hash_values(kind, values, pepper=None):
+    """
+    Returns a list of the hashes of the given strings, identical to
+    those computed by tokens.hash_string(kind, value, pepper), but
+    several times faster when there are many of them.
+    """
+    # 16 bytes encode to 22 characters and two of padding
+    return [
+        urlsafe_b64encode(d)[:22].decode("ascii")
+        for d in digest_values(kind, values, pepper)
+    ]
+
+
+def _open_text(path):
+    if path == "-":
+        return io.TextIOWrapper(sys.stdin.buffer, encoding="utf-8", newline="")
+    return open(path, encoding="utf-8", newline="")
+
+
+def read_roster(path, kind=None):
+    """
+    Yields (kind, value) pairs from a roster file; "-" is standard
+    input. If a kind is given, the file is a plain list of values, one
+    per line. Otherwise, it is either NDJSON, with one object per line,
+    or CSV, with a header row; the values are taken from the fields or
+    columns named in COLUMNS, and any others are ignored.
+    """
+    with _open_text(path) as fp:
+        if kind is not None:
+            for line in fp:
+                value = normalize(kind, line)
+                if value:
+                    yield kind, value
+            return
+        first = fp.readline()
+        if first.lstrip().startswith("{"):
+            rows = map(json.loads, filter(str.strip, chain([first], fp)))
+        else:
+            rows = csv.DictReader(chain([first], fp))
+        for row in rows:
+            for column, value in row.items():
+                kind = COLUMNS.get(column and column.strip().lower())
+                if kind is not None and isinstance(value, str):
+                    value = normalize(kind, value)
+                    if value:
+                        yield kind, value
+
+
+def _hash_task(task):
+    # Runs in a worker process, hashing a batch of values
+    kind, pepper, values, raw = task
+    yield (digest_values if raw else hash_values)(kind, values, pepper)
+
+
+def hash_roster(entries, peppers=None, jobs=1, raw=False):
+    """
+    Hashes the distinct (kind, value) pairs given with each of the
+    peppers from the anaconda_ident config, already decoded: a single
+    pepper, or a list of them. The entries are read once, and yield a
+    (kind, number, values, hashes) tuple for each batch of up to
+    HASH_BATCH values and each pepper, identified by its number in the
+    list; the hashes are the raw digests if raw=True. With jobs greater
+    than one, the batches are hashed in that many processes; zero means
+    one for each CPU.
+    """
+    peppers = _values(peppers)
+    distinct = {kind: {} for kind in KINDS}
+    for kind, value in entries:
+        distinct[kind][value] = None
+    batches = []
+    for kind, values in distinct.items():
+        values = iter(values)
+        while True:
+            batch = list(islice(values, HASH_BATCH))
+            if not batch:
+                break
+            batches.extend((kind, pepper, batch, raw) for pepper in peppers)
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    if jobs > 1 and len(batches) > 1:
+        hashes = logparse._pool_stream(_hash_task, batches, jobs)
+    else:
+        hashes = (next(_hash_task(batch)) for batch in batches)
+    for num, ((kind, _, batch, _), result) in enumerate(zip(batches, hashes)):
+        yield kind, num % len(peppers), batch, result
+
+
+def build_table(entries, peppers=None, jobs=1):
+    """
+    Hashes the (kind, value) pairs given, as hash_roster does. Returns
+    a dictionary that maps each hashed token, such as U, to a dictionary
+    from hash to the original value, whichever pepper it was hashed
+    with.
+    """
+    table = {hashed: {} for hashed, _ in KINDS.values()}
+    for kind, _, values, hashes in hash_roster(entries, peppers, jobs):
+        table[KINDS[kind][0]].update(zip(hashes, values))
+    return table
+
+
+def dehash(records, *tables):
+    """
+    Yields each TokenRecord with its u, h, and n tokens filled in from
+    the values whose hashes are its U, H, and N tokens. Each table is
+    searched in turn: one built by build_table, or a HashIndex. Values
+    already present, and hashes not found, are left as they are.
+    """
+    pairs = [(hashed, plain) for hashed, plain in KINDS.values()]
+
+    def join(record):
+        changes = {}
+        for hashed, plain in pairs:
+            token = getattr(record, hashed)
+            if token is not None and getattr(record, plain) is None:
+                for table in tables:
+                    value = table[hashed].get(token)
+                    if value is not None:
+                        changes[plain] = value
+                        break
+        return record._replace(**changes) if changes else record
+
+    return map(logparse._memoized(join), records)
+
+
+def write_table(table, fp):
+    """
+    Writes the table as CSV, with a row for each hashed token, its
+    hash, and the original value.
+    """
+    writer = csv.writer(fp, lineterminator="\n")
+    writer.writerow(("token", "hash", "value"))
+    for token, hashes in table.items():
+        writer.writerows((token, h, v) for h, v in hashes.items())
+
+
+def _pepper_arg(value):
+    try:
+        return parse_pepper(value)
+    except ValueError as exc:
+        raise argparse.ArgumentTypeError(str(exc))
+
+
+def _roster_arg(value):
+    # [KIND=]FILE; a kind must be one of KINDS
+    kind, sep, path = value.partition("=")
+    if sep and kind in KINDS:
+        return kind, path
+    return None, value
+
+
+def parse_argv(args=None):
+    p = argparse.ArgumentParser(
+        description="Recover the usernames, hostnames, and environment names "
+        "behind the hashed tokens in access logs, by hashing rosters of the "
+        "candidate values with the same pepper."
+    )
+    p.add_argument(
+        "files",
+        nargs="*",
+        default=["-"],
+        help="Log files to read. Defaults to standard input.",
+    )
+    p.add_argument(
+        "--roster",
+        "-r",
+        action="append",
+        type=_roster_arg,
+        default=[],
+        help="A roster of candidate values: CSV with a header row, or NDJSON, "
+        "with username, hostname, or environment columns; or, as KIND=FILE, "
+        "a plain list of values of that kind, one per line. Repeatable; "
+        "- is standard input.",
+    )
+    p.add_argument(
+        "--index",
+        "-i",
+        action="append",
+        default=[],
+        help="An index of hashed values, built by anaconda-ident-hash index, "
+        "to search after the rosters. Repeatable.",
+    )
+    p.add_argument(
+        "--pepper",
+        action="append",
+        type=_pepper_arg,
+        default=[],
+        help="The pepper from the anaconda_ident config, as it appears there, "
+        "optionally followed by :START and :END, the first and last dates on "
+        "which it was in use. Repeatable, for logs from before and after the "
+        "pepper was changed; any index must have been built with each.",
+    )
+    p.add_argument(
+        "--date",
+        type=date.fromisoformat,
+        help="The date of the logs, in ISO format. Only the peppers in use "
+        "on that date are used.",
+    )
+    p.add_argument(
+        "--table",
+        action="store_true",
+        help="Write the table of hashes, as CSV, instead of reading logs.",
+    )
+    p.add_argument(
+        "--format",
+        choices=tuple(logparse.FORMATS),
+        default="ndjson",
+        help="Output format. Defaults to ndjson.",
+    )
+    p.add_argument(
+        "--fields",
+        default=",".join(logparse.FIELDS),
+        help="A comma-separated list of the tokens to output. Defaults to all.",
+    )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used to hash the rosters and parse "
+        "the logs; 0 means one for each CPU. Defaults to 1.",
+    )
+    p.add_argument(
+        "--output",
+        "-o",
+        default="-",
+        help="The file to write. Defaults to standard output.",
+    )
+    args = p.parse_args(args)
+    args.fields = tuple(f for f in args.fields.split(",") if f)
+    bad = [f for f in args.fields if f not in logparse.FIELDS]
+    if bad or not args.fields:
+        p.error(
+            f"Unknown fields: {','.join(bad)}; expected {','.join(logparse.FIELDS)}"
+        )
+    if not (args.roster or args.index and not args.table):
+        p.error("At least one --roster, or --index without --table, is required")
+    if args.date is not None:
+        args.pepper = [pp for pp in args.pepper if in_use(pp, args.date)]
+        if not args.pepper:
+            p.error(f"No pepper was in use on {args.date}")
+    stdin = [path for _, path in args.roster if path == "-"]
+    if len(stdin) + ("-" in args.files and not args.table) > 1:
+        p.error("Only one roster or log can be read from standard input")
+    return args
+
+
+def _write(args, fp):
+    from .hashindex import HashIndex
+
+    peppers = [pp.value for pp in args.pepper] or None
+    entries = (e for kind, path in args.roster for e in read_roster(path, kind))
+    tables = [build_table(entries, peppers, args.jobs)] if args.roster else []
+    if args.table:
+        write_table(tables[0], fp)
+        return
+    tables.extend(HashIndex(path, peppers, args.date) for path in args.index)
+    try:
+        format_record = logparse.formatter(args.format, args.fields)
+        fp.write(logparse.header(args.format, args.fields))
+        records = logparse.parse_files(args.files, args.jobs)
+        fp.writelines(map(format_record, dehash(records, *tables)))
+    finally:
+        for table in tables:
+            if isinstance(table, HashIndex):
+                table.close()
+
+
+def main(args=None):
+    args = parse_argv(args)
+    if args.output == "-":
+        fp = sys.stdout
+    else:
+        fp = open(args.output, "w", newline="", buffering=logparse.BUFFER_SIZE)
+    try:
+        _write(args, fp)
+        fp.flush()
+    except BrokenPipeError:
+        os.dup2(os.open(os.devnull, os.O_WRONLY), sys.stdout.fileno())
+    finally:
+        if fp is not sys.stdout:
+            fp.close()
+
+
+if __name__ == "__main__":
+    main()
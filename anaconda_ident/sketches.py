@@ -0,0 +1,197 @@
+# This module implements the mergeable summaries used by
+# anaconda-ident-report to count the users, hosts, and other tokens in
+# access logs in bounded memory. HyperLogLog estimates the number of
+# distinct values, and TopK, a space-saving summary, the most frequent
+# ones along with an upper bound on their counts. Both can be merged
+# with others of the same kind, so summaries built from separate files
+# or processes combine into one, and both can be converted to and from
+# JSON-compatible dictionaries for storage. Values are hashed with
+# blake2b, so the results do not depend on the process that built them.
+
+import base64
+import heapq
+import zlib
+from array import array
+from hashlib import blake2b
+from math import log
+from operator import itemgetter
+
+# The default precision of HyperLogLog: 2**14 registers, for a
+# standard error of about 0.8%
+PRECISION = 14
+# The default number of values retained by TopK
+TOPK_SIZE = 1000
+
+
+def _hash64(value):
+    return int.from_bytes(blake2b(value.encode("utf-8"), digest_size=8).digest(), "big")
+
+
+class HyperLogLog:
+    """
+    Estimates the number of distinct strings added to it. Until it has
+    seen 2**precision / 16 distinct values, it holds their hashes and
+    counts them exactly; only then does it allocate its registers, so
+    that the many small sets found in a report stay small.
+    """
+
+    def __init__(self, precision=PRECISION, registers=None, hashes=None):
+        if not 4 <= precision <= 18:
+            raise ValueError(f"Invalid HyperLogLog precision: {precision}")
+        self.precision = precision
+        self.registers = registers
+        self.hashes = set() if hashes is None and registers is None else hashes
+
+    def _densify(self):
+        bits = 64 - self.precision
+        mask = (1 << bits) - 1
+        registers = bytearray(1 << self.precision)
+        for h in self.hashes:
+            ndx, rank = h >> bits, bits - (h & mask).bit_length() + 1
+            if rank > registers[ndx]:
+                registers[ndx] = rank
+        self.registers, self.hashes = registers, None
+
+    def update(self, values):
+        hashes = map(_hash64, values)
+        if self.hashes is not None:
+            self.hashes.update(hashes)
+            if len(self.hashes) > len(self) >> 4:
+                self._densify()
+            return
+        registers = self.registers
+        bits = 64 - self.precision
+        mask = (1 << bits) - 1
+        for h in hashes:
+            ndx, rank = h >> bits, bits - (h & mask).bit_length() + 1
+            if rank > registers[ndx]:
+                registers[ndx] = rank
+
+    def add(self, value):
+        self.update((value,))
+
+    def __len__(self):
+        # The number of registers
+        return 1 << self.precision
+
+    def merge(self, other):
+        """
+        Adds the values counted by another HyperLogLog, of the same
+        precision, to this one.
+        """
+        if other.precision != self.precision:
+            raise ValueError("Cannot merge HyperLogLogs of different precisions")
+        if other.hashes is not None:
+            if self.hashes is not None:
+                self.hashes |= other.hashes
+                if len(self.hashes) > len(self) >> 4:
+                    self._densify()
+            else:
+                other = HyperLogLog(self.precision, hashes=other.hashes)
+                other._densify()
+        if other.registers is not None:
+            if self.hashes is not None:
+                self._densify()
+            self.registers = bytearray(map(max, self.registers, other.registers))
+        return self
+
+    def count(self):
+        if self.hashes is not None:
+            return len(self.hashes)
+        size = len(self.registers)
+        alpha = 0.7213 / (1 + 1.079 / size)
+        estimate = alpha * size * size / sum(2.0**-r for r in self.registers)
+        zeros = self.registers.count(0)
+        if estimate <= 2.5 * size and zeros:
+            # Linear counting is more accurate for small cardinalities
+            estimate = size * log(size / zeros)
+        return int(round(estimate))
+
+    def to_dict(self):
+        if self.hashes is not None:
+            data = array("Q", sorted(self.hashes)).tobytes()
+            key = "hashes"
+        else:
+            data = bytes(self.registers)
+            key = "registers"
+        data = base64.b64encode(zlib.compress(data)).decode("ascii")
+        return {"precision": self.precision, key: data}
+
+    @classmethod
+    def from_dict(cls, data):
+        precision = data["precision"]
+        if "hashes" in data:
+            hashes = array("Q")
+            hashes.frombytes(zlib.decompress(base64.b64decode(data["hashes"])))
+            return cls(precision, hashes=set(hashes))
+        registers = bytearray(zlib.decompress(base64.b64decode(data["registers"])))
+        if len(registers) != 1 << precision:
+            raise ValueError("Corrupt HyperLogLog registers")
+        return cls(precision, registers)
+
+
+def _by_count(item):
+    return -item[1], item[0]
+
+
+class TopK:
+    """
+    Tracks the most frequent strings added to it, with counts that may
+    overestimate, but never underestimate, the true ones. Up to twice
+    size values are retained between prunings; floor is an upper bound
+    on the count of any value that was dropped.
+    """
+
+    def __init__(self, size=TOPK_SIZE, counts=None, floor=0):
+        self.size = size
+        self.counts = counts or {}
+        self.floor = floor
+
+    def add(self, value, count=1):
+        counts = self.counts
+        current = counts.get(value)
+        if current is not None:
+            counts[value] = current + count
+            return
+        # A new value may have been seen before and dropped
+        counts[value] = self.floor + count
+        if len(counts) > 2 * self.size:
+            self._prune()
+
+    def _prune(self):
+        if len(self.counts) <= self.size:
+            return
+        keep = heapq.nlargest(self.size + 1, self.counts.items(), key=itemgetter(1))
+        # The largest count dropped bounds those of all dropped values
+        self.floor = max(self.floor, keep.pop()[1])
+        self.counts = dict(keep)
+
+    def merge(self, other):
+        """
+        Adds the counts tracked by another TopK to this one.
+        """
+        counts = {}
+        for value in set(self.counts).union(other.counts):
+            counts[value] = self.counts.get(value, self.floor) + other.counts.get(
+                value, other.floor
+            )
+        self.counts = counts
+        self.floor += other.floor
+        self.size = max(self.size, other.size)
+        self._prune()
+        return self
+
+    def top(self, count=10):
+        """
+        Returns a list of (value, count) pairs for the most frequent
+        values, most frequent first, and ties in order of value.
+        """
+        return heapq.nsmallest(count, self.counts.items(), key=_by_count)
+
+    def to_dict(self):
+        self._prune()
+        return {"size": self.size, "floor": self.floor, "counts": self.counts}
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(data["size"], dict(data["counts"]), data["floor"])
@@ -0,0 +1,160 @@
+# This module implements an offline spool for activation heartbeats.
+# When anaconda_heartbeat_spool is set, a heartbeat that cannot reach
+# the repository is appended to a compact file in the user's cache
+# directory, one line per event, holding its time, URL, and the full
+# user agent it would have sent. Each time a heartbeat succeeds, the
+# background sender replays at most SPOOL_BATCH of the oldest events
+# over a single pooled session, leaving the rest for later heartbeats.
+# The file is capped in size, and compacted by dropping the oldest and
+# expired events when it grows too large.
+# The caller supplies the HTTP session.
+
+import os
+import time
+from os.path import dirname, join
+
+from anaconda_anon_usage.utils import _debug
+
+from .cache import CACHE_DIR, acquire_lock, release_lock
+
+SPOOL_PATH = join(CACHE_DIR, "heartbeat.spool")
+# Once the spool exceeds this size, it is compacted to half of it
+SPOOL_MAX_BYTES = 256 * 1024
+# Events older than this are discarded rather than sent
+SPOOL_MAX_AGE = 7 * 86400
+# The most events sent by a single flush
+SPOOL_BATCH = 64
+
+
+def _lock_path():
+    return SPOOL_PATH + ".lock"
+
+
+def _parse(data):
+    events = []
+    now = time.time()
+    for line in data.decode("utf-8", "replace").splitlines():
+        parts = line.split(" ", 2)
+        try:
+            if len(parts) == 3 and now - float(parts[0]) <= SPOOL_MAX_AGE:
+                events.append((float(parts[0]), parts[1], parts[2]))
+        except ValueError:
+            pass
+    # A stable sort keeps the order of events within the same second
+    events.sort(key=lambda e: e[0])
+    return events
+
+
+def _format(events):
+    return "".join("%.0f %s %s\n" % e for e in events).encode("utf-8")
+
+
+def _append(data):
+    # A single O_APPEND write keeps concurrent writers from
+    # interleaving their lines
+    fd = os.open(SPOOL_PATH, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o600)
+    try:
+        os.write(fd, data)
+    finally:
+        os.close(fd)
+
+
+def _take():
+    # Moves the spool aside, so that new events can be appended to a
+    # fresh file while the old ones are processed. The caller holds
+    # the lock, so a leftover work file can only be from a process
+    # that was interrupted; its events are recovered here.
+    wpath = SPOOL_PATH + ".work"
+    data = b""
+    for fpath in (wpath, SPOOL_PATH):
+        try:
+            if fpath == SPOOL_PATH:
+                os.replace(SPOOL_PATH, wpath)
+            with open(wpath, "rb") as fp:
+                data += fp.read()
+        except FileNotFoundError:
+            pass
+    try:
+        os.unlink(wpath)
+    except FileNotFoundError:
+        pass
+    return _parse(data)
+
+
+def _compact(events):
+    # Keeps the newest events that fit within half of the cap
+    total, keep = 0, []
+    for event in reversed(events):
+        total += len(_format([event]))
+        if total > SPOOL_MAX_BYTES // 2:
+            break
+        keep.append(event)
+    _debug("Heartbeat spool compacted: %d of %d events kept", len(keep), len(events))
+    return keep[::-1]
+
+
+def spool_event(url, user_agent):
+    """
+    Records a heartbeat that could not be sent.
+    """
+    if not user_agent or " " in url:
+        return
+    try:
+        os.makedirs(dirname(SPOOL_PATH), exist_ok=True)
+        _append(_format([(time.time(), url, user_agent)]))
+        _debug("Heartbeat spooled: %s", url)
+        if os.stat(SPOOL_PATH).st_size > SPOOL_MAX_BYTES and acquire_lock(_lock_path()):
+            try:
+                _append(_format(_compact(_take())))
+            finally:
+                release_lock(_lock_path())
+    except Exception as exc:
+        _debug("Unexpected error spooling heartbeat: %s", exc)
+
+
+def pending():
+    try:
+        return os.stat(SPOOL_PATH).st_size > 0
+    except OSError:
+        return False
+
+
+def _send_batch(get_session, batch, timeout):
+    for num, (_, url, user_agent) in enumerate(batch):
+        session = get_session(url)
+        try:
+            session.head(
+                url,
+                headers={"User-Agent": user_agent},
+                proxies=session.proxies,
+                timeout=timeout,
+            )
+        except Exception as exc:
+            _debug("Heartbeat spool flush interrupted: %s", exc)
+            return batch[num:]
+    return []
+
+
+def flush(get_session, timeout):
+    """
+    Sends up to SPOOL_BATCH of the spooled heartbeats, oldest first,
+    and returns the rest to the spool. get_session returns the session
+    to use for a given URL; for a single repository, this is one pooled
+    session. Stops at the first failure, returning the unsent events to
+    the spool as well. Returns the number of events sent.
+    """
+    if not pending() or not acquire_lock(_lock_path()):
+        return 0
+    sent = 0
+    try:
+        events = _take()
+        batch, events = events[:SPOOL_BATCH], events[SPOOL_BATCH:]
+        unsent = _send_batch(get_session, batch, timeout)
+        sent = len(batch) - len(unsent)
+        events = unsent + events
+        if events:
+            _append(_format(events))
+    finally:
+        release_lock(_lock_path())
+    _debug("Heartbeat spool flushed: %d events sent", sent)
+    return sent
@@ -0,0 +1,744 @@
+# This module keeps the tokens found in access logs in a local SQLite
+# database, so that questions such as "which hosts in organization X
+# used environment Y last week" are answered from indexes in
+# milliseconds, rather than by reading the logs again. It implements
+# anaconda-ident-query, whose ingest command adds logs to a database,
+# and which otherwise queries one.
+#
+# Every distinct token value is stored once, in the tokens table, and
+# referred to elsewhere by its integer id; 0 stands for an absent
+# token. The records table holds each distinct combination of tokens,
+# and the requests table the number of requests made with each record
+# in each hour. The hourly and daily tables roll those counts up for
+# each combination of organizations (o/), user, host, and environment;
+# the daily table is ordered by (org, day, user), and has a covering
+# index ordered by (org, day, host). The org column holds the id of
+# the combination, the same as that of the single organization in the
+# usual case, or 0 for requests without one, so that each request is
+# counted once; the orgs table lists the organizations in each, so
+# that one with several organizations is counted for each of them
+# when grouped or filtered by organization.
+#
+# The time of each request is taken from its log line, in the common
+# and combined log formats or as an ISO 8601 timestamp, and kept to
+# the hour, in UTC. Lines are aggregated in batches, each written in a
+# single transaction, and the database is kept in WAL mode, so that it
+# can be queried while logs are being added. Incremental ingestion
+# records the position reached in each log in the same transaction as
+# the counts, so each line is counted exactly once across restarts.
+
+import argparse
+import json
+import os
+import re
+import sqlite3
+import sys
+import time
+from collections import Counter
+from datetime import date, datetime, timedelta, timezone
+from itertools import islice
+
+from . import logparse
+from .cache import acquire_lock, release_lock
+
+SCHEMA_VERSION = 2
+# The dimensions of the rollup tables, with their columns
+ROLLUPS = {"users": "user", "hosts": "host", "environments": "env"}
+# The tokens that identify each dimension, in order of preference. As
+# in anaconda-ident-report, names are preferred to their hashes; but
+# environments are identified by name when possible, rather than by
+# their anonymous e/ token, so that they can be queried by name.
+DIMENSIONS = {"users": ("u", "U"), "hosts": ("h", "H"), "environments": ("n", "N", "e")}
+# The columns of the records table for each token; SQLite column
+# names are not case sensitive, so the hashed tokens are renamed
+COLUMNS = tuple(
+    {"U": "u_hash", "H": "h_hash", "N": "n_hash"}.get(f, f) for f in logparse.FIELDS
+)
+# The number of lines aggregated and written in each transaction
+BATCH_SIZE = 262144
+# The size of the page cache of each connection, in bytes
+CACHE_SIZE = 256 << 20
+
+# The columns of the unique index of the records table, most
+# selective first, so that the index is searched quickly
+_UNIQUE = tuple(
+    COLUMNS[logparse._INDEX[k]]
+    for k in ("s", "c", "e", "u", "h", "n", "U", "H", "N", "o", "m", "aid", "aau")
+)
+_COLUMNS = ", ".join(COLUMNS)
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS tokens (id INTEGER PRIMARY KEY, value TEXT NOT NULL UNIQUE);
+INSERT OR IGNORE INTO tokens VALUES (0, '');
+CREATE TABLE IF NOT EXISTS records (id INTEGER PRIMARY KEY, %s, UNIQUE (%s));
+CREATE TABLE IF NOT EXISTS requests (
+    hour INTEGER NOT NULL, record INTEGER NOT NULL, requests INTEGER NOT NULL,
+    PRIMARY KEY (hour, record)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hourly (
+    org INTEGER NOT NULL, hour INTEGER NOT NULL, user INTEGER NOT NULL,
+    host INTEGER NOT NULL, env INTEGER NOT NULL, requests INTEGER NOT NULL,
+    PRIMARY KEY (org, hour, user, host, env)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily (
+    org INTEGER NOT NULL, day INTEGER NOT NULL, user INTEGER NOT NULL,
+    host INTEGER NOT NULL, env INTEGER NOT NULL, requests INTEGER NOT NULL,
+    PRIMARY KEY (org, day, user, host, env)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS daily_host ON daily (org, day, host, user, env, requests);
+CREATE TABLE IF NOT EXISTS orgs (
+    org INTEGER NOT NULL, combo INTEGER NOT NULL, PRIMARY KEY (org, combo)
+) WITHOUT ROWID;
+INSERT OR IGNORE INTO orgs VALUES (0, 0);
+CREATE TABLE IF NOT EXISTS positions (path TEXT PRIMARY KEY, position TEXT NOT NULL);
+""" % (
+    ", ".join(f"{c} INTEGER NOT NULL" for c in COLUMNS),
+    ", ".join(_UNIQUE),
+)
+# Each batch of new tokens and records is staged in these tables
+_TEMP_SCHEMA = """
+CREATE TEMP TABLE new_tokens (value TEXT NOT NULL);
+CREATE TEMP TABLE new_records (%s);
+""" % _COLUMNS
+# The ids of the staged records, in the order they were staged
+_SELECT_NEW_RECORDS = (
+    "SELECT r.id FROM new_records AS n JOIN records AS r USING (%s) ORDER BY n.rowid"
+    % _COLUMNS
+)
+_INSERT_NEW_RECORD = "INSERT INTO new_records VALUES (%s)" % ",".join(
+    "?" * len(COLUMNS)
+)
+
+
+def _upsert(table, keys):
+    columns = keys + ("requests",)
+    return (
+        f"INSERT INTO {table} ({', '.join(columns)}) "
+        f"VALUES ({', '.join('?' * len(columns))}) "
+        f"ON CONFLICT ({', '.join(keys)}) "
+        "DO UPDATE SET requests = requests + excluded.requests"
+    )
+
+
+_INSERTS = {
+    "requests": _upsert("requests", ("hour", "record")),
+    "hourly": _upsert("hourly", ("org", "hour", "user", "host", "env")),
+    "daily": _upsert("daily", ("org", "day", "user", "host", "env")),
+}
+
+# Timestamps in the common log format, such as [17/Oct/2026:10:00:00
+# +0000], or ISO 8601, such as 2026-10-17T10:00:00Z; the first groups
+# hold each to the minute, and the second their offsets from UTC
+_TIME = re.compile(
+    rb"\[(\d\d/[A-Z][a-z][a-z]/\d{4}:\d\d:\d\d):\d\d(?:\.\d+)? ([+-]\d{4})\]"
+    rb"|(\d{4}-\d\d-\d\d[T ]\d\d:\d\d)(?::\d\d(?:[.,]\d+)?)?(Z|[+-]\d\d(?::?\d\d)?)?"
+)
+_MONTHS = {
+    m.encode(): n
+    for n, m in enumerate(
+        ("Jan", "Feb", "Mar", "Apr", "May", "Jun")
+        + ("Jul", "Aug", "Sep", "Oct", "Nov", "Dec"),
+        1,
+    )
+}
+_EPOCH = date(1970, 1, 1).toordinal()
+
+
+def _hour(clf, clf_zone, iso, iso_zone):
+    # Converts the groups of a _TIME match to hours since the epoch
+    try:
+        if clf is not None:
+            day, month, year = int(clf[:2]), _MONTHS[clf[3:6]], int(clf[7:11])
+            stamp, zone = clf[12:], clf_zone
+        else:
+            year, month, day = int(iso[:4]), int(iso[5:7]), int(iso[8:10])
+            stamp, zone = iso[11:], iso_zone
+        minutes = (date(year, month, day).toordinal() - _EPOCH) * 1440
+        minutes += int(stamp[:2]) * 60 + int(stamp[3:5])
+    except (KeyError, ValueError):
+        return None
+    if zone and zone != b"Z":
+        offset = int(zone[1:3]) * 60 + (int(zone[-2:]) if len(zone) > 3 else 0)
+        minutes += offset if zone[:1] == b"-" else -offset
+    return minutes // 60
+
+
+def parse_time(line):
+    """
+    Returns the time of a log line, as bytes, in whole hours since the
+    epoch, UTC; or None if it carries no recognizable timestamp. The
+    first timestamp in the common log format, or in ISO 8601, is used;
+    one without an offset is assumed to be in UTC.
+    """
+    match = _TIME.search(line)
+    return None if match is None else _hour(*match.groups())
+
+
+def _current_hour():
+    return int(time.time()) // 3600
+
+
+def timed_records(lines, default=None):
+    """
+    Like logparse.parse_lines, but yields an (hour, TokenRecord) pair
+    for each line, with the hour as parse_time returns it. Lines
+    without a timestamp are given the default hour, or the current
+    one if not given.
+    """
+    if default is None:
+        default = _current_hour()
+    records, hours = {}, {}
+    span_of, search = logparse._user_agent_span, _TIME.search
+    for line in lines:
+        span = span_of(line)
+        if span is None:
+            continue
+        record = records.get(span)
+        if record is None:
+            if len(records) >= logparse.MEMO_SIZE:
+                records.clear()
+            record = logparse.parse_tokens(span.decode("utf-8", "replace"))
+            records[span] = record
+        match = search(line)
+        if match is None:
+            yield default, record
+            continue
+        # Consecutive lines share their timestamps to the minute
+        key = match.groups()
+        hour = hours.get(key)
+        if hour is None:
+            if len(hours) >= logparse.MEMO_SIZE:
+                hours.clear()
+            hour = hours[key] = _hour(*key)
+            if hour is None:
+                hour = hours[key] = default
+        yield hour, record
+
+
+_ORG_INDEX = logparse._INDEX["o"]
+_LIST_INDEX = tuple(logparse._INDEX[k] for k in logparse.LIST_FIELDS)
+_DIMENSION_INDEX = tuple(
+    tuple(logparse._INDEX[k] for k in DIMENSIONS[d]) for d in ROLLUPS
+)
+
+
+def day_string(day):
+    return date.fromordinal(day + _EPOCH).isoformat()
+
+
+def hour_string(hour):
+    return f"{day_string(hour // 24)} {hour % 24:02d}:00"
+
+
+class Store:
+    """
+    A database of the tokens found in access logs, at the given path;
+    created if it does not exist. Usable as a context manager, which
+    closes it.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        # Transactions are begun and committed explicitly
+        self.db = sqlite3.connect(path, isolation_level=None, timeout=60)
+        # A database of another version is left exactly as it was found
+        version = self._version()
+        if version not in (None, str(SCHEMA_VERSION)):
+            self.db.close()
+            raise ValueError(f"Unsupported database version {version}: {path}")
+        self.db.execute("PRAGMA journal_mode=WAL")
+        # In WAL mode, this is still safe from corruption, and a
+        # transaction lost in a power failure loses its positions too
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        # Batches add rows all over the indexes, which are much faster
+        # to update when they are cached; SQLite caches 2 MB by default
+        self.db.execute(f"PRAGMA cache_size = -{CACHE_SIZE >> 10}")
+        self.db.execute("PRAGMA temp_store = MEMORY")
+        self.db.executescript(_SCHEMA + _TEMP_SCHEMA)
+        self.db.execute(
+            "INSERT OR IGNORE INTO meta VALUES ('version', ?)", (str(SCHEMA_VERSION),)
+        )
+        # The ids of recently seen tokens, and for recently seen
+        # records, their ids and those of their rollup dimensions
+        self._tokens = {None: 0, "": 0}
+        self._records = {}
+        # The organization combinations listed in the orgs table
+        self._combos = {0}
+
+    def _version(self):
+        # The version recorded in the database, or None if it is new
+        try:
+            row = self.db.execute(
+                "SELECT value FROM meta WHERE key = 'version'"
+            ).fetchone()
+        except sqlite3.OperationalError:
+            return None
+        return row[0] if row else None
+
+    def close(self):
+        self.db.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _token_ids(self, values):
+        # Returns the ids of the given token values, adding new ones
+        ids = self._tokens
+        missing = {v for v in values if v not in ids}
+        if not missing:
+            return ids
+        if len(ids) + len(missing) > logparse.MEMO_SIZE * 4:
+            ids = self._tokens = {v: ids[v] for v in values if v in ids}
+            ids[None] = ids[""] = 0
+        # The new values are staged in a temporary table, so that they
+        # are added, and all their ids found, by two statements
+        self.db.executemany("INSERT INTO new_tokens VALUES (?)", zip(missing))
+        self.db.execute(
+            "INSERT OR IGNORE INTO tokens (value) SELECT value FROM new_tokens"
+        )
+        ids.update(
+            self.db.execute(
+                "SELECT value, id FROM new_tokens JOIN tokens USING (value)"
+            )
+        )
+        self.db.execute("DELETE FROM new_tokens")
+        return ids
+
+    def _resolve(self, records):
+        # Adds any records not seen recently to self._records
+        known = self._records
+        missing = [r for r in records if r not in known]
+        if not missing:
+            return known
+        if len(known) + len(missing) > logparse.MEMO_SIZE:
+            known = self._records = {r: known[r] for r in records if r in known}
+        # The records are handled a column at a time, which leaves
+        # most of the work to map and zip
+        columns = list(zip(*missing))
+        orgs = columns[_ORG_INDEX]
+        for ndx in _LIST_INDEX:
+            columns[ndx] = [v and " ".join(v) for v in columns[ndx]]
+        distinct = set().union(*columns)
+        distinct.update(o for v in orgs if v for o in v)
+        ids = self._token_ids(distinct)
+        columns = [list(map(ids.__getitem__, c)) for c in columns]
+        self.db.executemany(_INSERT_NEW_RECORD, zip(*columns))
+        self.db.execute(
+            "INSERT OR IGNORE INTO records (%s) SELECT * FROM new_records" % _COLUMNS
+        )
+        rids = self.db.execute(_SELECT_NEW_RECORDS).fetchall()
+        self.db.execute("DELETE FROM new_records")
+        # The organizations of each combination not seen recently
+        combos = self._combos
+        members = {}
+        for combo, value in zip(columns[_ORG_INDEX], orgs):
+            if combo not in combos:
+                members.update(((ids[o], combo), None) for o in value)
+        if members:
+            if len(combos) + len(members) > logparse.MEMO_SIZE:
+                combos.intersection_update((0,))
+            self.db.executemany("INSERT OR IGNORE INTO orgs VALUES (?, ?)", members)
+            combos.update(c for _, c in members)
+        # The user, host, and environment are the first of their tokens
+        # present, whose ids are not zero
+        dims = []
+        for indices in _DIMENSION_INDEX:
+            values = columns[indices[0]]
+            for ndx in indices[1:]:
+                values = [a or b for a, b in zip(values, columns[ndx])]
+            dims.append(values)
+        known.update(
+            zip(missing, zip((r[0] for r in rids), columns[_ORG_INDEX], *dims))
+        )
+        return known
+
+    def add_counts(self, counts, checkpoint=None):
+        """
+        Adds a mapping of (hour, TokenRecord) pairs to request counts
+        to the database, in a single transaction. If a logtail
+        Checkpoint is given, the positions it records are saved in the
+        same transaction.
+        """
+        requests, hourly, daily = Counter(), Counter(), Counter()
+        self.db.execute("BEGIN IMMEDIATE")
+        try:
+            known = self._resolve({r for _, r in counts})
+            for (hour, record), count in counts.items():
+                rid, org, user, host, env = known[record]
+                requests[hour, rid] += count
+                hourly[org, hour, user, host, env] += count
+                daily[org, hour // 24, user, host, env] += count
+            for table, rows in (
+                ("requests", requests),
+                ("hourly", hourly),
+                ("daily", daily),
+            ):
+                self.db.executemany(
+                    _INSERTS[table], (k + (n,) for k, n in rows.items())
+                )
+            if checkpoint is not None:
+                self.db.executemany(
+                    "INSERT OR REPLACE INTO positions VALUES (?, ?)",
+                    ((k, json.dumps(p.to_dict())) for k, p in checkpoint.files.items()),
+                )
+            self.db.execute("COMMIT")
+        except BaseException:
+            self.db.execute("ROLLBACK")
+            # Ids assigned in the transaction are no longer valid
+            self._tokens, self._records, self._combos = {None: 0, "": 0}, {}, {0}
+            raise
+
+    def add(self, items, checkpoint=None):
+        """
+        Adds an iterable of (hour, TokenRecord) pairs, one for each
+        request, in a single transaction.
+        """
+        self.add_counts(Counter(items), checkpoint)
+
+    def checkpoint(self):
+        """
+        Returns a logtail Checkpoint, kept only in memory, holding the
+        positions reached in the logs ingested incrementally so far.
+        """
+        from .logtail import Checkpoint, Position
+
+        checkpoint = Checkpoint()
+        for path, data in self.db.execute("SELECT path, position FROM positions"):
+            checkpoint.files[path] = Position(**json.loads(data))
+        return checkpoint
+
+    def query(
+        self,
+        what,
+        org=None,
+        user=None,
+        host=None,
+        env=None,
+        since=None,
+        until=None,
+        limit=None,
+    ):
+        """
+        Returns the users, hosts, environments, or organizations seen
+        in the given time range, most active first; or the number of
+        requests in each of its days or hours. Each result is a dict
+        with its value and number of requests; all but days and hours
+        include the first and last days, or hours, they were seen.
+
+        The results can be limited to the requests of an organization,
+        user, host, or environment, each given as a value, such as
+        ml-gpu, or a token, such as n/ml-gpu; values are stored without
+        their token names, so the two are equivalent. The time range is
+        given by dates, inclusive, or datetimes, which select whole
+        hours; the hourly rollups are used for the latter, and for
+        hours, and the daily ones otherwise.
+        """
+        hourly = what == "hours" or any(isinstance(t, datetime) for t in (since, until))
+        table, column = ("hourly", "hour") if hourly else ("daily", "day")
+        conditions, params = [], []
+        for col, value in (("org", org), ("user", user), ("host", host), ("env", env)):
+            if value is None:
+                continue
+            keys = ("o",) if col == "org" else DIMENSIONS[_DIMENSION[col]]
+            prefix, _, rest = value.partition("/")
+            row = self.db.execute(
+                "SELECT id FROM tokens WHERE value = ?",
+                (rest if prefix in keys else value,),
+            ).fetchone()
+            if row is None:
+                return []
+            if col == "org":
+                # Any combination of organizations that includes it
+                conditions.append("r.org IN (SELECT combo FROM orgs WHERE org = ?)")
+            else:
+                conditions.append(f"r.{col} = ?")
+            params.append(row[0])
+        for bound, op in ((since, ">="), (until, "<=")):
+            if bound is not None:
+                conditions.append(f"r.{column} {op} ?")
+                params.append(_bucket(bound, hourly, op == "<="))
+        where = " AND ".join(conditions) or "1"
+        if what in ("days", "hours"):
+            group = "r.hour / 24" if hourly and what == "days" else f"r.{column}"
+            sql = (
+                f"SELECT {group}, SUM(r.requests) FROM {table} AS r WHERE {where} "
+                "GROUP BY 1 ORDER BY 1"
+            )
+            to_string = hour_string if what == "hours" else day_string
+            rows = self.db.execute(sql, params).fetchall()
+            return [{"value": to_string(t), "requests": n} for t, n in rows]
+        if what == "organizations":
+            # Each request counts for each of its organizations
+            group = "o.org"
+            source = f"{table} AS r JOIN orgs AS o ON o.combo = r.org"
+        else:
+            group = f"r.{ROLLUPS[what]}"
+            source = f"{table} AS r"
+        sql = (
+            f"SELECT t.value, q.requests, q.first, q.last FROM ("
+            f"SELECT {group} AS id, SUM(r.requests) AS requests, "
+            f"MIN(r.{column}) AS first, MAX(r.{column}) AS last "
+            f"FROM {source} WHERE {where} GROUP BY 1"
+            ") AS q JOIN tokens AS t ON t.id = q.id "
+            "ORDER BY 2 DESC, 1"
+        )
+        if limit is not None:
+            sql += " LIMIT ?"
+            params.append(limit)
+        to_string = hour_string if hourly else day_string
+        return [
+            {
+                "value": value,
+                "requests": n,
+                "first": to_string(first),
+                "last": to_string(last),
+            }
+            for value, n, first, last in self.db.execute(sql, params)
+        ]
+
+
+_DIMENSION = {v: k for k, v in ROLLUPS.items()}
+
+
+def _bucket(bound, hourly, end):
+    # The day or hour of a date or datetime bound; a date is the
+    # first or last hour of that day
+    if not isinstance(bound, datetime):
+        day = bound.toordinal() - _EPOCH
+        return day * 24 + (23 if end else 0) if hourly else day
+    if bound.tzinfo is not None:
+        bound = bound.astimezone(timezone.utc).replace(tzinfo=None)
+    hour = (bound.toordinal() - _EPOCH) * 24 + bound.hour
+    return hour if hourly else hour // 24
+
+
+def _store_task(task):
+    # Runs in a worker process, yielding the aggregated counts of a
+    # chunk or file of a log, with each distinct record sent once
+    path, start, end, _, _, default = task
+    items = timed_records(logparse._task_lines(path, start, end), default)
+    while True:
+        counts = Counter(islice(items, BATCH_SIZE))
+        if not counts:
+            break
+        index, rows = {}, []
+        for (hour, record), count in counts.items():
+            code = index.setdefault(record, len(index))
+            rows.append((hour, code, count))
+        yield list(map(tuple, index)), rows
+
+
+def ingest(store, paths, jobs=1, incremental=False):
+    """
+    Adds the requests in the given log files to a Store, and returns
+    their number. With jobs greater than one, the logs are divided
+    among that many processes as they are by anaconda-ident-logs; zero
+    means one for each CPU. With incremental=True, only the lines
+    added to each log since the last incremental ingestion are read,
+    in this process; logs rotated in between are followed as they are
+    by anaconda-ident-logs --checkpoint. Incremental ingestion locks
+    the database against another, and raises RuntimeError if it is
+    already locked.
+    """
+    if not incremental:
+        return _ingest(store, paths, jobs, None)
+    lpath = store.path + ".lock"
+    if not acquire_lock(lpath):
+        raise RuntimeError(f"Database being updated by another process: {store.path}")
+    try:
+        return _ingest(store, paths, 1, store.checkpoint(), lpath)
+    finally:
+        release_lock(lpath)
+
+
+def _ingest(store, paths, jobs, checkpoint, lpath=None):
+    from .logtail import new_lines
+
+    total = 0
+    default = _current_hour()
+    if jobs <= 0:
+        jobs = os.cpu_count() or 1
+    # Standard input is always read in this process
+    serial = [p for p in paths if jobs == 1 or p == "-"]
+    for path in serial:
+        if checkpoint is not None:
+            fp, lines = None, new_lines(path, checkpoint)
+        else:
+            fp = lines = logparse.open_log(path)
+        try:
+            items = timed_records(lines, default)
+            while True:
+                counts = Counter(islice(items, BATCH_SIZE))
+                # With a checkpoint, the positions are saved even if
+                # the lines read since the last batch had no tokens
+                count = sum(counts.values())
+                if count or checkpoint is not None:
+                    store.add_counts(counts, checkpoint)
+                    total += count
+                if lpath is not None:
+                    os.utime(lpath)
+                if count < BATCH_SIZE:
+                    break
+        finally:
+            if fp is not None and fp is not sys.stdin.buffer:
+                fp.close()
+    paths = [p for p in paths if p not in serial]
+    if paths:
+        tasks = (
+            t + (default,) for t in logparse._tasks(paths, None, logparse.FIELDS, None)
+        )
+        for distinct, rows in logparse._pool_stream(_store_task, tasks, jobs, False):
+            distinct = list(map(logparse.TokenRecord._make, distinct))
+            store.add_counts({(h, distinct[c]): n for h, c, n in rows})
+            total += sum(n for _, _, n in rows)
+    return total
+
+
+QUERIES = ("users", "hosts", "environments", "organizations", "days", "hours")
+
+
+def _time_arg(value):
+    try:
+        if len(value) == 10:
+            return date.fromisoformat(value)
+        return datetime.fromisoformat(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"Invalid date or time: {value}")
+
+
+def parse_argv(args=None):
+    p = argparse.ArgumentParser(
+        prog="anaconda-ident-query",
+        description="Query a database of the anaconda-ident tokens in access "
+        "logs, built with the ingest command.",
+        epilog="To add logs to the database: anaconda-ident-query ingest "
+        "DATABASE FILE... [--incremental] [--jobs N]",
+    )
+    p.add_argument("database", help="The database to query.")
+    p.add_argument(
+        "what",
+        choices=QUERIES,
+        help="The values to list, most active first; or the requests in "
+        "each day or hour.",
+    )
+    p.add_argument("--org", help="Only the requests of this organization.")
+    p.add_argument("--user", help="Only the requests of this user.")
+    p.add_argument("--host", help="Only the requests from this host.")
+    p.add_argument(
+        "--env",
+        help="Only the requests from this environment. A bare value matches "
+        "any token of its kind, for example both n/base and N/base.",
+    )
+    p.add_argument(
+        "--since",
+        type=_time_arg,
+        help="The first day, or hour as YYYY-MM-DDTHH, of the range, UTC.",
+    )
+    p.add_argument(
+        "--until",
+        type=_time_arg,
+        help="The last day, or hour as YYYY-MM-DDTHH, of the range, UTC.",
+    )
+    p.add_argument(
+        "--days",
+        type=int,
+        help="The range is the last this many days, including today.",
+    )
+    p.add_argument("--limit", type=int, help="The number of values to list.")
+    p.add_argument("--json", action="store_true", help="Output the results as JSON.")
+    args = p.parse_args(args)
+    if args.days is not None:
+        if args.since is not None:
+            p.error("--days and --since are mutually exclusive")
+        args.since = datetime.now(timezone.utc).date() - timedelta(days=args.days - 1)
+    return args
+
+
+def parse_ingest_argv(args=None):
+    p = argparse.ArgumentParser(
+        prog="anaconda-ident-query ingest",
+        description="Add the anaconda-ident tokens in access logs to a database.",
+    )
+    p.add_argument("database", help="The database, created if necessary.")
+    p.add_argument(
+        "files",
+        nargs="*",
+        default=["-"],
+        help="Log files to read. Defaults to standard input.",
+    )
+    p.add_argument(
+        "--incremental",
+        action="store_true",
+        help="Read only the lines added since the last incremental ingestion, "
+        "whose positions are kept in the database.",
+    )
+    p.add_argument(
+        "--jobs",
+        "-j",
+        type=int,
+        default=1,
+        help="The number of processes used to read the logs; "
+        "0 means one for each CPU. Defaults to 1.",
+    )
+    args = p.parse_args(args)
+    if args.incremental:
+        if args.jobs != 1:
+            p.error("--incremental does not support --jobs")
+        if "-" in args.files:
+            p.error("--incremental requires log files")
+    return args
+
+
+def ingest_main(args=None):
+    args = parse_ingest_argv(args)
+    try:
+        with Store(args.database) as store:
+            count = ingest(store, args.files, args.jobs, args.incremental)
+    except RuntimeError as exc:
+        print(f"Error: {exc}", file=sys.stderr)
+        return 1
+    print(f"{args.database}: {count:,d} requests added")
+    return 0
+
+
+def main(args=None):
+    if args is None:
+        args = sys.argv[1:]
+    if args[:1] == ["ingest"]:
+        return ingest_main(args[1:])
+    args = parse_argv(args)
+    if not os.path.exists(args.database):
+        print(f"Error: no such database: {args.database}", file=sys.stderr)
+        return 1
+    with Store(args.database) as store:
+        results = store.query(
+            args.what,
+            args.org,
+            args.user,
+            args.host,
+            args.env,
+            args.since,
+            args.until,
+            args.limit,
+        )
+    if args.json:
+        json.dump(results, sys.stdout, indent=2)
+        sys.stdout.write("\n")
+        return 0
+    for entry in results:
+        if "first" in entry:
+            span = f"  {entry['first']}  {entry['last']}"
+        else:
+            span = ""
+        sys.stdout.write(
+            f"{entry['requests']:12,d}{span}  {entry['value'] or '(none)'}\n"
+        )
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -1,43 +1,231 @@
-_baked_tokens = None
+import os
+import sys
+from operator import is_
 
 
 def get_baked_tokens():
-    global _baked_tokens
-    if _baked_tokens is None:
-        try:
-            from conda.base.context import context
-
-            # When importing the context module outside of
-            # conda, the context object will not be initialized.
-            # We detect this by looking for evidence that
-            # anaconda_anon_usage has fully loaded
-            if not hasattr(context, "_aid_initialized"):
-                from anaconda_ident import patch
-
-                patch.main()
-                context.__init__()
-            _baked_tokens = context.repo_tokens
-        except Exception:
-            _baked_tokens = {}
-    return _baked_tokens
+    """
+    Returns the repo_tokens map. Neither source is retained here: the
+    context caches its own value until it is reinitialized, and the
+    condarc files are checked for changes on each call.
+    """
+    try:
+        from conda.base.context import context
+
+        if getattr(context, "_aid_deferred", False):
+            # The tokens are needed before the user agent, so the
+            # deferred patch is applied now
+            from . import patch
+
+            patch.undefer()
+        # When importing the context module outside of
+        # conda, the context object will not be initialized.
+        # We detect this by looking for evidence that
+        # anaconda_anon_usage has fully loaded. In that case
+        # we read repo_tokens from the condarc files directly
+        # rather than building the entire context.
+        if hasattr(context, "_aid_initialized"):
+            return context.repo_tokens
+        return load_repo_tokens()
+    except Exception:
+        return {}
+
+
+CONDARC_FILENAMES = (".condarc", "condarc")
+YAML_EXTENSIONS = (".yml", ".yaml")
+
+
+def _root_prefix():
+    # conda sets CONDA_ROOT to sys.prefix when it is imported, if it is
+    # not already set; so in the Python of an environment, the base
+    # Python recorded by conda's shell integration is the better guide
+    root = os.environ.get("CONDA_ROOT")
+    if root and root != sys.prefix:
+        return root
+    exe = os.environ.get("CONDA_PYTHON_EXE")
+    if exe:
+        root = os.path.dirname(exe)
+        return root if sys.platform == "win32" else os.path.dirname(root)
+    return sys.prefix
+
+
+def _condarc_files():
+    """
+    Yields the configuration files found along conda's search path,
+    in the same order, and therefore precedence, used by conda.
+    """
+    from conda.base.constants import SEARCH_PATH
+
+    variables = {
+        "CONDA_ROOT": _root_prefix(),
+        "CONDA_PREFIX": os.environ.get("CONDA_PREFIX") or sys.prefix,
+    }
+    for path in SEARCH_PATH:
+        for k, v in variables.items():
+            path = path.replace("$" + k, v)
+        path = os.path.expanduser(os.path.expandvars(path))
+        if os.path.isfile(path):
+            name = os.path.basename(path)
+            if name in CONDARC_FILENAMES or name.endswith(YAML_EXTENSIONS):
+                yield path
+        elif os.path.isdir(path):
+            for name in sorted(os.listdir(path)):
+                fpath = os.path.join(path, name)
+                if name.endswith(YAML_EXTENSIONS) and os.path.isfile(fpath):
+                    yield fpath
+
+
+_condarc_cache = {}
+
+
+def _condarc_repo_tokens(fpath):
+    """
+    Returns the repo_tokens map from a single configuration file,
+    reusing the previous result if the file has not been modified.
+    """
+    try:
+        mtime = os.stat(fpath).st_mtime_ns
+    except OSError:
+        return {}
+    cached = _condarc_cache.get(fpath)
+    if cached is not None and cached[0] == mtime:
+        return cached[1]
+    result = {}
+    try:
+        with open(fpath, "rb") as fp:
+            data = fp.read()
+        # Most files never mention repo_tokens, so we can skip parsing
+        if b"repo_tokens" in data:
+            try:
+                from ruamel.yaml import YAML
+            except Exception:
+                from ruamel_yaml import YAML
+            data = YAML(typ="safe", pure=True).load(data) or {}
+            tokens = data.get("repo_tokens") if isinstance(data, dict) else None
+            if isinstance(tokens, dict):
+                result = {str(k): str(v) for k, v in tokens.items()}
+    except Exception:
+        pass
+    _condarc_cache[fpath] = (mtime, result)
+    return result
+
+
+_merged_cache = ((), {})
+
+
+def load_repo_tokens():
+    """
+    Returns the repo_tokens map merged across all configuration files.
+    As with conda's own map parameters, keys in files later in the
+    search path override those found earlier. The same map is returned
+    until a file is added, removed, or modified.
+    """
+    global _merged_cache
+    parts = [_condarc_repo_tokens(fpath) for fpath in _condarc_files()]
+    c_parts, result = _merged_cache
+    if len(parts) != len(c_parts) or not all(map(is_, parts, c_parts)):
+        result = {}
+        for tokens in parts:
+            result.update(tokens)
+        _merged_cache = (parts, result)
+    return result
+
+
+def _slash_prefixes(url):
+    """
+    Yields the prefixes of the given URL that end with a slash,
+    longest first.
+    """
+    end = url.rfind("/") + 1
+    while end:
+        yield url[:end]
+        end = url.rfind("/", 0, end - 1) + 1
+
+
+_baked_index = (None, None)
+
+
+def get_baked_index():
+    """
+    Returns the baked tokens keyed by URL prefixes normalized to end
+    with a slash. A longest-prefix lookup then requires only one probe
+    per slash in the URL, regardless of the number of tokens. The index
+    is rebuilt whenever get_baked_tokens returns a different map.
+    """
+    global _baked_index
+    baked = get_baked_tokens()
+    c_baked, index = _baked_index
+    if c_baked is not baked:
+        index = {}
+        for k, v in baked.items():
+            index.setdefault(k.rstrip("/") + "/", v)
+        _baked_index = (baked, index)
+    return index
 
 
 def load_baked_token(url):
-    url = url.rstrip("/") + "/"
-    for k, v in get_baked_tokens().items():
-        if url.startswith(k):
-            return v
+    index = get_baked_index()
+    for prefix in _slash_prefixes(url.rstrip("/") + "/"):
+        if prefix in index:
+            return index[prefix]
 
 
 def include_baked_tokens(tdict):
-    for k, v in get_baked_tokens().items():
-        for k2 in tdict:
-            if k2.startswith(k):
-                break
-        else:
-            tdict[k] = v
-            if k == "https://repo.anaconda.cloud/":
-                tdict[k + "repo/"] = v
+    # A baked token is skipped if tdict already holds a token for a URL
+    # at or below its prefix. Collecting the slash prefixes of every key
+    # up front makes each of those checks a single set lookup.
+    covered = {p for k in tdict for p in _slash_prefixes(k)}
+    for k, v in get_baked_index().items():
+        if k in covered:
+            continue
+        tdict[k] = v
+        covered.update(_slash_prefixes(k))
+        if k == "https://repo.anaconda.cloud/":
+            tdict[k + "repo/"] = v
+            covered.add(k + "repo/")
+
+
+_binstar_cache = (None, None, None)
+
+
+def read_binstar_tokens(ac):
+    """
+    Returns the tokens read by the original read_binstar_tokens function
+    of the given anaconda_client module, merged with the baked tokens.
+    The result is reused until the modification time of the token
+    directory changes. Adding, removing, or replacing a token file
+    updates that time; anaconda-ident and anaconda-client both replace
+    token files rather than rewriting them in place.
+    """
+    global _binstar_cache
+    token_dir = ac._get_binstar_token_directory()
+    try:
+        mtime = os.stat(token_dir).st_mtime_ns
+    except OSError:
+        mtime = None
+    index = get_baked_index()
+    c_key, c_index, c_tokens = _binstar_cache
+    if c_key != (token_dir, mtime) or c_index is not index:
+        c_tokens = ac._old_read_binstar_tokens()
+        include_baked_tokens(c_tokens)
+        _binstar_cache = ((token_dir, mtime), index, c_tokens)
+    return dict(c_tokens)
+
+
+def decode_pepper(pepper):
+    """
+    Decodes the pepper in an anaconda_ident config string, which is
+    base64-encoded without padding. A value that cannot be decoded is
+    returned unchanged.
+    """
+    import base64
+
+    try:
+        npad = len(pepper) % 3
+        npad = 3 - npad if npad else 0
+        return base64.b64decode(pepper + "=" * npad)
+    except Exception:
+        return pepper
 
 
 def hash_string(what, s, pepper=None):
@@ -60,12 +248,17 @@ def hash_string(what, s, pepper=None):
 def main():
     import sys
 
+    if sys.argv[1:2] == ["index"]:
+        from .hashindex import main
+
+        return main(sys.argv[2:])
     if len(sys.argv) != 4 or sys.argv[1] not in ("username", "hostname", "environment"):
         from os.path import basename
 
         ename = basename(sys.argv[0])
         print(
-            f"Usage: {ename} <username|hostname|environment> <value> <organization>",
+            f"Usage: {ename} <username|hostname|environment> <value> <organization>\n"
+            f"       {ename} index <file> --roster <file> [--pepper <pepper>]",
             file=sys.stderr,
         )
         sys.exit(0 if len(sys.argv) == 1 or "--help" in sys.argv else -1)
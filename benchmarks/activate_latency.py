@@ -0,0 +1,50 @@
+# Measures the latency of the anaconda-ident activation script with
+# and without a valid verification stamp. Run this from within an
+# environment where anaconda-ident is installed and enabled:
+#
+#   python benchmarks/activate_latency.py [--count N]
+#
+# The "python" row is what every activation cost before the stamp
+# was introduced; the "stamp" row is the cost of the shell check.
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+from os.path import dirname, join
+
+from anaconda_ident import install
+
+SCRIPT = join(dirname(dirname(__file__)), "scripts", "activate.sh")
+
+
+def _time(count, clear):
+    times = []
+    for _ in range(count):
+        if clear:
+            install.clear_stamp()
+        start = time.perf_counter()
+        subprocess.run(["sh", "-c", f'. "{SCRIPT}"'], env=ENV, check=True)
+        times.append(time.perf_counter() - start)
+    times.sort()
+    return times[len(times) // 2], times[0], times[-1]
+
+
+p = argparse.ArgumentParser()
+p.add_argument("--count", type=int, default=20)
+args = p.parse_args()
+
+ENV = dict(os.environ, CONDA_PREFIX=sys.prefix)
+ENV["PATH"] = os.pathsep.join((dirname(sys.executable), ENV.get("PATH", "")))
+
+print(f"{'mode':8} {'median':>10} {'min':>10} {'max':>10}")
+for mode in ("python", "stamp"):
+    if mode == "stamp":
+        # Write a fresh stamp before timing the fast path
+        subprocess.run(
+            [sys.executable, "-m", "anaconda_ident.install", "--verify", "--quiet"],
+            check=True,
+        )
+    med, lo, hi = _time(args.count, mode == "python")
+    print(f"{mode:8} {med * 1e3:8.2f}ms {lo * 1e3:8.2f}ms {hi * 1e3:8.2f}ms")
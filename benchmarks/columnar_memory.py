@@ -0,0 +1,134 @@
+# Compares the memory held by the parsed records of an access log as
+# a list of dicts, one per request, with that held by a TokenBatch,
+# and the time taken to count the distinct users of each organization
+# in each form:
+#
+#   python benchmarks/columnar_memory.py [--records 1000000]
+#       [--project 50000000] [--batch-only]
+#
+# The dicts are measured in two forms: those of logparse.record_dict,
+# whose strings are shared by the requests of a conda command, and
+# those loaded from the NDJSON written by anaconda-ident-logs, which
+# share nothing. Memory is measured with tracemalloc, as the memory
+# still allocated once each form is built, and projected to the given
+# number of records. The dicts grow in proportion to the records, but
+# the dictionaries of a batch grow more slowly, so its projection is
+# an overestimate unless --records is large. Each simulated conda
+# command issues a handful of requests with the same user agent, from
+# one of 5,000 users on one of their hosts, in one of 50 environments
+# and 200 organizations, and starts a new session. With
+# --batch-only, only the batch is built, so that it can be measured at
+# a scale whose dicts would not fit in memory.
+
+import argparse
+import json
+import random
+import time
+import tracemalloc
+from collections import defaultdict
+
+from anaconda_ident import logparse
+from anaconda_ident.columnar import TokenBatch
+
+LINE = b'"GET /pkgs/main/linux-64/repodata.json HTTP/1.1" 200 1 "-" "%s"'
+CONDA = "conda/24.9.2 requests/2.32.3 CPython/3.12.7 Linux/6.8.0"
+
+
+def generate(count, seed=0):
+    rnd = random.Random(seed)
+    orgs = ["org%03d" % n for n in range(200)]
+    envs = ["base"] + ["env%02d" % n for n in range(49)]
+    users = [
+        ("user%04d" % n, ["host%04d-%d" % (n, k) for k in range(3)], rnd.choice(orgs))
+        for n in range(5000)
+    ]
+    written = 0
+    while written < count:
+        user, hosts, org = rnd.choice(users)
+        host = rnd.choice(hosts)
+        env = rnd.choice(envs)
+        agent = (
+            f"{CONDA} aau/0.4.4 aid/0.5.1 c/client-{host} s/session{written} "
+            f"e/{env}-{host} u/{user} h/{host} n/{env} o/{org}"
+        )
+        line = LINE % agent.encode()
+        for _ in range(min(rnd.randint(2, 12), count - written)):
+            yield line
+            written += 1
+
+
+def _measure(build):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = build()
+    elapsed = time.perf_counter() - start
+    size, _ = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, size, elapsed
+
+
+def _dicts(count):
+    return [logparse.record_dict(r) for r in logparse.parse_lines(generate(count))]
+
+
+def _ndjson(count):
+    format = logparse.formatter("ndjson")
+    return [json.loads(format(r)) for r in logparse.parse_lines(generate(count))]
+
+
+def _batch(count):
+    return TokenBatch.from_records(logparse.parse_lines(generate(count)))
+
+
+def _users_per_org(dicts):
+    users = defaultdict(set)
+    for d in dicts:
+        if "u" in d:
+            for org in d.get("o", ()):
+                users[org].add(d["u"])
+    return {org: len(u) for org, u in users.items()}
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--records", type=int, default=1000000)
+    p.add_argument("--project", type=int, default=50000000)
+    p.add_argument("--batch-only", action="store_true")
+    args = p.parse_args()
+
+    count = args.records
+    scale = args.project / count
+    print(f"{count:,d} records; projected to {args.project:,d}")
+    forms = [("TokenBatch", _batch)]
+    if not args.batch_only:
+        forms += [("record_dict", _dicts), ("NDJSON dicts", _ndjson)]
+    sizes = {}
+    for label, build in forms:
+        result, size, elapsed = _measure(lambda: build(count))
+        sizes[label] = size
+        if label == "TokenBatch":
+            codes = result.nbytes
+            query = _timed(result.group_by, "o", "u")
+        else:
+            query = _timed(_users_per_org, result)
+        del result
+        print(
+            f"{label:>12}: {size / count:7.1f} bytes/record, "
+            f"{size * scale / 1e9:7.2f} GB projected; built in {elapsed:6.1f} s, "
+            f"users per org in {query * 1000:8.1f} ms"
+        )
+        if label == "TokenBatch":
+            print(f"{'':>12}  of which codes: {codes / count:7.1f} bytes/record")
+    for label, size in sizes.items():
+        if label != "TokenBatch":
+            print(f"{label} / TokenBatch: {size / sizes['TokenBatch']:.1f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,80 @@
+# Simulates many conda processes fetching their identity tokens at
+# once, comparing the token daemon against resolving them in-process:
+#
+#   python benchmarks/daemon_load.py [--procs N] [--requests N]
+#
+# Each worker is a separate process. In "local" mode it resolves the
+# prefix-independent tokens once, as a new conda process would; in
+# "daemon" mode it fetches them over the socket repeatedly.
+
+import argparse
+import os
+import subprocess
+import sys
+import tempfile
+import time
+from multiprocessing import Pool
+
+CONFIG = "fullhash:myorg"
+
+
+def _local(_):
+    from anaconda_anon_usage.utils import _cache_clear
+
+    from anaconda_ident import patch
+
+    plan = patch.token_plan(CONFIG)
+    _cache_clear()
+    start = time.perf_counter()
+    patch._resolve_tokens(plan, plan.static, sys.prefix, {})
+    return [time.perf_counter() - start]
+
+
+def _remote(count):
+    from anaconda_ident import daemon
+
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        values = daemon.request_tokens(CONFIG, spawn=False)
+        times.append(time.perf_counter() - start)
+        assert values, "daemon did not respond"
+    return times
+
+
+def _report(label, times, elapsed):
+    times.sort()
+    p50 = times[len(times) // 2] * 1e6
+    p99 = times[int(len(times) * 0.99)] * 1e6
+    rate = len(times) / elapsed
+    print(f"{label:8} {len(times):8} {p50:10.1f}us {p99:10.1f}us {rate:10.0f}/s")
+
+
+p = argparse.ArgumentParser()
+p.add_argument("--procs", type=int, default=64)
+p.add_argument("--requests", type=int, default=200)
+args = p.parse_args()
+
+with tempfile.TemporaryDirectory() as tdir:
+    os.chmod(tdir, 0o700)
+    os.environ["XDG_RUNTIME_DIR"] = tdir
+    from anaconda_ident import daemon
+
+    server = subprocess.Popen([sys.executable, "-m", "anaconda_ident.daemon"])
+    try:
+        while not os.path.exists(daemon.socket_path()):
+            time.sleep(0.01)
+        print(f"{'mode':8} {'count':>8} {'p50':>12} {'p99':>12} {'rate':>12}")
+        with Pool(args.procs) as pool:
+            # One resolution per process, as each conda command does
+            start = time.perf_counter()
+            results = pool.map(_local, range(args.procs * 4), chunksize=1)
+            elapsed = time.perf_counter() - start
+            _report("local", sum(results, []), elapsed)
+            start = time.perf_counter()
+            results = pool.map(_remote, [args.requests] * args.procs, chunksize=1)
+            elapsed = time.perf_counter() - start
+            _report("daemon", sum(results, []), elapsed)
+    finally:
+        server.terminate()
+        server.wait()
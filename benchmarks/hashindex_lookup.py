@@ -0,0 +1,88 @@
+# Measures anaconda_ident.hashindex against the in-memory table of
+# roster.build_table, for the same rosters:
+#
+#   python benchmarks/hashindex_lookup.py [--users 80000] [--hosts 200000]
+#       [--added 10000] [--lookups 1000000] [--peppers 1] [--path FILE]
+#
+# The times are to build the table; to build the index, and to merge a
+# further set of new users into it; and to open each, after which the
+# index needs no further work. Then the rate of lookups, in a mix of
+# nine hashes found to one not found, with each. With several peppers,
+# every value is hashed with each, and the lookups are of hashes from
+# all of them. The index is written to FILE if given; otherwise, to a
+# temporary directory.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from anaconda_ident import hashindex, roster
+
+PEPPER = b"pepper-"
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _lookups(table, tokens):
+    section = table["U"]
+    return sum(1 for t in tokens if section.get(t) is not None)
+
+
+def main():
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=80000)
+    p.add_argument("--hosts", type=int, default=200000)
+    p.add_argument("--added", type=int, default=10000)
+    p.add_argument("--lookups", type=int, default=1000000)
+    p.add_argument("--peppers", type=int, default=1)
+    p.add_argument("--path")
+    args = p.parse_args()
+
+    rnd = random.Random(0)
+    peppers = [PEPPER + b"%d" % n for n in range(args.peppers)]
+    users = ["user%06d" % n for n in range(args.users)]
+    entries = [("username", v) for v in users]
+    entries += [("hostname", "host-%06d.example.com" % n) for n in range(args.hosts)]
+    added = [("username", "new%06d" % n) for n in range(args.added)]
+    with tempfile.TemporaryDirectory() as tdir:
+        path = args.path or os.path.join(tdir, "hashes.idx")
+        if os.path.exists(path):
+            os.unlink(path)
+        print(
+            f"{len(entries):,d} roster values, {len(added):,d} added; "
+            f"{len(peppers)} peppers"
+        )
+        elapsed, table = _timed(roster.build_table, entries, peppers)
+        print(f"build_table:  {elapsed:8.3f} s")
+        elapsed, _ = _timed(hashindex.update_index, path, entries, peppers)
+        print(f"update_index: {elapsed:8.3f} s, {os.path.getsize(path) / 1e6:.1f} MB")
+        elapsed, _ = _timed(hashindex.update_index, path, added, peppers)
+        print(f"  merge:      {elapsed:8.3f} s")
+        elapsed, index = _timed(hashindex.HashIndex, path, peppers)
+        print(f"open:         {elapsed * 1e3:8.3f} ms")
+
+        found = [
+            h
+            for pepper in peppers
+            for h in roster.hash_values("username", users, pepper)
+        ]
+        missing = roster.hash_values("username", ["x%d" % n for n in range(1000)])
+        tokens = [
+            rnd.choice(found) if rnd.random() < 0.9 else rnd.choice(missing)
+            for _ in range(args.lookups)
+        ]
+        for name, source in (("table", table), ("index", index)):
+            elapsed, count = _timed(_lookups, source, tokens)
+            assert count > 0.85 * len(tokens)
+            print(f"{name} lookups: {len(tokens) / elapsed:12,.0f} /s")
+        index.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,100 @@
+# Measures the wall time of an environment activation with heartbeats
+# enabled, sent in the foreground as anaconda-anon-usage does and in
+# the background, against a local stand-in for the repository that is
+# fast, slow, or unresponsive:
+#
+#   python benchmarks/heartbeat_latency.py [--count N]
+#
+# Each activation runs in a fresh interpreter, and the time includes
+# the wait for any heartbeat thread before the interpreter exits.
+
+import argparse
+import os
+import socket
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+CHILD = """
+import sys
+from anaconda_anon_usage import patch as aau_patch
+from conda.activate import PosixActivator
+from conda.base.context import context
+from anaconda_ident import patch
+aau_patch.main(plugin=True, command="activate")
+patch.defer("activate")
+context.__init__()
+PosixActivator(["activate", sys.prefix]).execute()
+"""
+
+
+class Handler(BaseHTTPRequestHandler):
+    delay = 0
+
+    def do_HEAD(self):
+        time.sleep(self.delay)
+        self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class SlowHandler(Handler):
+    delay = 5
+
+
+def _server(handler):
+    server = ThreadingHTTPServer(("127.0.0.1", 0), handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, server.server_address[1]
+
+
+def _down():
+    # Accepts connections at the kernel level but never responds
+    sock = socket.socket()
+    sock.bind(("127.0.0.1", 0))
+    sock.listen(64)
+    return sock, sock.getsockname()[1]
+
+
+def _drain(home):
+    # Waits for the detached sender, so that it does not compete
+    # with the next measurement for the CPU
+    qdir = os.path.join(home, ".conda", "anaconda_ident", "heartbeats")
+    while os.path.isdir(qdir) and os.listdir(qdir):
+        time.sleep(0.1)
+
+
+def _activate(port, background, count, env):
+    env = dict(env)
+    env["CONDA_ANACONDA_HEARTBEAT"] = f"http://127.0.0.1:{port}/"
+    env["CONDA_ANACONDA_HEARTBEAT_BACKGROUND"] = "true" if background else "false"
+    times = []
+    for _ in range(count):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", CHILD], env=env, check=True)
+        times.append(time.perf_counter() - start)
+        _drain(env["HOME"])
+    return sorted(times)[len(times) // 2]
+
+
+p = argparse.ArgumentParser()
+p.add_argument("--count", type=int, default=5)
+args = p.parse_args()
+
+with tempfile.TemporaryDirectory() as home:
+    env = dict(os.environ, HOME=home, NO_PROXY="127.0.0.1")
+    targets = (
+        ("fast", _server(Handler)),
+        ("slow", _server(SlowHandler)),
+        ("down", _down()),
+    )
+    print(f"{'server':8} {'foreground':>12} {'background':>12}")
+    for label, (_, port) in targets:
+        fg = _activate(port, False, args.count, env)
+        bg = _activate(port, True, args.count, env)
+        print(f"{label:8} {fg * 1e3:10.1f}ms {bg * 1e3:10.1f}ms")
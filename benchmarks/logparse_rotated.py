@@ -0,0 +1,114 @@
+# Measures the throughput of anaconda_ident.logparse on a directory
+# of compressed, rotated access logs, in lines per second:
+#
+#   python benchmarks/logparse_rotated.py [--files 8] [--size-mb 128]
+#       [--codec gz] [--path DIR] [--jobs 1,2,4,...]
+#
+# The logs are generated as in logparse_throughput.py, each with
+# size-mb megabytes of text before compression, and are written to
+# DIR if given, and reused if they already exist; otherwise, to a
+# temporary directory. A plain decompression of every line provides a
+# baseline. Then, for each number of processes, the times are for the
+# parser, with the records in their original order and in the order
+# the files complete, and for the NDJSON output of anaconda-ident-logs,
+# written to the null device.
+
+import argparse
+import bz2
+import gzip
+import lzma
+import os
+import tempfile
+import time
+
+from logparse_throughput import generate
+
+from anaconda_ident import logparse
+
+
+def _zstd_open(path, mode):
+    import io
+
+    import zstandard
+
+    return io.TextIOWrapper(zstandard.open(path, "wb"))
+
+
+CODECS = {"gz": gzip.open, "bz2": bz2.open, "xz": lzma.open, "zst": _zstd_open}
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _read(paths):
+    count = 0
+    for path in paths:
+        with logparse.open_log(path) as fp:
+            count += sum(1 for _ in fp)
+    return count
+
+
+def _parse(paths, jobs, ordered=True):
+    for _ in logparse.parse_files(paths, jobs, ordered):
+        pass
+
+
+def _ndjson(paths, jobs):
+    logparse.main(paths + ["--jobs", str(jobs), "--output", os.devnull])
+
+
+def _jobs(value):
+    return [int(j) for j in value.split(",")]
+
+
+def main():
+    ncpu = os.cpu_count() or 1
+    p = argparse.ArgumentParser()
+    p.add_argument("--files", type=int, default=8)
+    p.add_argument("--size-mb", type=float, default=128)
+    p.add_argument("--codec", choices=tuple(CODECS), default="gz")
+    p.add_argument("--path")
+    p.add_argument(
+        "--jobs",
+        type=_jobs,
+        default=[j for j in (1, 2, 4, 8, 16, 32, 64) if j < ncpu] + [ncpu],
+        help="A comma-separated list of process counts. Defaults to powers "
+        "of two up to the number of CPUs.",
+    )
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        ldir = args.path or tdir
+        os.makedirs(ldir, exist_ok=True)
+        paths = []
+        for num in range(args.files):
+            # Named as logrotate would, with the newest first
+            path = os.path.join(ldir, f"access.log.{num + 1}.{args.codec}")
+            if not os.path.exists(path):
+                print(f"Generating {path}")
+                size = int(args.size_mb * 1e6)
+                generate(path, size, seed=num, opener=CODECS[args.codec])
+            paths.append(path)
+        size = sum(os.path.getsize(path) for path in paths)
+        count = _read(paths)
+        elapsed = _timed(_read, paths)
+        print(f"{count:,d} lines, {size / 1e6:,.0f} MB compressed; {ncpu} CPUs")
+        print(
+            f"decompress: {count / elapsed:,.0f} lines/s, "
+            f"{size / elapsed / 1e6:,.1f} MB/s"
+        )
+        print(f"{'jobs':>4} {'parse':>12} {'unordered':>12} {'ndjson':>12}  lines/s")
+        for jobs in args.jobs:
+            times = (
+                _timed(_parse, paths, jobs),
+                _timed(_parse, paths, jobs, False),
+                _timed(_ndjson, paths, jobs),
+            )
+            print(f"{jobs:4} " + " ".join(f"{count / t:12,.0f}" for t in times))
+
+
+if __name__ == "__main__":
+    main()
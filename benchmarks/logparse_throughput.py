@@ -0,0 +1,132 @@
+# Measures the throughput of anaconda_ident.logparse, in lines per
+# second, on a generated access log in the combined log format:
+#
+#   python benchmarks/logparse_throughput.py [--size-gb 2] [--path FILE]
+#       [--jobs 1,2,4,...]
+#
+# The log is written to FILE if given, and reused if it already
+# exists; otherwise, to a temporary file. Each simulated conda command
+# issues a handful of requests with the same user agent, and one line
+# in four comes from some other client. A plain read of every line
+# provides a baseline. Then, for each number of processes, the times
+# are for the parser, with the records in their original order and
+# in the order the chunks complete, and for the NDJSON output of
+# anaconda-ident-logs, written to the null device.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+
+from anaconda_ident import logparse
+
+LINE = (
+    '10.%d.%d.%d - - [17/Oct/2026:10:%02d:%02d +0000] "GET /pkgs/main/%s HTTP/1.1" '
+    '200 %d "-" "%s"\n'
+)
+PATHS = (
+    "linux-64/repodata.json",
+    "noarch/repodata.json",
+    "linux-64/numpy-2.1.1-py312h58c1407_0.conda",
+    "osx-arm64/python-3.12.7-h99e199e_0.conda",
+)
+CONDA = (
+    "conda/24.9.2 requests/2.32.3 CPython/3.12.7 Linux/6.8.0 ubuntu/24.04 glibc/2.39"
+)
+OTHERS = ("pip/24.2 CPython/3.12.7", "curl/8.9.1", "Mozilla/5.0 (X11; Linux x86_64)")
+
+
+def _token(rnd, size=22):
+    return "".join(
+        rnd.choice("abcdefghijklmnopqrstuvwxyz0123456789-_") for _ in range(size)
+    )
+
+
+def generate(path, size, seed=0, opener=open):
+    rnd = random.Random(seed)
+    users = [(_token(rnd, 8), _token(rnd, 12), _token(rnd)) for _ in range(500)]
+    orgs = [_token(rnd, 16) for _ in range(20)]
+    written = 0
+    with opener(path, "wt") as fp:
+        while written < size:
+            user, host, client = rnd.choice(users)
+            agent = (
+                f"{CONDA} aau/0.4.4 aid/0.5.1 c/{client} s/{_token(rnd)} "
+                f"e/{_token(rnd)} u/{user} h/{host} n/base o/{rnd.choice(orgs)}"
+            )
+            lines = []
+            for _ in range(rnd.randint(2, 12)):
+                if rnd.random() < 0.25:
+                    ua = rnd.choice(OTHERS)
+                else:
+                    ua = agent
+                ip = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                when = (rnd.randrange(60), rnd.randrange(60))
+                item = (rnd.choice(PATHS), rnd.randrange(1 << 24), ua)
+                lines.append(LINE % (ip + when + item))
+            block = "".join(lines)
+            fp.write(block)
+            written += len(block)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    func(*args)
+    return time.perf_counter() - start
+
+
+def _read(path):
+    with logparse.open_log(path) as fp:
+        return sum(1 for _ in fp)
+
+
+def _parse(path, jobs, ordered=True):
+    for _ in logparse.parse_file(path, jobs, ordered):
+        pass
+
+
+def _ndjson(path, jobs):
+    logparse.main([path, "--jobs", str(jobs), "--output", os.devnull])
+
+
+def _jobs(value):
+    return [int(j) for j in value.split(",")]
+
+
+def main():
+    ncpu = os.cpu_count() or 1
+    p = argparse.ArgumentParser()
+    p.add_argument("--size-gb", type=float, default=2)
+    p.add_argument("--path")
+    p.add_argument(
+        "--jobs",
+        type=_jobs,
+        default=[j for j in (1, 2, 4, 8, 16, 32, 64) if j < ncpu] + [ncpu],
+        help="A comma-separated list of process counts. Defaults to powers "
+        "of two up to the number of CPUs.",
+    )
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        path = args.path or os.path.join(tdir, "access.log")
+        if not os.path.exists(path):
+            print(f"Generating {args.size_gb:g} GB log: {path}")
+            generate(path, int(args.size_gb * 1e9))
+        size = os.path.getsize(path)
+        count = _read(path)
+        elapsed = _timed(_read, path)
+        print(f"{count:,d} lines, {size / 1e6:,.0f} MB; {ncpu} CPUs")
+        print(f"read: {count / elapsed:,.0f} lines/s, {size / elapsed / 1e6:,.1f} MB/s")
+        print(f"{'jobs':>4} {'parse':>12} {'unordered':>12} {'ndjson':>12}  lines/s")
+        for jobs in args.jobs:
+            times = (
+                _timed(_parse, path, jobs),
+                _timed(_parse, path, jobs, False),
+                _timed(_ndjson, path, jobs),
+            )
+            print(f"{jobs:4} " + " ".join(f"{count / t:12,.0f}" for t in times))
+
+
+if __name__ == "__main__":
+    main()
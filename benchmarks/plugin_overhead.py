@@ -0,0 +1,64 @@
+# Measures the overhead the anaconda-ident pre-command plugin adds to
+# each conda command it runs for. Each measurement runs in a fresh
+# interpreter, and includes reading the user agent for the commands
+# that build a CondaSession or display it. The anaconda-anon-usage
+# patch is applied beforehand in every case, since its own plugin
+# runs regardless of anaconda-ident.
+#
+#   python benchmarks/plugin_overhead.py [--count N]
+#
+# "off" is the cost without anaconda-ident, "eager" applies the full
+# patch up front as earlier versions did, and "deferred" is the
+# current plugin behavior.
+
+import argparse
+import subprocess
+import sys
+
+from anaconda_ident import plugin
+
+# Commands that read context.user_agent in normal operation. The
+# activate command does so only when heartbeats are enabled.
+READS_USER_AGENT = {"info", "install", "create", "uninstall", "env_create", "search"}
+
+CHILD = """
+import sys, time
+from conda.base.context import context
+from anaconda_anon_usage import patch as aau_patch
+mode, command, read_ua = sys.argv[1], sys.argv[2], sys.argv[3] == "1"
+context.__init__()
+aau_patch.main(plugin=True, command=command)
+start = time.perf_counter()
+if mode != "off":
+    from anaconda_ident import patch
+    (patch.main if mode == "eager" else patch.defer)(command)
+if read_ua:
+    context.user_agent
+print(time.perf_counter() - start)
+"""
+
+
+def _measure(mode, command, count):
+    read_ua = "1" if command in READS_USER_AGENT else "0"
+    times = []
+    for _ in range(count):
+        proc = subprocess.run(
+            [sys.executable, "-c", CHILD, mode, command, read_ua],
+            capture_output=True,
+            text=True,
+            check=True,
+        )
+        times.append(float(proc.stdout.strip().splitlines()[-1]))
+    return sorted(times)[len(times) // 2]
+
+
+p = argparse.ArgumentParser()
+p.add_argument("--count", type=int, default=5)
+args = p.parse_args()
+
+commands = sorted(c for hook in plugin.conda_pre_commands() for c in hook.run_for)
+modes = ("off", "eager", "deferred")
+print(f"{'command':12}" + "".join(f"{m:>12}" for m in modes))
+for command in commands:
+    row = [_measure(mode, command, args.count) for mode in modes]
+    print(f"{command:12}" + "".join(f"{t * 1e3:10.2f}ms" for t in row))
@@ -0,0 +1,65 @@
+# Compares the repo_tokens lookups against the linear scans they
+# replaced, for increasing numbers of configured channel tokens:
+#
+#   python benchmarks/repo_tokens.py
+
+import random
+import timeit
+
+from anaconda_ident import tokens
+
+
+def _old_load(url):
+    url = url.rstrip("/") + "/"
+    for k, v in tokens.get_baked_tokens().items():
+        if url.startswith(k):
+            return v
+
+
+def _old_include(tdict):
+    for k, v in tokens.get_baked_tokens().items():
+        for k2 in tdict:
+            if k2.startswith(k):
+                break
+        else:
+            tdict[k] = v
+
+
+def _setup(count):
+    rnd = random.Random(count)
+    baked = {}
+    for n in range(count):
+        host = f"mirror{n % 97}.example.com"
+        baked[f"https://{host}/repo{n}/"] = f"token{n}"
+    tokens.get_baked_tokens = lambda: baked
+    keys = list(baked)
+    urls = [rnd.choice(keys) + "main/linux-64/repodata.json" for _ in range(100)]
+    binstar = {f"https://{k.split('/')[2]}/other/": "t" for k in keys[:50]}
+    return urls, binstar
+
+
+print(f"{'entries':>8} {'op':8} {'scan':>12} {'index':>12}")
+for count in (10, 1000, 100000):
+    urls, binstar = _setup(count)
+    assert [_old_load(u) for u in urls] == [tokens.load_baked_token(u) for u in urls]
+    number = max(1, 10000 // count)
+    cases = (
+        (
+            "lookup",
+            lambda: [_old_load(u) for u in urls],
+            lambda: [tokens.load_baked_token(u) for u in urls],
+        ),
+        (
+            "include",
+            lambda: _old_include(dict(binstar)),
+            lambda: tokens.include_baked_tokens(dict(binstar)),
+        ),
+    )
+    for op, old, new in cases:
+        t_new = min(timeit.repeat(new, number=number, repeat=3)) / number
+        # The quadratic merge is impractical to time at the largest size
+        if op == "include" and count > 10000:
+            print(f"{count:8} {op:8} {'-':>12} {t_new * 1e3:10.3f}ms")
+            continue
+        t_old = min(timeit.repeat(old, number=number, repeat=3)) / number
+        print(f"{count:8} {op:8} {t_old * 1e3:10.3f}ms {t_new * 1e3:10.3f}ms")
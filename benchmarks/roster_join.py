@@ -0,0 +1,106 @@
+# Measures the throughput of anaconda_ident.roster: the rate at which
+# rosters are hashed, in values per second, and at which the resulting
+# table is joined against parsed log records, in records per second:
+#
+#   python benchmarks/roster_join.py [--users 80000] [--hosts 200000]
+#       [--records 2000000] [--jobs 1,2,4,...]
+#
+# The rosters hold generated usernames, hostnames, and a few hundred
+# environment names. tokens.hash_string, one value at a time, is the
+# baseline for hashing; hash_values, and build_table with each number
+# of processes, follow. The records are generated as a client with the
+# fullhash token config would send them: a user, one of their hosts,
+# and an environment per session, with one in ten from outside the
+# rosters, so that their hashes are not found.
+
+import argparse
+import os
+import random
+import time
+
+from anaconda_ident import logparse, roster
+from anaconda_ident.tokens import hash_string
+
+PEPPER = b"benchmark-pepper"
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _baseline(entries):
+    return [hash_string(kind, value, PEPPER) for kind, value in entries]
+
+
+def _records(rnd, users, hosts, envs, count):
+    result = []
+    while len(result) < count:
+        user, host, env = rnd.choice(users), rnd.choice(hosts), rnd.choice(envs)
+        if rnd.random() < 0.1:
+            user = "unknown%d" % rnd.randrange(1 << 30)
+        hashes = roster.hash_values("username", [user], PEPPER)
+        hashes += roster.hash_values("hostname", [host], PEPPER)
+        hashes += roster.hash_values("environment", [env], PEPPER)
+        record = logparse.TokenRecord(*((None,) * len(logparse.FIELDS)))._replace(
+            aau="0.4.4", U=hashes[0], H=hashes[1], N=hashes[2]
+        )
+        # Each session repeats the same record a few times
+        result.extend([record] * rnd.randint(2, 12))
+    return result[:count]
+
+
+def _join(records, table):
+    count = 0
+    for _ in roster.dehash(records, table):
+        count += 1
+    return count
+
+
+def _jobs(value):
+    return [int(j) for j in value.split(",")]
+
+
+def main():
+    ncpu = os.cpu_count() or 1
+    p = argparse.ArgumentParser()
+    p.add_argument("--users", type=int, default=80000)
+    p.add_argument("--hosts", type=int, default=200000)
+    p.add_argument("--records", type=int, default=2000000)
+    p.add_argument(
+        "--jobs",
+        type=_jobs,
+        default=[j for j in (1, 2, 4, 8, 16, 32, 64) if j < ncpu] + [ncpu],
+        help="A comma-separated list of process counts. Defaults to powers "
+        "of two up to the number of CPUs.",
+    )
+    args = p.parse_args()
+
+    rnd = random.Random(0)
+    users = ["user%06d" % n for n in range(args.users)]
+    hosts = ["host-%06d.example.com" % n for n in range(args.hosts)]
+    envs = ["base"] + ["env%03d" % n for n in range(300)]
+    entries = [("username", v) for v in users]
+    entries += [("hostname", v) for v in hosts]
+    entries += [("environment", v) for v in envs]
+    print(f"{len(entries):,d} roster values; {ncpu} CPUs")
+    elapsed, _ = _timed(_baseline, entries)
+    print(f"hash_string: {len(entries) / elapsed:12,.0f} values/s")
+    elapsed, _ = _timed(roster.hash_values, "username", users, PEPPER)
+    print(f"hash_values: {len(users) / elapsed:12,.0f} values/s")
+    for jobs in args.jobs:
+        elapsed, table = _timed(roster.build_table, entries, PEPPER, jobs)
+        print(f"build_table, {jobs:2} jobs: {len(entries) / elapsed:12,.0f} values/s")
+
+    records = _records(rnd, users, hosts, envs, args.records)
+    elapsed, count = _timed(_join, records, table)
+    print(f"dehash: {count / elapsed:12,.0f} records/s")
+    # With a distinct session token in each, every record is joined afresh
+    records = [r._replace(s=str(n)) for n, r in enumerate(records)]
+    elapsed, count = _timed(_join, records, table)
+    print(f"dehash, distinct records: {count / elapsed:12,.0f} records/s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,173 @@
+# Measures anaconda_ident.store: the rate at which access logs are
+# ingested into a database, in lines per second, and the time taken by
+# typical queries against it, in milliseconds:
+#
+#   python benchmarks/store_ingest.py [--lines 2000000] [--days 30]
+#       [--path FILE] [--jobs 1,2,4,...]
+#
+# The log, in the combined log format, is written to FILE if given,
+# and reused if it already exists; otherwise, to a temporary file. It
+# spans the given number of days, in time order. Each simulated conda
+# command issues a handful of requests with the same user agent, from
+# one of 5,000 users on one of their hosts, in one of 50 environments
+# and 200 organizations; one line in four comes from some other
+# client. The time to parse the log without storing it provides a
+# baseline. Each number of processes ingests into a new database.
+
+import argparse
+import os
+import random
+import tempfile
+import time
+from datetime import date, timedelta
+
+from anaconda_ident import logparse, store
+
+LINE = (
+    '10.%d.%d.%d - - [%s] "GET /pkgs/main/linux-64/repodata.json HTTP/1.1" '
+    '200 %d "-" "%s"\n'
+)
+CONDA = "conda/24.9.2 requests/2.32.3 CPython/3.12.7 Linux/6.8.0"
+OTHERS = ("pip/24.2 CPython/3.12.7", "curl/8.9.1", "Mozilla/5.0 (X11; Linux x86_64)")
+START = date(2026, 9, 1)
+
+
+def generate(path, count, days, seed=0):
+    rnd = random.Random(seed)
+    orgs = ["org%03d" % n for n in range(200)]
+    envs = ["base"] + ["env%02d" % n for n in range(49)]
+    # Each user has a client token for each of their hosts
+    users = [
+        ("user%04d" % n, ["host%04d-%d" % (n, k) for k in range(3)], rnd.choice(orgs))
+        for n in range(5000)
+    ]
+    seconds = days * 86400
+    written = 0
+    with open(path, "w") as fp:
+        while written < count:
+            user, hosts, org = rnd.choice(users)
+            host = rnd.choice(hosts)
+            env = rnd.choice(envs)
+            agent = (
+                f"{CONDA} aau/0.4.4 aid/0.5.1 c/client-{host} s/session{written} "
+                f"e/{env}-{host} u/{user} h/{host} n/{env} o/{org}"
+            )
+            offset = written * seconds // count
+            when = START + timedelta(days=offset // 86400)
+            stamp = when.strftime("%d/%b/%Y") + ":%02d:%02d:%02d +0000" % (
+                offset // 3600 % 24,
+                offset // 60 % 60,
+                offset % 60,
+            )
+            lines = []
+            for _ in range(rnd.randint(2, 12)):
+                ua = rnd.choice(OTHERS) if rnd.random() < 0.25 else agent
+                ip = (rnd.randrange(256), rnd.randrange(256), rnd.randrange(256))
+                lines.append(LINE % (ip + (stamp, rnd.randrange(1 << 24), ua)))
+            fp.write("".join(lines))
+            written += len(lines)
+
+
+def _timed(func, *args):
+    start = time.perf_counter()
+    result = func(*args)
+    return time.perf_counter() - start, result
+
+
+def _parse(path):
+    count = 0
+    with logparse.open_log(path) as fp:
+        for _ in store.timed_records(fp):
+            count += 1
+    return count
+
+
+def _ingest(path, dpath, jobs):
+    with store.Store(dpath) as db:
+        return store.ingest(db, [path], jobs)
+
+
+def _jobs(value):
+    return [int(j) for j in value.split(",")]
+
+
+def main():
+    ncpu = os.cpu_count() or 1
+    p = argparse.ArgumentParser()
+    p.add_argument("--lines", type=int, default=2000000)
+    p.add_argument("--days", type=int, default=30)
+    p.add_argument("--path")
+    p.add_argument(
+        "--jobs",
+        type=_jobs,
+        default=[j for j in (1, 2, 4, 8, 16, 32, 64) if j < ncpu] + [ncpu],
+        help="A comma-separated list of process counts. Defaults to powers "
+        "of two up to the number of CPUs.",
+    )
+    args = p.parse_args()
+
+    with tempfile.TemporaryDirectory() as tdir:
+        path = args.path or os.path.join(tdir, "access.log")
+        if not os.path.exists(path):
+            print(f"Generating {args.lines:,d} line log: {path}")
+            generate(path, args.lines, args.days)
+        with open(path, "rb") as fp:
+            lines = sum(1 for _ in fp)
+        print(f"{lines:,d} lines; {ncpu} CPUs")
+        elapsed, count = _timed(_parse, path)
+        print(f"parse only: {lines / elapsed:12,.0f} lines/s; {count:,d} requests")
+        for jobs in args.jobs:
+            dpath = os.path.join(tdir, f"store-{jobs}.db")
+            elapsed, count = _timed(_ingest, path, dpath, jobs)
+            print(f"ingest, {jobs:2} jobs: {lines / elapsed:12,.0f} lines/s")
+        size = sum(
+            os.path.getsize(dpath + suffix)
+            for suffix in ("", "-wal")
+            if os.path.exists(dpath + suffix)
+        )
+        print(f"database: {size / 1e6:,.1f} MB")
+
+        last = START + timedelta(days=args.days - 1)
+        week = last - timedelta(days=6)
+        queries = (
+            (
+                "hosts in an org using an environment, last week",
+                "hosts",
+                "org007",
+                None,
+                "env07",
+                week,
+            ),
+            ("users in an org, last week", "users", "org007", None, None, week),
+            (
+                "environments of a host, all time",
+                "environments",
+                None,
+                "host0042-1",
+                None,
+                None,
+            ),
+            ("requests per day in an org", "days", "org007", None, None, None),
+            ("requests per hour, last day", "hours", None, None, None, last),
+            (
+                "most active organizations, last week",
+                "organizations",
+                None,
+                None,
+                None,
+                week,
+            ),
+        )
+        with store.Store(dpath) as db:
+            for label, what, org, host, env, since in queries:
+                db.query(what, org=org, host=host, env=env, since=since)
+                runs = 20
+                start = time.perf_counter()
+                for _ in range(runs):
+                    results = db.query(what, org=org, host=host, env=env, since=since)
+                elapsed = (time.perf_counter() - start) / runs
+                print(f"{label}: {elapsed * 1000:8.2f} ms, {len(results):,d} results")
+
+
+if __name__ == "__main__":
+    main()
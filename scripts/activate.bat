@@ -1 +1,12 @@
-@python -m anaconda_ident.install --verify --quiet
+@setlocal
+@rem anaconda_ident.install --verify leaves a stamp listing the size of
+@rem each file it depends upon. If none of those sizes has changed,
+@rem there is no need to start Python at all.
+@set "_aid_stamp=%CONDA_PREFIX%\etc\anaconda_ident.stamp"
+@set "_aid_valid="
+@if exist "%_aid_stamp%" set "_aid_valid=yes"
+@if defined _aid_valid for /f "usebackq eol=# tokens=1,*" %%A in ("%_aid_stamp%") do @(
+  if not exist "%%B" (set "_aid_valid=") else if not "%%~zB"=="%%A" set "_aid_valid="
+)
+@if not defined _aid_valid python -m anaconda_ident.install --verify --quiet
+@endlocal
@@ -1,3 +1,22 @@
 #!/bin/sh
 
-python -m anaconda_ident.install --verify --quiet
+# anaconda_ident.install --verify leaves a stamp listing each file it
+# depends upon. If all of them still exist, and none has been modified
+# since, there is no need to start Python at all. Only shell builtins
+# are used, so the check costs no process launches either; the sizes
+# in the stamp are for activate.bat, which cannot compare times.
+_aid_stamp="${CONDA_PREFIX:-}/etc/anaconda_ident.stamp"
+_aid_valid=
+if [ -f "$_aid_stamp" ]; then
+  _aid_valid=yes
+  # shellcheck disable=SC2094,SC3013
+  while read -r _aid_size _aid_path; do
+    case $_aid_size in '#'*) continue ;; esac
+    if [ ! -f "$_aid_path" ] || [ "$_aid_path" -nt "$_aid_stamp" ]; then
+      _aid_valid=
+      break
+    fi
+  done <"$_aid_stamp"
+fi
+[ -n "$_aid_valid" ] || python -m anaconda_ident.install --verify --quiet
+unset _aid_stamp _aid_valid _aid_size _aid_path
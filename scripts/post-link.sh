@@ -3,4 +3,4 @@
 pfx=${CONDA_PREFIX:-${PREFIX:-}}
 pbin="${pfx}/python.exe"
 [ -f "${pbin}" ] || pbin="${pfx}/bin/python"
-"${pbin}" -m anaconda_ident.install --verify --quiet >>"${pfx}/.messages.txt" 2>&1
+"${pbin}" -m anaconda_ident.install --verify --precompute --quiet >>"${pfx}/.messages.txt" 2>&1
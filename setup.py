@@ -19,6 +19,10 @@ setup(
             "anaconda-ident = anaconda_ident.install:main",
             "anaconda-keymgr = anaconda_ident.keymgr:main",
             "anaconda-ident-hash = anaconda_ident.tokens:main",
+            "anaconda-ident-logs = anaconda_ident.logparse:main",
+            "anaconda-ident-report = anaconda_ident.report:main",
+            "anaconda-ident-dehash = anaconda_ident.roster:main",
+            "anaconda-ident-query = anaconda_ident.store:main",
         ],
         "conda": ["anaconda-ident-plugin = anaconda_ident.plugin"],
     },
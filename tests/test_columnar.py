@@ -0,0 +1,131 @@
+from anaconda_ident import columnar
+from anaconda_ident.columnar import TokenBatch
+from anaconda_ident.logparse import TokenRecord, parse_line, parse_lines
+
+AGENT = b'"GET /" 200 1 "-" "conda/24.1.2 aau/0.4.3 c/c%d s/s%d u/%s h/%s n/%s o/%s"'
+
+
+def _lines(count):
+    lines = []
+    for n in range(count):
+        user = b"user%d" % (n % 4)
+        host = b"host%d" % (n % 7)
+        env = b"ml-gpu" if n % 5 == 0 else b"base"
+        org = b"acme" if n % 2 else b"initech"
+        lines.append(AGENT % (n % 7, n // 3, user, host, env, org))
+        if n % 10 == 0:
+            lines.append(b'"GET /" 200 1 "-" "conda/24.1.2 aau/0.4.3 o/acme o/beta"')
+    return lines
+
+
+def test_batch():
+    lines = _lines(100)
+    records = list(parse_lines(lines))
+    batch = TokenBatch.from_records(records)
+    assert len(batch) == len(records) == 110
+    assert list(batch) == records
+    assert batch[0] == records[0] and batch[-1] == records[-1]
+    assert batch.columns["o"].values == [
+        None,
+        ("initech",),
+        ("acme", "beta"),
+        ("acme",),
+    ]
+    assert batch.columns["u"].codes.typecode == "B"
+    assert batch.nbytes == 110 * 13
+    assert batch.distinct("u") == ["user0", "user1", "user2", "user3"]
+    assert batch.distinct("aid") == []
+    assert batch.group_by("o") == {
+        ("initech",): 50,
+        ("acme", "beta"): 10,
+        ("acme",): 50,
+    }
+    assert batch.group_by(("o", "n"))[(("acme",), "ml-gpu")] == 10
+    assert batch.group_by("o", distinct="h") == {("initech",): 7, ("acme",): 7}
+    assert batch.group_by("n", distinct="u") == {"ml-gpu": 4, "base": 4}
+    # Filtered batches share the dictionaries of the original
+    subset = batch.where(o=("acme",), n="ml-gpu")
+    assert len(subset) == 10
+    assert list(subset) == [r for r in records if r.o == ("acme",) and r.n == "ml-gpu"]
+    assert subset.distinct("u") == ["user1", "user3"]
+    acme = batch.where(o=("acme",))
+    hosts = ["host1", "host3", "host5", "host0", "host2", "host4", "host6"]
+    assert acme.distinct("h") == hosts
+    assert subset.columns["u"].values is batch.columns["u"].values
+    assert len(batch.where(u=None)) == 10
+    assert len(batch.where(u="nobody")) == 0
+    # A subset of the fields
+    hosts = TokenBatch.from_records(records, fields=("h",))
+    assert hosts[2] == TokenRecord(*[None] * 6, "host1", *[None] * 6)
+    hosts.extend(records)
+    assert len(hosts) == 220 and hosts.nbytes == 220
+    assert hosts.group_by("h")["host3"] == 28
+
+
+def test_widen():
+    batch = TokenBatch(fields=("s", "u"))
+    batch.extend(
+        parse_line(b'"conda/24.1.2 aau/0.4.3 s/s%d u/u"' % n) for n in range(70000)
+    )
+    assert batch.columns["s"].codes.typecode == "I"
+    assert batch.columns["u"].codes.typecode == "B"
+    assert len(batch.distinct("s")) == 70000
+    assert batch[69999].s == "s69999"
+    assert batch.group_by("u", distinct="s") == {"u": 70000}
+
+
+def test_numpy():
+    import pytest
+
+    numpy = pytest.importorskip("numpy")
+    batch = TokenBatch.from_records(parse_lines(_lines(100)))
+    arrays = batch.to_numpy()
+    assert arrays["u"].dtype == numpy.uint8 and len(arrays["u"]) == 110
+    assert numpy.shares_memory(arrays["u"], batch.columns["u"].to_numpy())
+    assert batch.columns["u"].values[arrays["u"][1]] == "user1"
+
+
+def _queries(batch):
+    subset = batch.where(o=("acme",), n="ml-gpu")
+    return (
+        batch.group_by("o"),
+        batch.group_by(("o", "n")),
+        batch.group_by("o", distinct="h"),
+        batch.group_by("n", distinct="u"),
+        list(subset),
+        subset.distinct("u"),
+        len(batch.where(u=None)),
+        len(batch.where(u="nobody")),
+        batch.distinct("u"),
+        batch.distinct("aid"),
+        batch.where(o=("acme",)).distinct("h"),
+    )
+
+
+def test_numpy_matches_pure():
+    import pytest
+
+    pytest.importorskip("numpy")
+    narrow = TokenBatch.from_records(parse_lines(_lines(100)))
+    wide = TokenBatch(fields=("s", "u"))
+    wide.extend(
+        parse_line(b'"conda/24.1.2 s/s%d u/u%d"' % (n, n % 3)) for n in range(70000)
+    )
+    expected = _queries(narrow), wide.group_by("u", distinct="s"), wide.distinct("u")
+    old_numpy, columnar._numpy = columnar._numpy, lambda: None
+    try:
+        pure = _queries(narrow), wide.group_by("u", distinct="s"), wide.distinct("u")
+    finally:
+        columnar._numpy = old_numpy
+    assert pure == expected
+
+
+if __name__ == "__main__":
+    test_batch()
+    test_widen()
+    if columnar._numpy() is None:
+        print("NumPy not installed; skipping the NumPy tests")
+    else:
+        test_numpy()
+        test_numpy_matches_pure()
+    print("OK")
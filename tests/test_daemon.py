@@ -0,0 +1,54 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+
+from anaconda_ident import daemon, patch
+
+
+def _wait_for(path, timeout=5):
+    deadline = time.monotonic() + timeout
+    while not os.path.exists(path):
+        assert time.monotonic() < deadline, "daemon did not start"
+        time.sleep(0.01)
+
+
+def test_private_dir():
+    with tempfile.TemporaryDirectory() as tdir:
+        os.chmod(tdir, 0o755)
+        try:
+            daemon._private_dir(tdir)
+            assert False, "expected PermissionError"
+        except PermissionError:
+            pass
+        os.chmod(tdir, 0o700)
+        assert daemon._private_dir(tdir) == tdir
+
+
+def test_daemon_tokens():
+    config = "fullhash:myorg"
+    plan = patch.token_plan(config)
+    with tempfile.TemporaryDirectory() as tdir:
+        os.chmod(tdir, 0o700)
+        os.environ["XDG_RUNTIME_DIR"] = tdir
+        try:
+            assert daemon.request_tokens(config, spawn=False) is None
+            thread = threading.Thread(target=daemon.serve, args=(0.5,))
+            thread.start()
+            _wait_for(daemon.socket_path())
+            assert not daemon.serve(0.5)
+            values = daemon.request_tokens(config, spawn=False)
+            assert set(values) == set(plan.static) - set(daemon.LOCAL_CODES)
+            local, _ = patch._resolve_tokens(plan, plan.static, sys.prefix, {})
+            assert all(local[c] == v for c, v in values.items())
+            thread.join()
+            assert not os.path.exists(daemon.socket_path())
+        finally:
+            del os.environ["XDG_RUNTIME_DIR"]
+
+
+if __name__ == "__main__":
+    test_private_dir()
+    test_daemon_tokens()
+    print("OK")
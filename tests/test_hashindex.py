@@ -0,0 +1,130 @@
+import json
+import os
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from datetime import date
+from io import StringIO
+
+from anaconda_ident import hashindex, roster
+from anaconda_ident.tokens import decode_pepper, hash_string
+
+PEPPER = "c2VjcmV0LXBlcHBlcg"
+
+
+def test_index():
+    pepper = decode_pepper(PEPPER)
+    users = ["user%d" % n for n in range(1000)] + ["ünïcode", "x"]
+    hosts = ["host%d" % n for n in range(300)]
+    with tempfile.TemporaryDirectory() as tdir:
+        path = os.path.join(tdir, "hashes.idx")
+        entries = [("username", v) for v in users[:600]]
+        entries += [("hostname", v) for v in hosts]
+        assert hashindex.update_index(path, entries, pepper) == 900
+        # New values are merged with the old, once each
+        entries = [("username", v) for v in users[400:]]
+        entries += [("environment", "base")]
+        assert hashindex.update_index(path, entries, pepper, jobs=2) == 403
+        with hashindex.HashIndex(path, pepper) as index:
+            assert index.counts() == {
+                "username": len(users),
+                "hostname": len(hosts),
+                "environment": 1,
+            }
+            for kind, values in (("username", users), ("hostname", hosts)):
+                hashed = roster.KINDS[kind][0]
+                for value in values:
+                    token = hash_string(kind, value, pepper)
+                    assert index[hashed].get(token) == value
+                    # Each kind is searched separately
+                    assert index["N"].get(token) is None
+            assert index["N"].get(hash_string("environment", "base", pepper))
+            assert index["U"].get(hash_string("username", "nobody", pepper)) is None
+            assert index["U"].get("not-a-hash") is None
+        try:
+            hashindex.HashIndex(path, b"other")
+            assert False, "Expected an exception"
+        except ValueError:
+            pass
+
+
+def test_peppers():
+    old = roster.Pepper(b"old-pepper", None, date(2026, 10, 31))
+    new = roster.Pepper(b"new-pepper", date(2026, 10, 1), None)
+    users = ["user%d" % n for n in range(500)]
+    entries = [("username", v) for v in users]
+    # Every value is hashed with every pepper, in one pass
+    batches = list(roster.hash_roster(entries, [old.value, new.value]))
+    assert sorted(num for _, num, _, _ in batches) == [0, 1]
+    table = roster.build_table(entries, [old.value, new.value])
+    assert len(table["U"]) == 1000
+    with tempfile.TemporaryDirectory() as tdir:
+        path = os.path.join(tdir, "hashes.idx")
+        assert hashindex.update_index(path, entries[:100], [old, new]) == 200
+        # A value already hashed with one pepper is added for another
+        third = b"third-pepper"
+        assert hashindex.update_index(path, entries, [new, third]) == 400 + 500
+        hashed = {
+            p: [hash_string("username", v, p) for v in users[:100]]
+            for p in (old.value, new.value, third)
+        }
+        with hashindex.HashIndex(path, [old.value, third]) as index:
+            assert [p.start for p in index.peppers] == [None, new.start, None]
+            for tokens in hashed.values():
+                assert [index["U"].get(t) for t in tokens] == users[:100]
+        # Hashes computed with peppers not in use at the time are not found
+        for when, expected in (
+            (date(2026, 9, 1), (old.value, third)),
+            (date(2026, 10, 15), (old.value, new.value, third)),
+            (date(2026, 11, 1), (new.value, third)),
+        ):
+            with hashindex.HashIndex(path, when=when) as index:
+                for pepper, tokens in hashed.items():
+                    found = index["U"].get(tokens[0]) is not None
+                    assert found == (pepper in expected), (when, pepper)
+
+
+def test_index_cli():
+    with tempfile.TemporaryDirectory() as tdir:
+        rpath = os.path.join(tdir, "users.txt")
+        with open(rpath, "w") as fp:
+            fp.write("alice\nbob\n")
+        ipath = os.path.join(tdir, "hashes.idx")
+        args = [ipath, "--roster", "username=" + rpath, "--pepper", PEPPER]
+        out = StringIO()
+        with redirect_stdout(out), redirect_stderr(StringIO()):
+            assert hashindex.main(args + ["--pepper", "c2Vjb25k"]) == 0
+            assert out.getvalue() == (
+                f"{ipath}: 2 peppers; digests: 4 username, 0 hostname, "
+                "0 environment; 4 added\n"
+            )
+            try:
+                hashindex.main(args + ["--pepper", "x:2026-02-01:2026-01-01"])
+                assert False, "Expected an exception"
+            except SystemExit:
+                pass
+        pepper = decode_pepper(PEPPER)
+        lpath = os.path.join(tdir, "access.log")
+        with open(lpath, "w") as fp:
+            for user in ("alice", "carol"):
+                token = hash_string("username", user, pepper)
+                fp.write(f'"GET / HTTP/1.1" 200 1 "-" "conda/24.1 aau/0.4 U/{token}"\n')
+        opath = os.path.join(tdir, "out.ndjson")
+        roster.main([lpath, "--index", ipath, "--fields", "u", "-o", opath])
+        with open(opath) as fp:
+            assert [json.loads(line) for line in fp] == [{"u": "alice"}, {}]
+        # The rosters are searched first, then the index
+        cpath = os.path.join(tdir, "more.txt")
+        with open(cpath, "w") as fp:
+            fp.write("carol\n")
+        args = [lpath, "-i", ipath, "-r", "username=" + cpath, "--pepper", PEPPER]
+        roster.main(args + ["--fields", "u", "-o", opath])
+        with open(opath) as fp:
+            users = [json.loads(line)["u"] for line in fp]
+        assert users == ["alice", "carol"]
+
+
+if __name__ == "__main__":
+    test_index()
+    test_peppers()
+    test_index_cli()
+    print("OK")
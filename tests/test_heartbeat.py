@@ -0,0 +1,125 @@
+import os
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from anaconda_anon_usage import patch as aau_patch
+from conda.activate import PosixActivator
+from conda.base.context import context
+
+from anaconda_ident import heartbeat, patch
+
+HEARTBEATS = []
+
+
+class Handler(BaseHTTPRequestHandler):
+    def do_HEAD(self):
+        HEARTBEATS.append(self.path)
+        self.send_response(404)
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _activate(count):
+    del HEARTBEATS[:]
+    for _ in range(count):
+        PosixActivator(["activate", sys.prefix]).execute()
+    # The heartbeat is sent from a background thread
+    for t in threading.enumerate():
+        if t is not threading.current_thread() and not t.daemon:
+            t.join()
+    return len(HEARTBEATS)
+
+
+def test_heartbeat_due():
+    with tempfile.TemporaryDirectory() as tdir:
+        old_dir, heartbeat.CACHE_DIR = heartbeat.CACHE_DIR, tdir
+        try:
+            assert heartbeat.heartbeat_due("/env1", 0.2)
+            assert not heartbeat.heartbeat_due("/env1", 0.2)
+            assert heartbeat.heartbeat_due("/env2", 0.2)
+            time.sleep(0.3)
+            assert heartbeat.heartbeat_due("/env1", 0.2)
+            # A concurrent sender holds the lock
+            lpath = heartbeat._timestamp_path("/env3") + ".lock"
+            open(lpath, "w").close()
+            assert not heartbeat.heartbeat_due("/env3", 0.2)
+        finally:
+            heartbeat.CACHE_DIR = old_dir
+
+
+def test_heartbeat_coalesced():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    env = {
+        "CONDA_ANACONDA_HEARTBEAT": url,
+        "NO_PROXY": "127.0.0.1",
+    }
+    os.environ.update(env)
+    with tempfile.TemporaryDirectory() as tdir:
+        old_dir, heartbeat.CACHE_DIR = heartbeat.CACHE_DIR, tdir
+        try:
+            aau_patch.main(plugin=True, command="activate")
+            patch.defer("activate")
+            context.__init__()
+            assert _activate(3) == 3
+            os.environ["CONDA_ANACONDA_HEARTBEAT_INTERVAL"] = "3600"
+            context.__init__()
+            assert _activate(5) == 1
+            assert _activate(5) == 0
+        finally:
+            heartbeat.CACHE_DIR = old_dir
+            for k in list(env) + ["CONDA_ANACONDA_HEARTBEAT_INTERVAL"]:
+                os.environ.pop(k, None)
+            context.__init__()
+            server.shutdown()
+
+
+def test_background_queue():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_address[1]}/"
+    os.environ["NO_PROXY"] = "127.0.0.1"
+    with tempfile.TemporaryDirectory() as tdir:
+        old_dir, heartbeat.QUEUE_DIR = heartbeat.QUEUE_DIR, tdir
+        old_popen = heartbeat.subprocess.Popen
+        try:
+            del HEARTBEATS[:]
+            for _ in range(heartbeat.QUEUE_LIMIT):
+                assert heartbeat.queue_heartbeat(sys.prefix, url, "", spawn=False)
+            assert not heartbeat.queue_heartbeat(sys.prefix, url, "", spawn=False)
+            # Another sender holds the lock
+            open(heartbeat._sender_lock(), "w").close()
+            assert heartbeat.send_queued() == 0
+            os.unlink(heartbeat._sender_lock())
+            assert heartbeat.send_queued() == heartbeat.QUEUE_LIMIT
+            assert len(HEARTBEATS) == heartbeat.QUEUE_LIMIT
+            assert not os.listdir(tdir)
+            # A burst of activations starts a single sender, which is
+            # handed the lock taken for it
+            started = []
+            heartbeat.subprocess.Popen = lambda args, **kw: started.append(args)
+            for _ in range(3):
+                assert heartbeat.queue_heartbeat(sys.prefix, url, "")
+            assert len(started) == 1 and started[0][-1] == "--locked"
+            assert os.path.exists(heartbeat._sender_lock())
+            assert heartbeat.send_queued() == 0
+            assert heartbeat.send_queued(locked=True) == 3
+            assert not os.listdir(tdir)
+        finally:
+            heartbeat.subprocess.Popen = old_popen
+            heartbeat.QUEUE_DIR = old_dir
+            os.environ.pop("NO_PROXY", None)
+            server.shutdown()
+
+
+if __name__ == "__main__":
+    test_heartbeat_due()
+    test_heartbeat_coalesced()
+    test_background_queue()
+    print("OK")
@@ -0,0 +1,38 @@
+import subprocess
+import sys
+
+# Modules that the activation-time verification must not load
+HEAVY_MODULES = ("conda", "anaconda_anon_usage")
+
+
+def imported_modules(*args):
+    proc = subprocess.run(
+        [sys.executable, "-X", "importtime"] + list(args),
+        check=False,
+        capture_output=True,
+        text=True,
+    )
+    # import time: self [us] | cumulative | imported package
+    result = {}
+    for line in proc.stderr.splitlines():
+        if line.startswith("import time:") and "|" in line:
+            _, cumul, name = line.split("|")
+            name = name.strip()
+            if cumul.strip().isdigit():
+                result[name] = int(cumul.strip())
+    return proc.returncode, result
+
+
+def test_verify_importtime():
+    code, modules = imported_modules(
+        "-m", "anaconda_ident.install", "--verify", "--quiet"
+    )
+    assert code == 0
+    assert "anaconda_ident" in modules
+    heavy = sorted(m for m in modules if m.split(".", 1)[0] in HEAVY_MODULES)
+    assert not heavy, "verify path imported: " + ", ".join(heavy)
+
+
+if __name__ == "__main__":
+    test_verify_importtime()
+    print("OK")
@@ -0,0 +1,197 @@
+import csv
+import json
+import os
+import tempfile
+
+from anaconda_ident import logparse
+
+UA = (
+    "conda/24.1.2 requests/2.31.0 CPython/3.11.7 Linux/6.5.0 glibc/2.35 "
+    "aau/0.4.3 aid/0.5.1 c/Xk3Tq9vA s/aB8dQwEr e/Zp0oLkJm u/alice h/build-01 "
+    "n/base o/acme o/other U/hashU H/hashH N/hashN"
+)
+COMBINED = (
+    '10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "GET /main/linux-64/repodata.json '
+    'HTTP/1.1" 200 12345 "-" "%s"\n'
+)
+LINES = [
+    # Combined log format
+    (COMBINED % UA).encode(),
+    # conda's own debug output, in its older and newer forms
+    ("> User-Agent: %s\r\n" % UA).encode(),
+    ("{'User-Agent': '%s', 'Accept': \"*/*\"}\n" % UA).encode(),
+    # JSON logs
+    (json.dumps({"status": 200, "user_agent": UA, "bytes": 1}) + "\n").encode(),
+]
+EXPECTED = logparse.TokenRecord(
+    aau="0.4.3",
+    aid="0.5.1",
+    c="Xk3Tq9vA",
+    s="aB8dQwEr",
+    e="Zp0oLkJm",
+    u="alice",
+    h="build-01",
+    n="base",
+    o=("acme", "other"),
+    m=None,
+    U="hashU",
+    H="hashH",
+    N="hashN",
+)
+
+
+def test_parse_line():
+    for line in LINES:
+        assert logparse.parse_line(line) == EXPECTED, line
+    # Only anaconda_anon_usage user agents are recognized
+    assert logparse.parse_line((COMBINED % "pip/23.0 c/x").encode()) is None
+    assert logparse.parse_line(b'"GET /xaau/1 HTTP/1.1" 404 0 "-" "curl/8.0"') is None
+    # The aau/ token is always first, but the others may vary
+    record = logparse.parse_line(b'"GET / HTTP/1.1" "conda/23.1 aau/0.2 m/a s/b m/c"')
+    assert record == logparse.TokenRecord(
+        "0.2",
+        None,
+        None,
+        "b",
+        None,
+        None,
+        None,
+        None,
+        None,
+        ("a", "c"),
+        None,
+        None,
+        None,
+    )
+
+
+def test_parse_lines():
+    other = (COMBINED % "pip/23.0").encode()
+    lines = [LINES[0], other, LINES[1], other, LINES[0].replace(b"alice", b"bob")]
+    records = list(logparse.parse_lines(lines))
+    assert [r.u for r in records] == ["alice", "alice", "bob"]
+    # The same user agent yields the same record, whatever the log format
+    assert records[0] is records[1]
+
+
+def test_logs_cli():
+    with tempfile.TemporaryDirectory() as tdir:
+        lpath = os.path.join(tdir, "access.log")
+        with open(lpath, "wb") as fp:
+            fp.writelines(LINES * 2)
+        opath = os.path.join(tdir, "out.ndjson")
+        logparse.main([lpath, "--output", opath])
+        with open(opath) as fp:
+            records = [json.loads(line) for line in fp]
+        assert len(records) == 2 * len(LINES)
+        expected = logparse.record_dict(EXPECTED)
+        assert all(r == expected for r in records)
+        assert expected["o"] == ["acme", "other"] and "m" not in expected
+        opath = os.path.join(tdir, "out.csv")
+        logparse.main([lpath, "--format", "csv", "--fields", "u,c,o,m", "-o", opath])
+        with open(opath, newline="") as fp:
+            rows = list(csv.reader(fp))
+        assert rows[0] == ["u", "c", "o", "m"]
+        assert rows[1:] == [["alice", "Xk3Tq9vA", "acme other", ""]] * 2 * len(LINES)
+
+
+def test_parallel():
+    with tempfile.TemporaryDirectory() as tdir:
+        lpath = os.path.join(tdir, "access.log")
+        with open(lpath, "wb") as fp:
+            for n in range(500):
+                fp.write(LINES[n % len(LINES)].replace(b"alice", b"user%d" % n))
+            # No trailing newline
+            fp.write(LINES[0].rstrip())
+        old_size, logparse.CHUNK_SIZE = logparse.CHUNK_SIZE, 1000
+        try:
+            ranges = logparse.chunk_ranges(lpath)
+            assert len(ranges) > 50
+            assert ranges[0][0] == 0 and ranges[-1][1] == os.path.getsize(lpath)
+            assert all(a[1] == b[0] for a, b in zip(ranges, ranges[1:]))
+            expected = list(logparse.parse_file(lpath))
+            assert len(expected) == 501
+            assert list(logparse.parse_file(lpath, jobs=3)) == expected
+            unordered = list(logparse.parse_files([lpath, lpath], 3, False))
+            assert sorted(unordered) == sorted(expected * 2)
+            opath = os.path.join(tdir, "out.ndjson")
+            logparse.main([lpath, "-j", "2", "-o", opath, "--fields", "u"])
+            with open(opath) as fp:
+                users = [json.loads(line)["u"] for line in fp]
+            assert users == [f"user{n}" for n in range(500)] + ["alice"]
+        finally:
+            logparse.CHUNK_SIZE = old_size
+
+
+def _echo(task):
+    yield task
+    yield task[::-1]
+
+
+def test_pool_stream():
+    # Tasks and results that each exceed the pipe buffer
+    tasks = [bytes([n]) * (1 << 20) for n in range(6)]
+    results = list(logparse._pool_stream(_echo, tasks, 2))
+    assert results == [r for t in tasks for r in (t, t[::-1])]
+
+
+def _compressors():
+    import bz2
+    import gzip
+    import lzma
+
+    result = {".gz": gzip.compress, ".bz2": bz2.compress, ".xz": lzma.compress}
+    try:
+        import zstandard
+
+        result[".zst"] = zstandard.ZstdCompressor().compress
+    except ImportError:
+        pass
+    return result
+
+
+def test_compressed():
+    with tempfile.TemporaryDirectory() as tdir:
+        data = b"".join(
+            LINES[n % len(LINES)].replace(b"alice", b"user%d" % n) for n in range(300)
+        )
+        paths = []
+        for ext, compress in _compressors().items():
+            # Rotated names, which do not reveal the compression
+            paths.append(os.path.join(tdir, "access.log.%d" % len(paths)))
+            with open(paths[-1], "wb") as fp:
+                fp.write(compress(data))
+            assert logparse.is_compressed(paths[-1])
+            records = list(logparse.parse_file(paths[-1]))
+            assert [r.u for r in records] == [f"user{n}" for n in range(300)], ext
+        paths.append(os.path.join(tdir, "access.log"))
+        with open(paths[-1], "wb") as fp:
+            fp.write(data)
+        assert not logparse.is_compressed(paths[-1])
+        expected = list(logparse.parse_files(paths))
+        assert len(expected) == 300 * len(paths)
+        old_size, logparse.BATCH_SIZE = logparse.BATCH_SIZE, 64
+        try:
+            assert list(logparse.parse_files(paths, jobs=2)) == expected
+            unordered = list(logparse.parse_files(paths, jobs=3, ordered=False))
+            assert sorted(unordered) == sorted(expected)
+        finally:
+            logparse.BATCH_SIZE = old_size
+        # Errors in the workers are raised in the parent
+        with open(paths[0], "r+b") as fp:
+            fp.truncate(os.path.getsize(paths[0]) // 2)
+        try:
+            list(logparse.parse_files(paths, jobs=2))
+            assert False, "Expected an exception"
+        except EOFError:
+            pass
+
+
+if __name__ == "__main__":
+    test_parse_line()
+    test_parse_lines()
+    test_logs_cli()
+    test_parallel()
+    test_pool_stream()
+    test_compressed()
+    print("OK")
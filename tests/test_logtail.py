@@ -0,0 +1,127 @@
+import gzip
+import json
+import os
+import shutil
+import tempfile
+
+from anaconda_ident import logparse, logtail
+
+LINE = '10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "GET / HTTP/1.1" 200 1 "-" "%s"\n'
+UA = "conda/24.1.2 aau/0.4.3 aid/0.5.1 c/client s/session u/%s o/acme"
+
+
+def _lines(*users):
+    return "".join(LINE % (UA % u) for u in users).encode()
+
+
+def _append(path, data):
+    with open(path, "ab") as fp:
+        fp.write(data)
+
+
+class _Logs:
+    def __enter__(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.log = os.path.join(self.tdir.name, "access.log")
+        self.ckpt = os.path.join(self.tdir.name, "state", "checkpoint.json")
+        self.out = os.path.join(self.tdir.name, "tokens.ndjson")
+        return self
+
+    def __exit__(self, *args):
+        self.tdir.cleanup()
+
+    def run(self):
+        # Returns the users written by this run
+        size = os.path.getsize(self.out) if os.path.exists(self.out) else 0
+        logparse.main([self.log, "--checkpoint", self.ckpt, "-o", self.out])
+        with open(self.out) as fp:
+            fp.seek(size)
+            return [json.loads(line)["u"] for line in fp]
+
+
+def test_incremental():
+    with _Logs() as logs:
+        _append(logs.log, _lines("a", "b") + b"not a conda request\n")
+        assert logs.run() == ["a", "b"]
+        assert logs.run() == []
+        # An incomplete line is left for the next run
+        data = _lines("c", "d")
+        _append(logs.log, data[:-10])
+        assert logs.run() == ["c"]
+        _append(logs.log, data[-10:])
+        assert logs.run() == ["d"]
+        # Only one process may use the checkpoint at a time
+        with logtail.Checkpoint(logs.ckpt):
+            try:
+                logtail.Checkpoint(logs.ckpt).__enter__()
+                assert False, "Expected the checkpoint to be locked"
+            except RuntimeError:
+                pass
+        assert not os.path.exists(logs.ckpt + ".lock")
+
+
+def test_rotation():
+    with _Logs() as logs:
+        _append(logs.log, _lines("a"))
+        assert logs.run() == ["a"]
+        # Renamed, with the lines written before and after the rename
+        _append(logs.log, _lines("b"))
+        os.rename(logs.log, logs.log + ".1")
+        _append(logs.log + ".1", _lines("c"))
+        _append(logs.log, _lines("d"))
+        assert logs.run() == ["b", "c", "d"]
+        # Copied, compressed, and truncated in place
+        _append(logs.log, _lines("e"))
+        with open(logs.log, "rb") as src, gzip.open(logs.log + ".2.gz", "wb") as dst:
+            shutil.copyfileobj(src, dst)
+        with open(logs.log, "wb") as fp:
+            fp.write(_lines("f", "g"))
+        assert logs.run() == ["e", "f", "g"]
+        # Truncated, with no copy to be found
+        with open(logs.log, "wb") as fp:
+            fp.write(_lines("h"))
+        assert logs.run() == ["h"]
+        # A compressed log is read once
+        os.unlink(logs.log)
+        with gzip.open(logs.log, "wb") as fp:
+            fp.write(_lines("i", "j"))
+        assert logs.run() == ["i", "j"]
+        assert logs.run() == []
+
+
+def test_exactly_once():
+    with _Logs() as logs:
+        _append(logs.log, _lines("a", "b"))
+        assert logs.run() == ["a", "b"]
+        # A run that is interrupted after writing output, but before
+        # saving the checkpoint, leaves uncommitted output behind
+        _append(logs.log, _lines("c"))
+        _append(logs.out, b'{"u":"c"}\n{"u":')
+        logparse.main([logs.log, "--checkpoint", logs.ckpt, "-o", logs.out])
+        with open(logs.out) as fp:
+            assert [json.loads(line)["u"] for line in fp] == ["a", "b", "c"]
+        # Commits within a run cover exactly the records written
+        old_count, logtail.COMMIT_RECORDS = logtail.COMMIT_RECORDS, 2
+        try:
+            _append(logs.log, _lines("d", "e", "f"))
+            checkpoint = logtail.Checkpoint(logs.ckpt)
+            with open(logs.out, "a") as fp:
+                saves = []
+                checkpoint.save = lambda: saves.append(
+                    (os.path.getsize(logs.out), checkpoint.files[logs.log].offset)
+                )
+                logtail.ingest([logs.log], checkpoint, fp)
+            with open(logs.out, "rb") as fp:
+                lines = fp.readlines()
+            # The first save follows the fifth record overall
+            assert saves[0] == (len(b"".join(lines[:5])), len(_lines(*"abcde")))
+            assert saves[-1] == (os.path.getsize(logs.out), len(_lines(*"abcdef")))
+        finally:
+            logtail.COMMIT_RECORDS = old_count
+
+
+if __name__ == "__main__":
+    test_incremental()
+    test_rotation()
+    test_exactly_once()
+    print("OK")
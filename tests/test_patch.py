@@ -0,0 +1,181 @@
+import json
+import os
+import platform
+import sys
+import tempfile
+import threading
+import time
+
+from anaconda_anon_usage import utils as aau_utils
+from conda.base.context import Context, context
+
+from anaconda_ident import cache, patch
+
+patch.main()
+context.__init__()
+
+
+def test_token_plan():
+    plan = patch.token_plan("fullhash:myorg")
+    assert plan.fmt == "cseaUHNom"
+    assert plan.org == "myorg"
+    assert plan.static == "csaUHom"
+    assert plan.per_prefix == "eN"
+    assert patch.token_plan("fullhash:myorg") is plan
+
+
+def test_per_prefix_user_agent():
+    os.environ["CONDA_ANACONDA_IDENT"] = "full"
+    context.__init__()
+    try:
+        with tempfile.TemporaryDirectory() as tdir:
+            agents = {}
+            for name in ("env1", "env2", "env1"):
+                pfx = os.path.join(tdir, name)
+                os.makedirs(os.path.join(pfx, "conda-meta"), exist_ok=True)
+                Context.checked_prefix = pfx
+                ua = context.user_agent
+                assert f" n/{name}" in ua
+                assert agents.setdefault(name, ua) == ua
+            assert agents["env1"] != agents["env2"]
+    finally:
+        Context.checked_prefix = None
+        del os.environ["CONDA_ANACONDA_IDENT"]
+        context.__init__()
+    assert not patch._token_strings and not patch._static_tokens
+
+
+def test_precomputed_suffix():
+    os.environ["CONDA_ANACONDA_IDENT"] = "fullhash:myorg"
+    old_path = cache.SUFFIX_PATH
+    try:
+        with tempfile.TemporaryDirectory() as tdir:
+            cache.SUFFIX_PATH = os.path.join(tdir, "suffix.json")
+            context.__init__()
+            expected = context.user_agent
+            assert patch.write_suffix()
+            plan = patch.token_plan(context.anaconda_ident)
+            values = cache.load_suffix(patch.suffix_key(plan))
+            assert set(values) == set(plan.static) & set(patch.SUFFIX_CODES)
+            assert "o" not in values
+            assert not cache.load_suffix(patch.suffix_key(patch.token_plan("full")))
+            # Reinitializing the context discards the static tokens
+            context.__init__()
+            assert not patch._static_tokens
+            assert context.user_agent == expected
+    finally:
+        cache.SUFFIX_PATH = old_path
+        del os.environ["CONDA_ANACONDA_IDENT"]
+        context.__init__()
+
+
+def test_suffix_org_token():
+    os.environ["CONDA_ANACONDA_IDENT"] = "fullhash:myorg"
+    old_path, old_xdg = cache.SUFFIX_PATH, os.environ.get("XDG_CONFIG_HOME")
+    try:
+        with tempfile.TemporaryDirectory() as tdir:
+            cache.SUFFIX_PATH = os.path.join(tdir, "suffix.json")
+            os.environ["XDG_CONFIG_HOME"] = tdir
+            os.makedirs(os.path.join(tdir, "conda"))
+            assert patch.write_suffix()
+            # An organization token deployed after the suffix was written;
+            # anaconda_anon_usage reads it once per process
+            with open(os.path.join(tdir, "conda", "org_token"), "w") as fp:
+                fp.write("neworg")
+            aau_utils.CACHE.clear()
+            context.__init__()
+            assert " o/neworg" in context.user_agent
+    finally:
+        cache.SUFFIX_PATH = old_path
+        del os.environ["CONDA_ANACONDA_IDENT"]
+        if old_xdg is None:
+            os.environ.pop("XDG_CONFIG_HOME", None)
+        else:
+            os.environ["XDG_CONFIG_HOME"] = old_xdg
+        aau_utils.CACHE.clear()
+        context.__init__()
+
+
+def test_identity_cache():
+    old_dir, old_ttl = cache.CACHE_DIR, cache.CACHE_TTL
+    old_node = platform.node
+    plan = patch.token_plan("full")
+    key = patch.identity_key(plan)
+    values = {"u": "alice", "h": "node1", "n": "base"}
+    try:
+        with tempfile.TemporaryDirectory() as tdir:
+            cache.CACHE_DIR, cache.CACHE_TTL = tdir, 60
+            cache.save_identity(tdir, key, values)
+            assert cache.load_identity(tdir, key) == values
+            # Another configuration
+            other = patch.identity_key(patch.token_plan("userhost"))
+            assert cache.load_identity(tdir, other) == {}
+            # Another host sharing the same home directory
+            platform.node = lambda: "node2"
+            assert patch.identity_key(plan) != key
+            assert cache.load_identity(tdir, key) == {}
+            platform.node = old_node
+            # Expired values are used only when asked for
+            fpath = cache._identity_path(tdir)
+            with open(fpath) as fp:
+                data = json.load(fp)
+            data["time"] -= 120
+            with open(fpath, "w") as fp:
+                json.dump(data, fp)
+            assert cache.load_identity(tdir, key) == {}
+            assert cache.load_identity(tdir, key, expired=True) == values
+            # The values resolved for a prefix are saved under the key
+            pfx = os.path.join(tdir, "env1")
+            os.makedirs(os.path.join(pfx, "conda-meta"))
+            patch._static_tokens.clear()
+            patch.plan_token_string(plan, pfx)
+            saved = cache.load_identity(pfx, key)
+            assert saved["n"] == "env1" and saved["h"] == platform.node()
+    finally:
+        cache.CACHE_DIR, cache.CACHE_TTL = old_dir, old_ttl
+        platform.node = old_node
+        patch._static_tokens.clear()
+
+
+def test_lookup_deadline():
+    release = threading.Event()
+    calls = []
+
+    def slow_hostname(plan, pfx):
+        calls.append(pfx)
+        release.wait(10)
+        return "slowhost"
+
+    old_resolver, old_timeout = patch._token_resolvers["h"], patch.TOKEN_TIMEOUT
+    patch._token_resolvers["h"] = slow_hostname
+    patch.TOKEN_TIMEOUT = 0.05
+    plan = patch.token_plan("userhost")
+    try:
+        start = time.monotonic()
+        values, late = patch._resolve_tokens(plan, "uh", sys.prefix, {})
+        assert time.monotonic() - start < 1
+        assert late == ["h"] and values["u"] and "h" not in values
+        # The stuck lookup is not started again
+        values, late = patch._resolve_tokens(plan, "uh", sys.prefix, {})
+        assert late == ["h"] and len(calls) == 1
+        # Once it finishes, its result is used
+        release.set()
+        patch._lookups[(plan, "h")].result(1)
+        values, late = patch._resolve_tokens(plan, "uh", sys.prefix, {})
+        assert not late and values["h"] == "slowhost" and len(calls) == 1
+        assert len(patch._lookup_threads) <= patch.LOOKUP_THREADS
+    finally:
+        release.set()
+        patch._token_resolvers["h"] = old_resolver
+        patch.TOKEN_TIMEOUT = old_timeout
+        patch._lookup_cache_clear()
+
+
+if __name__ == "__main__":
+    test_token_plan()
+    test_per_prefix_user_agent()
+    test_precomputed_suffix()
+    test_suffix_org_token()
+    test_identity_cache()
+    test_lookup_deadline()
+    print("OK")
@@ -0,0 +1,153 @@
+import json
+import os
+import random
+import tempfile
+from contextlib import redirect_stderr, redirect_stdout
+from io import StringIO
+
+from anaconda_ident import logparse, report
+from anaconda_ident.sketches import HyperLogLog, TopK
+
+COMBINED = (
+    '10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "GET /main/noarch/repodata.json '
+    'HTTP/1.1" 200 12345 "-" "conda/24.1.2 aau/0.4.3 %s"\n'
+)
+
+
+def _line(n, org="acme"):
+    # User n, on one of a tenth as many hosts, in its own session
+    tokens = f"c/c{n % 7} s/s{n} e/e{n % 3} u/user{n} h/host{n // 10}"
+    if org:
+        tokens += f" o/{org}"
+    return (COMBINED % tokens).encode()
+
+
+def test_hyperloglog():
+    values = [f"value{n}" for n in range(200000)]
+    a, b = HyperLogLog(), HyperLogLog()
+    a.update(values[:120000])
+    b.update(values[80000:])
+    assert abs(a.count() - 120000) < 120000 * 0.03
+    # Merged sketches count the union, not the sum
+    a.merge(b)
+    assert abs(a.count() - 200000) < 200000 * 0.03
+    assert (
+        HyperLogLog.from_dict(json.loads(json.dumps(a.to_dict()))).count() == a.count()
+    )
+    # Small sets are counted exactly, however they are merged
+    small = HyperLogLog()
+    small.update(values[:100])
+    small.update(values[50:150])
+    assert small.count() == 150
+    assert HyperLogLog.from_dict(small.to_dict()).count() == 150
+    assert HyperLogLog().merge(small).count() == 150
+    assert abs(small.merge(a).count() - 200000) < 200000 * 0.03
+    try:
+        HyperLogLog(12).merge(HyperLogLog())
+        assert False, "Expected an exception"
+    except ValueError:
+        pass
+
+
+def test_topk():
+    rng = random.Random(0)
+    values = [f"v{int(rng.paretovariate(1.0))}" for _ in range(100000)]
+    exact = {}
+    for value in values:
+        exact[value] = exact.get(value, 0) + 1
+    expected = sorted(exact, key=lambda v: -exact[v])[:5]
+    a, b = TopK(50), TopK(50)
+    for value in values[:50000]:
+        a.add(value)
+    for value in values[50000:]:
+        b.add(value)
+    a = TopK.from_dict(json.loads(json.dumps(a.to_dict())))
+    top = a.merge(b).top(5)
+    assert [v for v, _ in top] == expected
+    # Counts never underestimate
+    assert all(c >= exact[v] for v, c in top)
+
+
+def test_report():
+    records = list(logparse.parse_lines(_line(n) for n in range(100)))
+    records += list(logparse.parse_lines(_line(n, None) for n in range(10)))
+    records += list(logparse.parse_lines([_line(1)] * 50))
+    rep = report.Report()
+    rep.add_records(records)
+    results = rep.results(3)["organizations"]
+    assert list(results) == [report.ALL, "acme", report.NONE]
+    acme = results["acme"]
+    assert acme["requests"] == 150
+    assert acme["users"] == 100 and acme["hosts"] == 10
+    assert acme["environments"] == 3 and acme["clients"] == 7
+    assert acme["sessions"] == 100
+    assert acme["top_users"][0] == ("u/user1", 51)
+    assert acme["top_hosts"][0] == ("h/host0", 60)
+    assert results[report.NONE]["users"] == 10
+    assert results[report.ALL]["users"] == 100
+    assert rep.results()["top_organizations"] == [("acme", 150)]
+    # Reports built separately merge into the same one
+    half = report.Report()
+    half.add_records(records[:60])
+    rest = report.Report()
+    rest.add_records(records[60:])
+    assert half.merge(rest).results(3)["organizations"] == results
+
+
+def test_report_cli():
+    with tempfile.TemporaryDirectory() as tdir:
+        paths = []
+        for day in range(3):
+            paths.append(os.path.join(tdir, f"access.log.{day}"))
+            with open(paths[-1], "wb") as fp:
+                for n in range(day * 100, day * 100 + 200):
+                    fp.write(_line(n, f"org{n % 2}"))
+        out = StringIO()
+        with redirect_stdout(out):
+            report.main(paths + ["--json"])
+        expected = json.loads(out.getvalue())
+        org0 = expected["organizations"]["org0"]
+        assert org0["requests"] == 300 and org0["users"] == 200
+        # Saved daily reports roll up to the same results
+        saved = []
+        for path in paths:
+            saved.append(path + ".report")
+            report.main([path, "--save", saved[-1], "--quiet"])
+            assert report.is_report(saved[-1]) and not report.is_report(path)
+        out = StringIO()
+        with redirect_stdout(out):
+            report.main(saved + ["--json"])
+        assert json.loads(out.getvalue())["organizations"] == expected["organizations"]
+        # As do the reports of several processes reading chunks of them
+        old_size, logparse.CHUNK_SIZE = logparse.CHUNK_SIZE, 2000
+        try:
+            out = StringIO()
+            with redirect_stdout(out):
+                report.main(paths + ["--json", "--jobs", "2"])
+        finally:
+            logparse.CHUNK_SIZE = old_size
+        results = json.loads(out.getvalue())
+        assert results["organizations"] == expected["organizations"]
+        out = StringIO()
+        with redirect_stdout(out):
+            report.main(saved[:1] + paths[1:] + ["--top", "2"])
+        text = out.getvalue()
+        assert text.startswith("organization") and "top users: org1" in text
+        # Reports of different precisions cannot be merged
+        coarse = os.path.join(tdir, "coarse.report")
+        report.main([paths[0], "--precision", "10", "--save", coarse, "--quiet"])
+        err = StringIO()
+        with redirect_stdout(StringIO()), redirect_stderr(err):
+            assert report.main([saved[0], coarse]) == 1
+        assert err.getvalue() == (
+            f"Error: cannot merge {coarse}, with precision 10, "
+            f"and {saved[0]}, with precision 14\n"
+        )
+
+
+if __name__ == "__main__":
+    test_hyperloglog()
+    test_topk()
+    test_report()
+    test_report_cli()
+    print("OK")
@@ -0,0 +1,98 @@
+import json
+import os
+import tempfile
+
+from anaconda_ident import roster
+from anaconda_ident.tokens import decode_pepper, hash_string
+
+PEPPER = "c2VjcmV0LXBlcHBlcg"
+COMBINED = (
+    '10.0.0.1 - - [17/Oct/2026:10:00:00 +0000] "GET /main/noarch/repodata.json '
+    'HTTP/1.1" 200 12345 "-" "conda/24.1.2 aau/0.4.3 c/client %s"\n'
+)
+
+
+def _hashed(user, host, env, pepper=PEPPER):
+    pepper = decode_pepper(pepper)
+    return "U/%s H/%s N/%s" % (
+        hash_string("username", user, pepper),
+        hash_string("hostname", host, pepper),
+        hash_string("environment", env, pepper),
+    )
+
+
+def test_hash_values():
+    values = ["alice", "bob", "", "ünïcode"]
+    for pepper in (None, "", b"pepper", "a-much-longer-pepper-than-allowed"):
+        expected = [hash_string("username", v, pepper) for v in values]
+        assert roster.hash_values("username", values, pepper) == expected
+    entries = [("username", "user%d" % n) for n in range(100)]
+    entries += [("hostname", "host%d" % n) for n in range(50)] * 2
+    pepper = decode_pepper(PEPPER)
+    old_batch, roster.HASH_BATCH = roster.HASH_BATCH, 16
+    try:
+        table = roster.build_table(entries, pepper)
+        assert len(table["U"]) == 100 and len(table["H"]) == 50 and not table["N"]
+        assert table["U"][hash_string("username", "user7", pepper)] == "user7"
+        assert roster.build_table(entries, pepper, jobs=3) == table
+    finally:
+        roster.HASH_BATCH = old_batch
+    # Batches too large for a pipe's buffer, in either direction
+    entries = [("username", "%064d" % n) for n in range(4 * roster.HASH_BATCH)]
+    assert roster.build_table(entries, pepper, jobs=2) == roster.build_table(
+        entries, pepper
+    )
+
+
+def test_dehash_cli():
+    with tempfile.TemporaryDirectory() as tdir:
+        rpath = os.path.join(tdir, "people.csv")
+        with open(rpath, "w") as fp:
+            fp.write("Username,email,Host\n")
+            fp.write("alice,alice@example.com,build-01.local\n")
+            fp.write("bob,bob@example.com,\n")
+        hpath = os.path.join(tdir, "hosts.ndjson")
+        with open(hpath, "w") as fp:
+            fp.write(json.dumps({"hostname": "laptop-02", "owner": "bob"}) + "\n")
+        epath = os.path.join(tdir, "envs.txt")
+        with open(epath, "w") as fp:
+            fp.write("base\nml-gpu\n\n")
+        lpath = os.path.join(tdir, "access.log")
+        with open(lpath, "w") as fp:
+            fp.write(COMBINED % _hashed("alice", "build-01", "base"))
+            fp.write(COMBINED % _hashed("bob", "laptop-02", "ml-gpu"))
+            fp.write(COMBINED % _hashed("carol", "laptop-02", "base"))
+            fp.write(COMBINED % ("u/dave " + _hashed("bob", "x", "y")))
+            fp.write(COMBINED % _hashed("alice", "build-01", "base", "other"))
+        opath = os.path.join(tdir, "out.ndjson")
+        args = [lpath, "-r", rpath, "-r", hpath, "-r", "environment=" + epath]
+        roster.main(args + ["--pepper", PEPPER, "--fields", "u,h,n", "-o", opath])
+        with open(opath) as fp:
+            records = [json.loads(line) for line in fp]
+        assert records == [
+            {"u": "alice", "h": "build-01", "n": "base"},
+            {"u": "bob", "h": "laptop-02", "n": "ml-gpu"},
+            {"h": "laptop-02", "n": "base"},
+            {"u": "dave"},
+            {},
+        ]
+        # Records hashed with either of two peppers, unless one was not
+        # in use on the date of the logs
+        args += ["--pepper", PEPPER + "::2026-10-31", "--pepper", "other:2026-10-01"]
+        for when, expected in (("2026-10-17", "alice"), ("2026-11-01", None)):
+            roster.main(args + ["--fields", "u", "--date", when, "-o", opath])
+            with open(opath) as fp:
+                records = [json.loads(line) for line in fp]
+            assert records[0].get("u") == expected and records[4] == {"u": "alice"}
+        args = args[:-4]
+        tpath = os.path.join(tdir, "table.csv")
+        roster.main(args + ["--pepper", PEPPER, "--table", "-o", tpath])
+        with open(tpath) as fp:
+            rows = fp.read().splitlines()
+        assert rows[0] == "token,hash,value" and len(rows) == 1 + 2 + 2 + 2
+
+
+if __name__ == "__main__":
+    test_hash_values()
+    test_dehash_cli()
+    print("OK")
@@ -0,0 +1,124 @@
+import os
+import socket
+import tempfile
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import requests
+
+from anaconda_ident import heartbeat, spool
+
+REQUESTS = []
+
+
+class Handler(BaseHTTPRequestHandler):
+    # Keep-alive, so that pooled connections can be observed
+    protocol_version = "HTTP/1.1"
+
+    def do_HEAD(self):
+        port = self.client_address[1]
+        REQUESTS.append((self.path, self.headers.get("User-Agent"), port))
+        self.send_response(404)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+def _closed_port():
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+class _Spool:
+    def __enter__(self):
+        self.tdir = tempfile.TemporaryDirectory()
+        self.old = spool.SPOOL_PATH, spool.SPOOL_BATCH, spool.SPOOL_MAX_BYTES
+        spool.SPOOL_PATH = os.path.join(self.tdir.name, "heartbeat.spool")
+        del REQUESTS[:]
+        return self
+
+    def __exit__(self, *args):
+        spool.SPOOL_PATH, spool.SPOOL_BATCH, spool.SPOOL_MAX_BYTES = self.old
+        self.tdir.cleanup()
+
+
+def test_spool_flush():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    good = f"http://127.0.0.1:{server.server_address[1]}/"
+    bad = f"http://127.0.0.1:{_closed_port()}/"
+    session = requests.Session()
+    session.trust_env = False
+    try:
+        with _Spool():
+            # Failed heartbeats are spooled with their user agents
+            for n in range(5):
+                session.headers["User-Agent"] = f"conda/test c/token{n}"
+                heartbeat._aid_ping(session, bad + f"beat{n}", 0.5)
+            assert not REQUESTS
+            with open(spool.SPOOL_PATH) as fp:
+                assert len(fp.readlines()) == 5
+            # A successful heartbeat in the sender replays the spool,
+            # oldest first, over the same pooled connection
+            heartbeat.SENDER = True
+            spool.SPOOL_BATCH = 2
+            session.headers["User-Agent"] = "conda/test c/live"
+            heartbeat._aid_ping(session, good + "live", 0.5)
+            assert len(REQUESTS) == 1
+            spool._append(
+                spool._format(spool._take()).replace(bad.encode(), good.encode())
+            )
+            # Each flush sends a single batch
+            flushed = [spool.flush(lambda url: session, 0.5) for _ in range(4)]
+            assert flushed == [2, 2, 1, 0]
+            paths = [r[0] for r in REQUESTS]
+            assert paths == ["/live"] + [f"/beat{n}" for n in range(5)]
+            assert [r[1] for r in REQUESTS[1:]] == [
+                f"conda/test c/token{n}" for n in range(5)
+            ]
+            assert len(set(r[2] for r in REQUESTS)) == 1
+            assert not spool.pending()
+    finally:
+        heartbeat.SENDER = False
+        server.shutdown()
+
+
+def test_spool_partial_flush():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    good = f"http://127.0.0.1:{server.server_address[1]}/"
+    bad = f"http://127.0.0.1:{_closed_port()}/"
+    session = requests.Session()
+    session.trust_env = False
+    try:
+        with _Spool():
+            spool.SPOOL_BATCH = 4
+            for n in range(5):
+                spool.spool_event((bad if n == 3 else good) + f"beat{n}", f"ua{n}")
+            # Stops at the unreachable one, leaving it and the rest
+            assert spool.flush(lambda url: session, 0.5) == 3
+            assert [e[1][-5:] for e in spool._take()] == ["beat3", "beat4"]
+    finally:
+        server.shutdown()
+
+
+def test_spool_compaction():
+    with _Spool():
+        spool.SPOOL_MAX_BYTES = 2000
+        for n in range(200):
+            spool.spool_event(f"http://localhost/beat{n}", f"conda/test c/{n}")
+            assert os.path.getsize(spool.SPOOL_PATH) <= spool.SPOOL_MAX_BYTES
+        events = spool._take()
+        assert events[-1][1] == "http://localhost/beat199"
+        assert 0 < len(events) < 200
+        assert not os.path.exists(spool._lock_path())
+
+
+if __name__ == "__main__":
+    test_spool_flush()
+    test_spool_partial_flush()
+    test_spool_compaction()
+    print("OK")
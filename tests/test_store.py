@@ -0,0 +1,210 @@
+import json
+import os
+import sqlite3
+import tempfile
+from contextlib import redirect_stdout
+from datetime import date, datetime
+from io import StringIO
+
+from anaconda_ident import store
+from anaconda_ident.logparse import parse_line
+
+COMBINED = (
+    '10.0.0.1 - - [%s] "GET /main/noarch/repodata.json HTTP/1.1" 200 1 "-" '
+    '"conda/24.1.2 aau/0.4.3 c/client s/session%d e/%s u/%s h/%s o/%s"\n'
+)
+JSON = '{"time":"%s","agent":"conda/24.1.2 aau/0.4.3 u/%s h/%s n/%s o/%s"}\n'
+HOUR = store.parse_time(b"[17/Oct/2026:10:00:00 +0000]")
+
+
+def test_parse_time():
+    assert (
+        HOUR
+        == (date(2026, 10, 17).toordinal() - date(1970, 1, 1).toordinal()) * 24 + 10
+    )
+    for line, expected in (
+        (b'1.2.3.4 - - [17/Oct/2026:10:59:59 +0000] "GET /"', HOUR),
+        (b"[17/Oct/2026:12:30:00 +0230] x", HOUR),
+        (b"[17/Oct/2026:05:00:00 -0500]", HOUR),
+        (b'{"time":"2026-10-17T10:15:00.123Z"}', HOUR),
+        (b'{"time":"2026-10-17 11:15:00+01:00"}', HOUR),
+        (b"2026-10-17T10:00", HOUR),
+        (b"[17/Foo/2026:10:00:00 +0000]", None),
+        (b"2026-13-17T10:00:00Z", None),
+        (b"no timestamp", None),
+    ):
+        assert store.parse_time(line) == expected, line
+    lines = [
+        b'[17/Oct/2026:10:00:00 +0000] "conda/24.1 aau/0.4 u/alice"',
+        b"[17/Oct/2026:10:00:00 +0000] no tokens",
+        b'"conda/24.1 aau/0.4 u/alice"',
+    ]
+    result = list(store.timed_records(lines, default=7))
+    assert result == [(HOUR, parse_line(lines[0]))] * 1 + [(7, parse_line(lines[2]))]
+
+
+def _write_logs(path):
+    with open(path, "w") as fp:
+        for n in range(50):
+            # Three days of requests from two organizations
+            stamp = "%02d/Oct/2026:%02d:00:00 +0000" % (15 + n % 3, n % 24)
+            env = "ml-gpu" if n % 5 == 0 else "base"
+            org = "acme" if n % 2 else "initech"
+            fp.write(
+                COMBINED % (stamp, n, env, "user%d" % (n % 4), "host%d" % (n % 7), org)
+            )
+        fp.write(JSON % ("2026-10-17T10:00:00Z", "alice", "laptop", "ml-gpu", "acme"))
+        # A request from two organizations
+        fp.write(
+            COMBINED
+            % (
+                "17/Oct/2026:12:00:00 +0000",
+                50,
+                "base",
+                "carol",
+                "host9",
+                "acme o/beta",
+            )
+        )
+        fp.write('"GET /" 200 1 "-" "conda/24.1.2"\n')
+
+
+def test_store():
+    with tempfile.TemporaryDirectory() as tdir:
+        lpath = os.path.join(tdir, "access.log")
+        _write_logs(lpath)
+        dpath = os.path.join(tdir, "telemetry.db")
+        with store.Store(dpath) as db:
+            assert store.ingest(db, [lpath]) == 52
+            days = db.query("days")
+            assert [d["value"] for d in days] == [
+                "2026-10-15",
+                "2026-10-16",
+                "2026-10-17",
+            ]
+            # The request from two organizations is counted once in
+            # total, and once for each of them
+            assert sum(d["requests"] for d in days) == 52
+            assert sum(u["requests"] for u in db.query("users")) == 52
+            orgs = {o["value"]: o["requests"] for o in db.query("organizations")}
+            assert orgs == {"acme": 27, "initech": 25, "beta": 1}
+            assert db.query("users", org="beta") == [
+                {
+                    "value": "carol",
+                    "requests": 1,
+                    "first": "2026-10-17",
+                    "last": "2026-10-17",
+                }
+            ]
+            assert db.query("days", org="acme")[-1]["requests"] == 10
+            hosts = db.query("hosts", org="acme", env="ml-gpu")
+            assert [h["value"] for h in hosts] == [
+                "host0",
+                "host1",
+                "host3",
+                "host4",
+                "host5",
+                "laptop",
+            ]
+            assert hosts[1] == {
+                "value": "host1",
+                "requests": 1,
+                "first": "2026-10-15",
+                "last": "2026-10-15",
+            }
+            # Values are matched whatever their token, with or without it
+            assert db.query("hosts", org="o/acme", env="n/ml-gpu") == hosts
+            assert db.query("hosts", org="nobody") == []
+            since = date(2026, 10, 17)
+            users = db.query("users", org="acme", since=since, limit=2)
+            assert [u["value"] for u in users] == ["user1", "user3"]
+            orgs = db.query("organizations", host="host0")
+            assert {o["value"]: o["requests"] for o in orgs} == {
+                "acme": 4,
+                "initech": 4,
+            }
+            # Datetimes select whole hours from the hourly rollups
+            hours = db.query("hours", since=datetime(2026, 10, 17, 10), until=since)
+            assert hours == [
+                {"value": "2026-10-17 %02d:00" % h, "requests": n}
+                for h, n in (
+                    (10, 1),
+                    (11, 2),
+                    (12, 1),
+                    (14, 2),
+                    (17, 2),
+                    (20, 2),
+                    (23, 2),
+                )
+            ]
+            # Ingesting again adds to the counts, as does ingesting in parallel
+            assert store.ingest(db, [lpath], jobs=2) == 52
+            assert sum(d["requests"] for d in db.query("days")) == 104
+            (count,) = db.db.execute("SELECT COUNT(*) FROM records").fetchone()
+            assert count == 52
+
+
+def test_store_version():
+    with tempfile.TemporaryDirectory() as tdir:
+        dpath = os.path.join(tdir, "telemetry.db")
+        db = sqlite3.connect(dpath)
+        db.executescript(
+            "CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT NOT NULL);"
+            "INSERT INTO meta VALUES ('version', '1');"
+        )
+        db.commit()
+        db.close()
+        with open(dpath, "rb") as fp:
+            before = fp.read()
+        try:
+            store.Store(dpath)
+            assert False, "Expected an exception"
+        except ValueError as exc:
+            assert "version 1" in str(exc)
+        # Nothing was added to it, nor was its journal mode changed
+        with open(dpath, "rb") as fp:
+            assert fp.read() == before
+        assert sorted(os.listdir(tdir)) == ["telemetry.db"]
+
+
+def test_query_cli():
+    with tempfile.TemporaryDirectory() as tdir:
+        lpath = os.path.join(tdir, "access.log")
+        _write_logs(lpath)
+        dpath = os.path.join(tdir, "telemetry.db")
+        with redirect_stdout(StringIO()) as out:
+            assert store.main(["ingest", dpath, lpath, "--incremental"]) == 0
+            # Only the lines added since are read
+            assert store.main(["ingest", dpath, lpath, "--incremental"]) == 0
+            with open(lpath, "a") as fp:
+                fp.write(
+                    JSON % ("2026-10-18T01:00:00Z", "bob", "laptop", "base", "acme")
+                )
+            assert store.main(["ingest", dpath, lpath, "--incremental"]) == 0
+        assert out.getvalue().splitlines() == [
+            f"{dpath}: 52 requests added",
+            f"{dpath}: 0 requests added",
+            f"{dpath}: 1 requests added",
+        ]
+        args = [dpath, "hosts", "--org", "acme", "--env", "ml-gpu", "--json"]
+        with redirect_stdout(StringIO()) as out:
+            assert store.main(args + ["--since", "2026-10-17"]) == 0
+        assert [h["value"] for h in json.loads(out.getvalue())] == [
+            "host0",
+            "host5",
+            "laptop",
+        ]
+        with redirect_stdout(StringIO()) as out:
+            assert store.main([dpath, "users", "--user", "bob"]) == 0
+        assert out.getvalue() == "           1  2026-10-18  2026-10-18  bob\n"
+        with redirect_stdout(StringIO()) as out:
+            store.main([dpath, "days", "--org", "acme", "--days", "100000"])
+        assert len(out.getvalue().splitlines()) == 4
+
+
+if __name__ == "__main__":
+    test_parse_time()
+    test_store()
+    test_store_version()
+    test_query_cli()
+    print("OK")
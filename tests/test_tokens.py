@@ -0,0 +1,98 @@
+import os
+import subprocess
+import sys
+import tempfile
+import time
+
+from anaconda_ident import tokens
+
+URL = "https://repo.example.com/repo/main/"
+
+
+def _write_condarc(fpath, token):
+    with open(fpath, "w") as fp:
+        fp.write(f"repo_tokens:\n  {URL}: {token}\n")
+
+
+def _setenv(name, value):
+    if value is None:
+        os.environ.pop(name, None)
+    else:
+        os.environ[name] = value
+
+
+def test_repo_tokens_reloaded():
+    old = os.environ.get("CONDARC")
+    try:
+        with tempfile.TemporaryDirectory() as tdir:
+            fpath = os.path.join(tdir, "condarc")
+            os.environ["CONDARC"] = fpath
+            _write_condarc(fpath, "token1")
+            first = tokens.load_repo_tokens()
+            assert first[URL] == "token1"
+            assert tokens.load_repo_tokens() is first
+            _write_condarc(fpath, "token2")
+            mtime = time.time() + 10
+            os.utime(fpath, (mtime, mtime))
+            second = tokens.load_repo_tokens()
+            assert second is not first and second[URL] == "token2"
+            os.unlink(fpath)
+            assert URL not in tokens.load_repo_tokens()
+    finally:
+        _setenv("CONDARC", old)
+
+
+# Reads the repository tokens before the user agent, in a process in
+# which the patch has been deferred, as conda's pre-command hook does
+DEFERRED = """
+from conda.base.context import context
+from anaconda_ident import patch, tokens
+context.__init__()
+assert patch.defer()
+baked = tokens.get_baked_tokens()
+assert context._aid_initialized and baked is context.repo_tokens
+assert tokens.load_baked_token(%r) == "token1"
+assert " aid/" in context.user_agent
+"""
+
+
+def test_deferred_repo_tokens():
+    with tempfile.TemporaryDirectory() as tdir:
+        fpath = os.path.join(tdir, "condarc")
+        _write_condarc(fpath, "token1")
+        env = dict(os.environ, CONDARC=fpath)
+        proc = subprocess.run(
+            [sys.executable, "-c", DEFERRED % (URL + "linux-64/repodata.json")],
+            env=env,
+            capture_output=True,
+            text=True,
+        )
+        assert proc.returncode == 0, proc.stderr
+
+
+def test_root_prefix():
+    old = os.environ.get("CONDA_ROOT"), os.environ.get("CONDA_PYTHON_EXE")
+    try:
+        os.environ["CONDA_ROOT"] = sys.prefix
+        os.environ.pop("CONDA_PYTHON_EXE", None)
+        assert tokens._root_prefix() == sys.prefix
+        # The Python of an environment, with conda's shell integration
+        base = os.path.join(tempfile.gettempdir(), "base")
+        if sys.platform == "win32":
+            os.environ["CONDA_PYTHON_EXE"] = os.path.join(base, "python.exe")
+        else:
+            os.environ["CONDA_PYTHON_EXE"] = os.path.join(base, "bin", "python")
+        assert tokens._root_prefix() == base
+        # An explicit setting takes precedence
+        os.environ["CONDA_ROOT"] = base + "2"
+        assert tokens._root_prefix() == base + "2"
+    finally:
+        _setenv("CONDA_ROOT", old[0])
+        _setenv("CONDA_PYTHON_EXE", old[1])
+
+
+if __name__ == "__main__":
+    test_repo_tokens_reloaded()
+    test_deferred_repo_tokens()
+    test_root_prefix()
+    print("OK")